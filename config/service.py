@@ -54,6 +54,144 @@ JPER_BASE_URL = "http://www.oa-deepgreen.de/api/v1"
 JPER_API_KEY = ""
 """API key for making requests against JPER - not needed here, as incoming user's own API keys will be used"""
 
+JPER_POOL_SIZE = 10
+"""maximum number of pooled, keep-alive connections to JPER held by each worker process"""
+
+JPER_CONNECT_TIMEOUT = 5
+"""seconds to wait when opening a connection to JPER"""
+
+JPER_READ_TIMEOUT = 60
+"""seconds to wait for JPER to send data on an open connection"""
+
+JPER_TIMEOUTS = {
+    "get_notification" : (5, 10),
+    "notification_exists" : (5, 10),
+    "content_accessible" : (5, 10),
+    "list_notifications" : (5, 30),
+    "check_credentials" : (5, 10),
+    "validate" : (5, 120),
+    "create_notification" : (5, 300),
+    "get_content" : (5, 60)
+}
+"""connect and read timeouts in seconds for each operation on JPER; operations not listed use JPER_CONNECT_TIMEOUT and JPER_READ_TIMEOUT"""
+
+JPER_RETRIES = 2
+"""number of times to retry a read from JPER which fails with a connection error, timeout or 5xx.  Deposits are never retried"""
+
+JPER_RETRY_BACKOFF = 0.1
+"""seconds to wait before the first retry of a read from JPER; the wait doubles with each further retry, with random jitter"""
+
+JPER_RETRY_BACKOFF_MAX = 2
+"""maximum seconds to wait between retries of a read from JPER"""
+
+JPER_BREAKER_THRESHOLD = 5
+"""number of consecutive failed requests to JPER after which requests are refused at once with a 503, rather than sent"""
+
+JPER_BREAKER_RESET_TIMEOUT = 30
+"""seconds to refuse requests for once JPER_BREAKER_THRESHOLD is reached, before a trial request is sent to see if JPER has recovered"""
+
+JPER_VERIFY_CREDENTIALS = False
+"""check users' API keys with JPER before accepting their requests, rather than just forwarding them, so that deposits with bad keys are refused before they are uploaded"""
+
+EARLY_REJECT_DRAIN_LIMIT = 1048576
+"""largest body, in bytes, of a deposit refused before it is read which is read and discarded before the refusal is sent; the connection is closed after refusing larger deposits, so the client may see a reset rather than the refusal"""
+
+JPER_CREDENTIAL_PROBE_ID = "sword-in-credential-check"
+"""id of a notification which does not exist, requested from JPER to check whether it accepts an API key"""
+
+CREDENTIAL_CACHE_SIZE = 1000
+"""maximum number of API key check outcomes to remember"""
+
+CREDENTIAL_CACHE_VALID_TTL = 600
+"""seconds to remember that JPER accepted an API key"""
+
+CREDENTIAL_CACHE_INVALID_TTL = 60
+"""seconds to remember that JPER refused an API key"""
+
+JPER_UPLOAD_CHUNK_SIZE = 1048576
+"""size in bytes of the chunks in which deposited content is read and forwarded to JPER"""
+
+JPER_UPLOAD_CHUNKED = False
+"""send deposited content to JPER with chunked transfer encoding even when its size is known.  If False, chunked encoding is only used when the size of the content can't be determined, as for a streamed deposit sent without a Content-Length"""
+
+############################################
+## Deposit handling
+
+DEPOSIT_STREAMING = False
+"""stream deposits straight through to JPER as they arrive, rather than letting the SWORD server receive them into tmp_dir first"""
+
+DEPOSIT_STREAMING_MAX_UPLOAD_SIZE = 1073741824
+"""maximum size in bytes of a streamed or buffered deposit (this default is 1Gb).  The max_upload_size in SWORDV2_SERVER_CONFIG applies otherwise"""
+
+DEPOSIT_BUFFERING = False
+"""receive deposits in memory, or in a temporary file if they are large, in large blocks, rather than letting the SWORD server receive them into tmp_dir.  Ignored if DEPOSIT_STREAMING is enabled"""
+
+DEPOSIT_BUFFER_MEMORY_THRESHOLD = 8388608
+"""size in bytes above which a buffered deposit is received into a temporary file rather than into memory"""
+
+DEPOSIT_BUFFER_BLOCK_SIZE = 1048576
+"""size in bytes of the blocks in which a buffered deposit is received"""
+
+DEPOSIT_BUFFER_DIR = None
+"""directory to receive large buffered deposits into; the system temporary directory if None"""
+
+PACKAGE_PRECHECK = False
+"""check deposited packages locally, and reject those which are not zip files or lack a JATS XML file, before sending them to JPER"""
+
+PACKAGE_PRECHECK_FORMATS = ["https://datahub.deepgreen.org/FilesAndJATS"]
+"""packaging formats which are checked locally before sending them to JPER"""
+
+PACKAGE_PRECHECK_CACHE_SIZE = 1000
+"""maximum number of local package check outcomes to remember"""
+
+PACKAGE_PRECHECK_CACHE_TTL = 86400
+"""seconds to remember the outcome of a local package check, by the SHA-256 digest of the package"""
+
+BULK_DEPOSIT_WORKERS = 8
+"""maximum number of packages from a single bulk deposit to send to JPER concurrently"""
+
+BULK_DEPOSIT_MAX_PACKAGES = 1000
+"""maximum number of packages allowed in a single bulk deposit"""
+
+############################################
+## Notification cache
+
+NOTIFICATION_CACHE_SIZE = 1000
+"""maximum number of notifications to hold in the process-wide notification cache"""
+
+NOTIFICATION_CACHE_ROUTED_TTL = 3600
+"""seconds to cache a notification which has already been routed (has an analysis_date), and so will not change"""
+
+NOTIFICATION_CACHE_PENDING_TTL = 10
+"""seconds to cache a notification which is still pending routing, and so may change at any moment"""
+
+NOTIFICATION_NEGATIVE_CACHE_SIZE = 1000
+"""maximum number of notification ids which JPER reported as not found to remember"""
+
+NOTIFICATION_NEGATIVE_CACHE_TTL = 30
+"""seconds to remember that JPER reported a notification as not found, before asking it again"""
+
+EXISTENCE_INDEX_SIZE = 100000
+"""maximum number of notification ids known to exist to remember in each worker, for answering existence checks without retrieving the notification"""
+
+EXISTENCE_INDEX_TTL = 86400
+"""seconds to remember that a notification exists"""
+
+COLLECTION_PAGE_SIZE = 100
+"""number of notifications on each page of the Atom feed listing a collection"""
+
+COLLECTION_PAGE_CACHE_SIZE = 1000
+"""maximum number of pages of collection listings to hold in each worker's cache"""
+
+COLLECTION_PAGE_CACHE_TTL = 30
+"""seconds to cache a page of a collection listing"""
+
+RENDERED_CACHE_SIZE = 1000
+"""maximum number of rendered statements and deposit receipts to hold in memory"""
+
+RENDERED_CACHE_TTL = 3600
+"""seconds to hold a rendered statement or deposit receipt.  These are cached against the state of the notification, so are never stale"""
+
 
 ############################################
 ## SWORD Server configuration
@@ -158,7 +296,8 @@ SWORDV2_SERVER_CONFIG = {
     "tmp_dir" : paths.rel2abs(__file__, "..", "..", "..", "..", "service", "tests", "sss_tmp"),
 
     # The chunk size used to copy file streams into and out of the temp directory
-    "copy_chunk_size" : 8096,
+    # (this is well above the SSS default of 8096, so that large deposits are not copied in thousands of pieces)
+    "copy_chunk_size" : 1048576,
 
     # use this to create an error
     "accept_nothing" : False,
@@ -212,3 +351,130 @@ SWORDV2_SERVER_CONFIG = {
 
 }
 """Simple SWORD Server external library configuration object - see SSS documentation for more information"""
+
+############################################
+## Local storage
+
+DEPOSIT_DEDUP = False
+"""recognise notify deposits which repeat one made recently by the same account, and answer them with the original receipt rather than creating a new notification"""
+
+DEPOSIT_DEDUP_WINDOW = 86400
+"""seconds after a notify deposit during which a repeat of it is answered with the original receipt"""
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+"""request header in which clients may send their own key identifying a deposit, so that retries of it are recognised"""
+
+DEPOSIT_INDEX_PATH = paths.rel2abs(__file__, "..", "var", "deposits.sqlite")
+"""SQLite database holding the index of recent notify deposits.  This is shared by all of the workers on the host"""
+
+DEPOSIT_INDEX_MAX_ENTRIES = 100000
+"""maximum number of entries to keep in the index of recent notify deposits"""
+
+NOTIFY_ASYNC = False
+"""write notify deposits to a local spool and reply 202 Accepted at once, rather than waiting for JPER to create the notification.  Background forwarders deliver the spooled deposits to JPER"""
+
+SPOOL_DIR = paths.rel2abs(__file__, "..", "var", "spool")
+"""directory holding the content of spooled deposits.  This must only be readable by the application's user"""
+
+SPOOL_JOURNAL_PATH = paths.rel2abs(__file__, "..", "var", "spool.sqlite")
+"""SQLite database recording the state of spooled deposits.  This holds users' API keys, so must only be readable by the application's user"""
+
+SPOOL_FORWARDERS = 2
+"""number of threads in each worker process forwarding spooled deposits to JPER"""
+
+SPOOL_POLL_INTERVAL = 1
+"""seconds for a forwarder to wait before checking an empty spool again"""
+
+SPOOL_MAX_ATTEMPTS = 10
+"""number of times to try forwarding a spooled deposit before giving up on it"""
+
+SPOOL_RETRY_BASE = 5
+"""seconds to wait before the first retry of a spooled deposit; the wait doubles with each further retry"""
+
+SPOOL_RETRY_MAX = 3600
+"""maximum seconds to wait between retries of a spooled deposit"""
+
+SPOOL_STALE_AFTER = 600
+"""seconds after which a spooled deposit claimed by a forwarder which has stopped renewing its claim (because its worker died) is claimed again.  This must be several times SPOOL_HEARTBEAT_INTERVAL"""
+
+SPOOL_HEARTBEAT_INTERVAL = 60
+"""seconds between renewals of the claim on a spooled deposit while it is being sent to JPER, so that a slow upload is never taken for an abandoned one"""
+
+SPOOL_RETENTION = 604800
+"""seconds to keep the record of a forwarded or failed deposit in the spool journal, so that its status can be reported"""
+
+MEDIA_RESOURCE_PROXY = False
+"""answer requests for a notification's media resource with the package itself, served from a local cache, rather than with a redirect to the package in JPER"""
+
+PACKAGE_CACHE_DIR = paths.rel2abs(__file__, "..", "var", "packages")
+"""directory holding the cached packages served when MEDIA_RESOURCE_PROXY is enabled"""
+
+PACKAGE_CACHE_INDEX_PATH = paths.rel2abs(__file__, "..", "var", "packages.sqlite")
+"""SQLite database holding the index of the package cache.  This is shared by all of the workers on the host"""
+
+PACKAGE_CACHE_MAX_BYTES = 10737418240
+"""maximum total size in bytes of the cached packages; the least recently used are removed to stay within it"""
+
+PACKAGE_ACCESS_TTL = 86400
+"""seconds for which JPER's answer that an account may retrieve a package is relied on, before serving that account the cached package means asking JPER again"""
+
+
+############################################
+## Shared caches
+
+CACHE_BACKEND = "memory"
+"""where to keep the caches named in SHARED_CACHES: "memory", in each worker process, or "sqlite", in a database shared by all of the workers on the host"""
+
+SHARED_CACHES = ["notifications", "missing_notifications", "collection_pages", "rendered", "credentials"]
+"""the caches which use CACHE_BACKEND; all others are always kept in each worker's memory"""
+
+CACHE_SQLITE_PATH = paths.rel2abs(__file__, "..", "var", "cache.sqlite")
+"""SQLite database holding the shared caches, when CACHE_BACKEND is "sqlite".  This holds users' notifications, so must only be readable by the application's user, and is best kept on a local (or memory-backed, e.g. /dev/shm) filesystem"""
+
+
+############################################
+## Start-up
+
+PRELOAD = True
+"""import the modules of the SwordServer and Authenticator classes, and compile the templates in PRELOAD_TEMPLATES, when the application starts rather than on the first request to need them.  With preload_app set in the gunicorn configuration, this is done once, in the gunicorn master"""
+
+PRELOAD_TEMPLATES = ["errors/404.html"]
+"""templates to compile when the application starts"""
+
+
+############################################
+## Compression
+
+COMPRESSION = True
+"""compress statements, deposit receipts and the service document for clients which accept gzip (or brotli) encoding"""
+
+COMPRESSION_MIMETYPES = ["application/atom+xml", "application/rdf+xml", "application/xml", "text/xml", "text/html", "application/json"]
+"""the types of response which are compressed"""
+
+COMPRESSION_MIN_SIZE = 1024
+"""size in bytes below which responses are not compressed"""
+
+COMPRESSION_LEVEL = 6
+"""gzip compression level, from 1 (fastest) to 9 (smallest)"""
+
+COMPRESSION_BROTLI = True
+"""offer brotli encoding to clients which prefer it.  This needs the brotli package installed, and is ignored if it is not"""
+
+COMPRESSION_BROTLI_QUALITY = 5
+"""brotli compression quality, from 0 (fastest) to 11 (smallest)"""
+
+COMPRESSED_CACHE_SIZE = 1000
+"""maximum number of compressed response bodies to hold in each worker's cache"""
+
+COMPRESSED_CACHE_TTL = 3600
+"""seconds to hold a compressed response body.  These are cached against the ETag or digest of the uncompressed body, so are never stale"""
+
+
+############################################
+## Metrics
+
+METRICS_ENDPOINT = False
+"""serve Prometheus metrics at /metrics.  They describe the traffic and health of the service, so if this is enabled, /metrics should only be reachable by your Prometheus server, or be protected with METRICS_TOKEN"""
+
+METRICS_TOKEN = None
+"""if set, scrapes of /metrics must send this in an "Authorization: Bearer" header, and are refused with a 401 otherwise"""
@@ -9,4 +9,39 @@ pip install -r requirements.txt
 
 sudo supervisorctl reread jper-sword-in
 sudo supervisorctl update jper-sword-in
-kill -HUP $(sudo supervisorctl pid jper-sword-in)
+
+# The application is preloaded by the gunicorn master (preload_app in deployment/gconf_common.py), so a HUP would
+# only fork new workers from the code it already has.  Instead the master is upgraded in place: USR2 starts a new
+# master, with the new code, alongside the old one, and once its workers are running the old master is stopped.
+# Requests are answered throughout.  gunicorn is not daemonized under supervisor, so it ignores WINCH, and QUIT
+# would cut off the requests the old workers are answering; TERM stops the old master and its workers gracefully.
+# deployment/supervise_gunicorn.sh keeps supervisor following whichever master is running.
+PIDFILE=$DIR/var/gunicorn.pid
+if [ ! -f "$PIDFILE" ]; then
+    echo "gunicorn is not running, starting it"
+    sudo supervisorctl start jper-sword-in
+    exit 0
+fi
+
+OLD=$( cat "$PIDFILE" )
+kill -USR2 "$OLD"
+
+# wait for the new master to write its pid file, and fork its workers.  If it fails to start, the old master
+# puts its own pid file back, and carries on serving
+NEW=$OLD
+i=0
+while [ $i -lt 60 ]; do
+    NEW=$( cat "$PIDFILE" 2>/dev/null )
+    if [ -n "$NEW" ] && [ "$NEW" != "$OLD" ] && pgrep -P "$NEW" >/dev/null; then
+        break
+    fi
+    i=$(( i + 1 ))
+    sleep 1
+done
+if [ -z "$NEW" ] || [ "$NEW" = "$OLD" ] || ! pgrep -P "$NEW" >/dev/null; then
+    echo "the new gunicorn master did not start; the old one (pid $OLD) is still running the previous code"
+    exit 1
+fi
+
+kill -TERM "$OLD"
+echo "gunicorn upgraded: pid $OLD replaced by $NEW"
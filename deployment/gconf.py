@@ -2,4 +2,9 @@ bind = '127.0.0.1:5025'
 workers = 4
 worker_connections = 1000
 
+# preload_app, and the recording of metrics (see gconf_common.py)
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from gconf_common import *
+
 # see https://github.com/benoitc/gunicorn/blob/master/examples/example_config.py for more config
\ No newline at end of file
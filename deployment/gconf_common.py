@@ -0,0 +1,23 @@
+# Settings shared by the gunicorn configurations in this directory, which import everything from here.
+
+# Load the application once in the master, and fork the workers from it, so that they start at once and share
+# its memory copy-on-write (see service/startup.py).  Note that a HUP then restarts the workers with the code the
+# master loaded, so deploy.sh upgrades the master in place (with USR2) to pick up new code.
+preload_app = True
+
+# Each worker writes its metrics to its own files in this directory, and /metrics adds them up (see service/metrics.py)
+import os, shutil
+os.environ.setdefault("prometheus_multiproc_dir", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "var", "metrics"))
+
+def on_starting(server):
+    # clear out the metrics of workers from previous runs, unless this is the new master of an upgrade (which
+    # gunicorn passes its listening sockets in GUNICORN_FD), whose predecessor's workers are still running
+    if "GUNICORN_FD" in os.environ:
+        return
+    d = os.environ["prometheus_multiproc_dir"]
+    shutil.rmtree(d, ignore_errors=True)
+    os.makedirs(d)
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,19 @@
+# High-concurrency profile: each worker process serves requests from a pool of threads, so
+# that many requests can be waiting on JPER at once.  Use it in place of gconf.py in the
+# supervisor configuration.  Python 2 needs the "futures" package installed for gthread workers.
+#
+# Each worker needs a pooled connection to JPER for every thread, so set JPER_POOL_SIZE in
+# local.cfg to at least the number of threads.
+bind = '127.0.0.1:5025'
+workers = 4
+worker_class = 'gthread'
+threads = 16
+timeout = 120
+keepalive = 5
+
+# preload_app, and the recording of metrics (see gconf_common.py)
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from gconf_common import *
+
+# see https://github.com/benoitc/gunicorn/blob/master/examples/example_config.py for more config
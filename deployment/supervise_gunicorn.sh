@@ -0,0 +1,51 @@
+#!/bin/sh
+# Run gunicorn under supervisor in a way which survives the in-place upgrades deploy.sh makes.
+#
+# deploy.sh upgrades gunicorn by sending USR2 to its master, which starts a new master alongside it, and then
+# stopping the old master.  The new master is not a child of supervisor, so if supervisor ran gunicorn directly it
+# would take the old master's exit for a crash, and start another gunicorn.  Instead supervisor runs this script,
+# which starts gunicorn with a pid file, and stays running for as long as a gunicorn master (old or new) is, passing
+# on the signals supervisor sends it to the current master.
+#
+# Usage, as the supervisor command (see sword-in.conf):
+#
+#     supervise_gunicorn.sh /path/to/bin/gunicorn -c deployment/gconf.py service.web:app
+
+ROOT=$( cd "$( dirname "$0" )/.." && pwd )
+PIDFILE=${GUNICORN_PIDFILE:-$ROOT/var/gunicorn.pid}
+mkdir -p "$( dirname "$PIDFILE" )"
+
+# during an upgrade the old master's pid file is renamed with .oldbin until it exits
+master() {
+    for f in "$PIDFILE" "$PIDFILE.oldbin"; do
+        if [ -f "$f" ] && kill -0 "$( cat "$f" )" 2>/dev/null; then
+            cat "$f"
+            return 0
+        fi
+    done
+    return 1
+}
+
+forward() {
+    pid=$( master ) && kill -"$1" "$pid"
+}
+
+trap 'forward TERM' TERM INT
+trap 'forward HUP' HUP
+trap 'forward QUIT' QUIT
+
+"$@" --pid "$PIDFILE" &
+STARTED=$!
+
+# wait for the first master to write its pid file, unless it fails to start
+while ! master >/dev/null; do
+    if ! kill -0 "$STARTED" 2>/dev/null; then
+        wait "$STARTED"
+        exit $?
+    fi
+    sleep 1
+done
+
+while master >/dev/null; do
+    sleep 1
+done
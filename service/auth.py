@@ -0,0 +1,55 @@
+"""
+Verification of users' credentials against JPER
+
+JPER is the authority on which API keys are valid, so by default credentials are simply forwarded to it with each
+request.  When JPER_VERIFY_CREDENTIALS is enabled, API keys are instead checked with JPER up front, and the outcome
+is cached, so that requests with bad keys can be refused before any work is done on them.
+"""
+
+import hashlib
+from octopus.core import app
+from service import cache, upstream
+
+def account_id(api_key):
+    """
+    Identify an account by a digest of its API key, so that the key itself need not be kept
+
+    :param api_key: the API key
+    :return: the account identifier
+    """
+    if isinstance(api_key, unicode):
+        api_key = api_key.encode("utf-8")
+    return hashlib.sha256(api_key or "").hexdigest()
+
+def credential_cache():
+    """
+    Get the cache of the outcomes of checking API keys with JPER
+
+    :return: the cache of outcomes, keyed by a digest of the API key
+    """
+    return cache.get_cache("credentials",
+                           maxsize=app.config.get("CREDENTIAL_CACHE_SIZE", 1000),
+                           ttl=app.config.get("CREDENTIAL_CACHE_VALID_TTL", 600))
+
+def credentials_valid(api_key):
+    """
+    Is the API key accepted by JPER?  Valid and invalid outcomes are cached for CREDENTIAL_CACHE_VALID_TTL and
+    CREDENTIAL_CACHE_INVALID_TTL seconds respectively.
+
+    :param api_key: the API key
+    :return: True if the key is valid, False if not
+    """
+    if not api_key:
+        return False
+    key = account_id(api_key)
+
+    cc = credential_cache()
+    valid = cc.get(key)
+    if valid is None:
+        valid = upstream.get_client(api_key).check_credentials()
+        if valid:
+            cc.set(key, True, ttl=app.config.get("CREDENTIAL_CACHE_VALID_TTL", 600))
+        else:
+            cc.set(key, False, ttl=app.config.get("CREDENTIAL_CACHE_INVALID_TTL", 60))
+        app.logger.debug(u"Checked API key with JPER, valid:%s", valid)
+    return valid
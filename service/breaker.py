@@ -0,0 +1,148 @@
+"""
+Circuit breakers for upstream services
+
+A circuit breaker watches the outcome of calls to an upstream service.  While the service is healthy the breaker
+is closed, and calls go through as normal.  After a run of consecutive failures it opens, and calls are refused
+at once, without waiting on the service, until the reset timeout has passed.  It then lets a single trial call
+through (half-open): if that succeeds the breaker closes again, and if it fails the breaker re-opens.
+
+Breakers are held per process, so each worker makes its own judgement of the service's health.
+"""
+
+import threading, time
+from octopus.core import app
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name, threshold=5, reset_timeout=30):
+    """
+    Get the named process-wide circuit breaker, creating it with the given settings on first use
+
+    :param name: name of the breaker
+    :param threshold: number of consecutive failures after which the breaker opens
+    :param reset_timeout: seconds for which the breaker stays open before allowing a trial call
+    :return: the CircuitBreaker
+    """
+    b = _breakers.get(name)
+    if b is None:
+        with _breakers_lock:
+            b = _breakers.get(name)
+            if b is None:
+                b = CircuitBreaker(name, threshold=threshold, reset_timeout=reset_timeout)
+                _breakers[name] = b
+    return b
+
+def all_stats():
+    """
+    Get the state and counters of all of the process-wide circuit breakers
+
+    :return: dict of breaker name to the stats for that breaker
+    """
+    return dict([(name, b.stats()) for name, b in _breakers.items()])
+
+class CircuitBreaker(object):
+    """
+    Thread-safe circuit breaker.  Callers ask allow() before making a call, and then report its outcome with
+    success() or failure().
+    """
+    def __init__(self, name, threshold=5, reset_timeout=30):
+        """
+        :param name: name of the breaker, used in log messages
+        :param threshold: number of consecutive failures after which the breaker opens
+        :param reset_timeout: seconds for which the breaker stays open before allowing a trial call
+        """
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self.successes = 0
+        self.failures = 0
+        self.rejections = 0
+        self.trips = 0
+
+    def allow(self):
+        """
+        May a call be made now?  Once the reset timeout has passed on an open breaker, the first caller to ask is
+        allowed through to make the trial call, and everyone else is refused until its outcome is known.
+
+        :return: True if the call may be made, False if it should be refused
+        """
+        with self._lock:
+            if self.state == OPEN and time.time() >= self.opened_at + self.reset_timeout:
+                self._transition(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self.rejections += 1
+            return False
+
+    def success(self):
+        """
+        Record that a call succeeded
+        """
+        with self._lock:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def failure(self):
+        """
+        Record that a call failed
+        """
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self._trial_in_flight = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.consecutive_failures >= self.threshold):
+                self.opened_at = time.time()
+                self.trips += 1
+                self._transition(OPEN)
+
+    def abandon(self):
+        """
+        Record that a call was abandoned without an outcome which says anything about the health of the service
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def retry_after(self):
+        """
+        :return: whole seconds until the breaker will next allow a trial call, or 0 if it is not open
+        """
+        if self.state != OPEN:
+            return 0
+        return max(1, int(round(self.opened_at + self.reset_timeout - time.time())))
+
+    def stats(self):
+        """
+        Get the state and counters of the breaker
+
+        :return: dict of the state, consecutive failures, retry_after, and the successes, failures, rejections
+            and trips counted since the process started
+        """
+        return {
+            "state" : self.state,
+            "consecutive_failures" : self.consecutive_failures,
+            "retry_after" : self.retry_after(),
+            "successes" : self.successes,
+            "failures" : self.failures,
+            "rejections" : self.rejections,
+            "trips" : self.trips
+        }
+
+    def _transition(self, state):
+        app.logger.warning(u"Circuit breaker %s changed from %s to %s", self.name, self.state, state)
+        self.state = state
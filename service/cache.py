@@ -0,0 +1,479 @@
+"""
+Caching support for the JPER SWORD integration
+
+This provides named caches with per-entry expiry and a bounded size, and a means of coalescing concurrent requests
+for the same uncached item into a single upstream fetch.
+
+Each cache is provided by one of two backends, which have the same interface (get, set, get_or_set, delete, clear,
+stats):
+
+* TTLCache, held in memory and shared between all requests handled by a single process.  This is the fastest,
+  but under gunicorn each worker has its own copy, which it has to warm by itself.
+* SQLiteCache, held in an SQLite database shared by all of the workers on the host, so that an item fetched
+  from JPER by one worker is served from the cache by the others.  Values are pickled; those which cannot be
+  pickled are not cached.
+
+The caches named in SHARED_CACHES use the backend set by CACHE_BACKEND ("memory" or "sqlite"); all others are
+always kept in memory.
+"""
+
+import cPickle, hashlib, sqlite3, sys, threading, time
+from collections import OrderedDict
+
+from octopus.core import app
+from service.store import SQLiteStore
+
+MEMORY = "memory"
+SQLITE = "sqlite"
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(name, maxsize=1000, ttl=60):
+    """
+    Get the named cache, creating it with the given size and default time-to-live on first use, with the backend
+    configured for it
+
+    :param name: name of the cache
+    :param maxsize: maximum number of entries to hold
+    :param ttl: default time-to-live for entries, in seconds
+    :return: the TTLCache or SQLiteCache
+    """
+    c = _caches.get(name)
+    if c is None:
+        with _caches_lock:
+            c = _caches.get(name)
+            if c is None:
+                if backend(name) == SQLITE:
+                    c = SQLiteCache(name, shared_store(), maxsize=maxsize, ttl=ttl)
+                else:
+                    c = TTLCache(maxsize=maxsize, ttl=ttl)
+                _caches[name] = c
+    return c
+
+def backend(name):
+    """
+    Get the backend to use for the named cache, as configured by CACHE_BACKEND and SHARED_CACHES
+
+    :param name: name of the cache
+    :return: MEMORY or SQLITE
+    """
+    if name in app.config.get("SHARED_CACHES", []):
+        return app.config.get("CACHE_BACKEND", MEMORY)
+    return MEMORY
+
+_shared_store = None
+
+def shared_store():
+    """
+    Get the store holding the shared caches, as configured by CACHE_SQLITE_PATH
+
+    :return: the SharedCacheStore
+    """
+    global _shared_store
+    if _shared_store is None:
+        _shared_store = SharedCacheStore(app.config.get("CACHE_SQLITE_PATH"))
+    return _shared_store
+
+def all_stats():
+    """
+    Get the usage counters for all of the process-wide caches
+
+    :return: dict of cache name to the stats for that cache
+    """
+    return dict([(name, c.stats()) for name, c in _caches.items()])
+
+class TTLCache(object):
+    """
+    Thread-safe key/value cache with a maximum size and a time-to-live for each entry.
+
+    When the cache is full, the least recently used entry is evicted to make room for a new one.  Expired
+    entries are removed lazily, when they are next looked up.
+    """
+    def __init__(self, maxsize=1000, ttl=60):
+        """
+        :param maxsize: maximum number of entries to hold before evicting
+        :param ttl: default time-to-live for entries, in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """
+        Get the value stored against the key, if it is present and has not expired
+
+        :param key: the cache key
+        :param default: value to return if there is no live entry for the key
+        :return: the cached value or the default
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires < time.time():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            # move the key to the most recently used end
+            del self._data[key]
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store the value against the key, evicting the least recently used entries if necessary
+
+        :param key: the cache key
+        :param value: the value to store
+        :param ttl: time-to-live for this entry in seconds; the cache default is used if not supplied
+        """
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+            self._data[key] = (value, time.time() + ttl)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key, fn, ttl=None):
+        """
+        Get the value stored against the key, or if there is none, store and return the value given by the
+        function.  If another thread stores a value for the key while the function is running, that value is
+        kept and returned instead.
+
+        :param key: the cache key
+        :param fn: function taking no arguments which gives the value; if it gives None, nothing is stored
+        :param ttl: time-to-live for a new entry in seconds; the cache default is used if not supplied
+        :return: the cached or new value
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = fn()
+        if value is None:
+            return None
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] >= time.time():
+                return entry[0]
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + ttl)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def delete(self, key):
+        """
+        Remove the key from the cache, if it is present
+
+        :param key: the cache key
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries from the cache
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """
+        Get the usage counters for this cache
+
+        :return: dict of size, maxsize, hits, misses, evictions and expirations
+        """
+        with self._lock:
+            return {
+                "size" : len(self._data),
+                "maxsize" : self.maxsize,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "expirations" : self.expirations
+            }
+
+class SharedCacheStore(SQLiteStore):
+    """
+    The database holding all of the shared caches, one row per entry
+    """
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS cache (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value BLOB NOT NULL,
+            expires REAL NOT NULL,
+            stored REAL NOT NULL,
+            PRIMARY KEY (name, key)
+        )""",
+        "CREATE INDEX IF NOT EXISTS cache_expires ON cache (name, expires)",
+        "CREATE INDEX IF NOT EXISTS cache_stored ON cache (name, stored)"
+    ]
+
+class SQLiteCache(object):
+    """
+    Key/value cache with a maximum size and a time-to-live for each entry, kept in a SharedCacheStore so that it is
+    shared by all of the processes on the host.
+
+    Keys are stored as digests, so may contain secrets such as API keys.  Expired entries are ignored when they are
+    looked up, and removed, along with the oldest entries if the cache is over its maximum size, every PRUNE_INTERVAL
+    sets made by each process.  The hit and miss counters are those of this process only.
+    """
+    PRUNE_INTERVAL = 100
+    """number of entries each process stores between removing expired and excess entries"""
+
+    def __init__(self, name, store, maxsize=1000, ttl=60):
+        """
+        :param name: name of the cache, which distinguishes its entries in the store
+        :param store: the SharedCacheStore
+        :param maxsize: maximum number of entries to hold before evicting
+        :param ttl: default time-to-live for entries, in seconds
+        """
+        self.name = name
+        self.store = store
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sets = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """
+        Get the value stored against the key, if it is present and has not expired
+
+        :param key: the cache key
+        :param default: value to return if there is no live entry for the key
+        :return: the cached value or the default
+        """
+        row = self.store.execute("SELECT value FROM cache WHERE name = ? AND key = ? AND expires >= ?",
+                                 (self.name, self._key(key), time.time())).fetchone()
+        value = self._load(key, row)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return default if value is None else value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store the value against the key
+
+        :param key: the cache key
+        :param value: the value to store; values which cannot be pickled are not stored
+        :param ttl: time-to-live for this entry in seconds; the cache default is used if not supplied
+        """
+        if ttl is None:
+            ttl = self.ttl
+        data = self._dump(value)
+        if data is None:
+            return
+        now = time.time()
+        self.store.execute("INSERT OR REPLACE INTO cache (name, key, value, expires, stored) VALUES (?, ?, ?, ?, ?)",
+                           (self.name, self._key(key), data, now + ttl, now))
+        self._stored()
+
+    def get_or_set(self, key, fn, ttl=None):
+        """
+        Get the value stored against the key, or if there is none, store and return the value given by the
+        function.  The function is not run inside a transaction, so workers which miss at the same time may each
+        run it, but the first value stored is the one kept, and returned to all of them.
+
+        :param key: the cache key
+        :param fn: function taking no arguments which gives the value; if it gives None, nothing is stored
+        :param ttl: time-to-live for a new entry in seconds; the cache default is used if not supplied
+        :return: the cached or new value
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = fn()
+        if value is None:
+            return None
+        if ttl is None:
+            ttl = self.ttl
+        data = self._dump(value)
+        if data is None:
+            return value
+
+        k = self._key(key)
+        with self.store.transaction() as conn:
+            now = time.time()
+            row = conn.execute("SELECT value FROM cache WHERE name = ? AND key = ? AND expires >= ?",
+                               (self.name, k, now)).fetchone()
+            existing = self._load(key, row)
+            if existing is None:
+                conn.execute("INSERT OR REPLACE INTO cache (name, key, value, expires, stored) VALUES (?, ?, ?, ?, ?)",
+                             (self.name, k, data, now + ttl, now))
+        if existing is not None:
+            return existing
+        self._stored()
+        return value
+
+    def delete(self, key):
+        """
+        Remove the key from the cache, if it is present
+
+        :param key: the cache key
+        """
+        self.store.execute("DELETE FROM cache WHERE name = ? AND key = ?", (self.name, self._key(key)))
+
+    def clear(self):
+        """
+        Remove all entries from the cache
+        """
+        self.store.execute("DELETE FROM cache WHERE name = ?", (self.name,))
+
+    def __len__(self):
+        return self.store.execute("SELECT COUNT(*) FROM cache WHERE name = ?", (self.name,)).fetchone()[0]
+
+    def stats(self):
+        """
+        Get the usage counters for this cache
+
+        :return: dict of size (across all processes), maxsize, and this process's hits, misses, evictions and
+            expirations
+        """
+        size = len(self)
+        with self._lock:
+            return {
+                "size" : size,
+                "maxsize" : self.maxsize,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "expirations" : self.expirations,
+                "shared" : True
+            }
+
+    def prune(self):
+        """
+        Remove the expired entries, and then the oldest entries until the cache is within its maximum size
+        """
+        with self.store.transaction() as conn:
+            expired = conn.execute("DELETE FROM cache WHERE name = ? AND expires < ?", (self.name, time.time())).rowcount
+            size = conn.execute("SELECT COUNT(*) FROM cache WHERE name = ?", (self.name,)).fetchone()[0]
+            evicted = 0
+            if size > self.maxsize:
+                evicted = conn.execute("""DELETE FROM cache WHERE name = ? AND key IN
+                                          (SELECT key FROM cache WHERE name = ? ORDER BY stored LIMIT ?)""",
+                                       (self.name, self.name, size - self.maxsize)).rowcount
+        with self._lock:
+            self.expirations += expired
+            self.evictions += evicted
+
+    def _stored(self):
+        with self._lock:
+            self._sets += 1
+            due = self._sets % self.PRUNE_INTERVAL == 0
+        if due:
+            self.prune()
+
+    def _key(self, key):
+        return hashlib.sha256(repr(key)).hexdigest()
+
+    def _dump(self, value):
+        try:
+            return sqlite3.Binary(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+        except (cPickle.PicklingError, TypeError):
+            app.logger.warning(u"Not caching unpicklable value in shared Cache:%s", self.name)
+            return None
+
+    def _load(self, key, row):
+        if row is None:
+            return None
+        try:
+            return cPickle.loads(str(row["value"]))
+        except Exception:
+            # e.g. stored by an older version of the code; treat it as missing
+            app.logger.warning(u"Discarding unreadable entry in shared Cache:%s", self.name)
+            self.delete(key)
+            return None
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key, so that only one of them does the work.
+
+    The first thread to ask for a key runs the function, and any other threads which ask for the same key while
+    it is running wait for it to finish and then share its result, or have its exception raised in them too.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, fn):
+        """
+        Run the function for the key, or wait for the run already in progress for that key
+
+        :param key: the key identifying the work
+        :param fn: function taking no arguments which does the work
+        :return: the result of the function
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """
+        Get the usage counters for this instance
+
+        :return: dict of the number of calls which did the work (leaders) and which shared another's (followers)
+        """
+        with self._lock:
+            return {"in_flight" : len(self._calls), "leaders" : self.leaders, "followers" : self.followers}
+
+class _Call(object):
+    """
+    A call in progress in a SingleFlight
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
@@ -0,0 +1,113 @@
+"""
+Negotiated compression of the XML documents served by the SWORD endpoint
+
+Statements, deposit receipts and the service document are verbose XML which compresses to a fraction of its
+size.  compress_response, which is registered as an after_request handler in service.web, compresses them with
+gzip, or with brotli if the brotli package is installed and the client prefers it, when the client's
+Accept-Encoding allows.  Responses of the types which are compressed are marked Vary: Accept-Encoding, whether or
+not this particular one was, so that shared caches keep the variants apart.
+
+Most of these documents are themselves served from a cache (see JperSword._render_cached), so the same body is
+sent many times.  The compressed variant of each body is cached against its ETag (or a digest of the body, if it
+has none), so that each version of a document is compressed once, rather than once per request.  Each variant
+has its own ETag (the document's, with the encoding appended).  Conditional requests are answered with a 304 by
+responses.conditional_response, which service.web runs after this, so that the client's ETag is compared with
+that of the variant it would be sent, and the 304 has the Vary header set here.
+
+Responses which are streamed (collection listings) or sent from a file (packages) are left alone, as are those
+smaller than COMPRESSION_MIN_SIZE, for which the saving is not worth the time.
+"""
+
+import hashlib, zlib
+
+from flask import request
+
+from octopus.core import app
+from service import cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP = "gzip"
+BROTLI = "br"
+
+def compressed_cache():
+    """
+    Get the process-wide cache of compressed variants of response bodies
+
+    :return: the cache of compressed bodies, keyed by the ETag or digest of the uncompressed body and the encoding
+    """
+    return cache.get_cache("compressed",
+                           maxsize=app.config.get("COMPRESSED_CACHE_SIZE", 1000),
+                           ttl=app.config.get("COMPRESSED_CACHE_TTL", 3600))
+
+def compress_response(response):
+    """
+    Compress the response body, if it is of a compressible type and large enough, and the client accepts a
+    compressed encoding
+
+    :param response: the response being sent
+    :return: the response to send
+    """
+    if not app.config.get("COMPRESSION", True):
+        return response
+    if response.status_code not in [200, 201] or response.direct_passthrough or response.is_streamed:
+        return response
+    if response.mimetype not in app.config.get("COMPRESSION_MIMETYPES", []):
+        return response
+    if "Content-Encoding" in response.headers or "Content-Range" in response.headers:
+        return response
+
+    # responses of this type depend on the Accept-Encoding of the request, even if this one is too small to compress
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < app.config.get("COMPRESSION_MIN_SIZE", 1024):
+        return response
+
+    encoding = negotiate()
+    if encoding is None:
+        return response
+
+    etag, weak = response.get_etag()
+    key = (etag or hashlib.sha1(body).hexdigest(), encoding)
+    compressed = compressed_cache().get_or_set(key, lambda: compress(body, encoding))
+    if len(compressed) >= len(body):
+        return response
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    if etag is not None:
+        # the compressed variant is a different representation, so must not share the uncompressed one's ETag
+        response.set_etag(etag + "-" + encoding, weak=weak)
+    return response
+
+def negotiate():
+    """
+    Choose the encoding to compress the current response with, from those the client accepts
+
+    :return: BROTLI, GZIP, or None if the response should not be compressed
+    """
+    accept = request.accept_encodings
+    gzip_q = accept.quality(GZIP)
+    br_q = accept.quality(BROTLI) if brotli is not None and app.config.get("COMPRESSION_BROTLI", True) else 0
+    if br_q > 0 and br_q >= gzip_q:
+        return BROTLI
+    if gzip_q > 0:
+        return GZIP
+    return None
+
+def compress(body, encoding):
+    """
+    Compress a response body
+
+    :param body: the body
+    :param encoding: GZIP or BROTLI
+    :return: the compressed body
+    """
+    if encoding == BROTLI:
+        return brotli.compress(body, quality=app.config.get("COMPRESSION_BROTLI_QUALITY", 5))
+    # a gzip stream with a zero timestamp, so that the same body always compresses to the same bytes
+    c = zlib.compressobj(app.config.get("COMPRESSION_LEVEL", 6), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(body) + c.flush()
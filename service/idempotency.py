@@ -0,0 +1,74 @@
+"""
+Index of recent deposits, used to answer retried notify deposits without creating duplicate notifications
+
+Each deposit to the notify collection is recorded against the account which made it, under the SHA-256 digest of
+its content and under any idempotency key the client supplied.  If the same account sends the same deposit again
+within the deduplication window, the original notification is found here, and the original receipt is returned.
+"""
+
+import time
+from service.store import SQLiteStore
+from service.auth import account_id
+
+class DepositIndex(SQLiteStore):
+    """
+    Persistent index from (account, deposit key) to the notification created by that deposit.  API keys are not
+    stored; accounts are identified by a digest of the key.
+    """
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS deposits (
+            account TEXT NOT NULL,
+            deposit_key TEXT NOT NULL,
+            notification_id TEXT NOT NULL,
+            location TEXT,
+            created REAL NOT NULL,
+            PRIMARY KEY (account, deposit_key)
+        )""",
+        "CREATE INDEX IF NOT EXISTS deposits_created ON deposits (created)"
+    ]
+
+    def __init__(self, path, window=86400, max_entries=100000):
+        """
+        :param path: path to the database file
+        :param window: seconds for which a deposit may be answered from the index
+        :param max_entries: maximum number of entries to keep; the oldest are removed first
+        """
+        super(DepositIndex, self).__init__(path)
+        self.window = window
+        self.max_entries = max_entries
+
+    def lookup(self, api_key, deposit_keys):
+        """
+        Find the notification created by an earlier deposit with any of the given keys, within the window
+
+        :param api_key: the API key the deposit was made with
+        :param deposit_keys: list of keys identifying the deposit
+        :return: tuple of (notification id, location), or None if there was no such deposit
+        """
+        if len(deposit_keys) == 0:
+            return None
+        sql = "SELECT notification_id, location FROM deposits WHERE account = ? AND created > ? AND deposit_key IN ({x}) ORDER BY created DESC LIMIT 1"
+        sql = sql.format(x=", ".join(["?"] * len(deposit_keys)))
+        row = self.execute(sql, [account_id(api_key), time.time() - self.window] + list(deposit_keys)).fetchone()
+        if row is None:
+            return None
+        return row["notification_id"], row["location"]
+
+    def record(self, api_key, deposit_keys, notification_id, location):
+        """
+        Record the notification created by a deposit, under each of the deposit's keys, and remove entries which
+        are out of the window or over the size limit
+
+        :param api_key: the API key the deposit was made with
+        :param deposit_keys: list of keys identifying the deposit
+        :param notification_id: the id of the notification created
+        :param location: the location of the notification created
+        """
+        now = time.time()
+        account = account_id(api_key)
+        with self.transaction() as conn:
+            for k in deposit_keys:
+                conn.execute("INSERT OR REPLACE INTO deposits (account, deposit_key, notification_id, location, created) VALUES (?, ?, ?, ?, ?)",
+                             (account, k, notification_id, location, now))
+            conn.execute("DELETE FROM deposits WHERE created <= ?", (now - self.window,))
+            conn.execute("DELETE FROM deposits WHERE rowid IN (SELECT rowid FROM deposits ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
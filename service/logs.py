@@ -0,0 +1,160 @@
+"""
+Logging support which keeps the cost of logging off the request threads
+
+AsyncStreamHandler is a logging handler which does nothing on the thread making the log call but put the record
+on a bounded queue; a background thread takes records off the queue, formats them and writes them out.  If the
+output (e.g. supervisor's pipe) is slow, request threads are not held up: records queue up, and if the queue
+fills, further records are dropped and counted, rather than blocking.  The handler can also sample the records at
+INFO and below, passing on only a given proportion of them, which cuts the volume of the per-request lines
+while keeping every warning and error.
+
+JSONFormatter writes each record as a single line of JSON, including the id of the request it was logged during.
+assign_request_id is registered as a before_request handler in service.web; it takes the request id from the
+X-Request-Id header if the client (or the front end proxy) sent one, makes one up otherwise, and returns it to
+the client in the response.
+
+These are configured in sss_logging.conf.
+"""
+
+import json, logging, os, random, re, threading, uuid
+import Queue
+
+from flask import g, request, has_request_context
+
+from service import responses
+
+REQUEST_ID_HEADER = "X-Request-Id"
+
+_VALID_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+def assign_request_id():
+    """
+    Give the current request an id, which is attached to everything logged while handling it and returned to
+    the client
+    """
+    rid = request.headers.get(REQUEST_ID_HEADER)
+    if rid is None or not _VALID_REQUEST_ID.match(rid):
+        rid = uuid.uuid4().hex
+    g.request_id = rid
+    responses.header(REQUEST_ID_HEADER, rid)
+
+def request_id():
+    """
+    :return: the id of the current request, or None if there is no current request
+    """
+    if not has_request_context():
+        return None
+    return getattr(g, "request_id", None)
+
+class AsyncStreamHandler(logging.Handler):
+    """
+    Handler which writes records to a stream from a background thread, so that logging never blocks the caller
+    """
+    def __init__(self, stream=None, queue_size=10000, sample_rate=1.0):
+        """
+        :param stream: the stream to write to; stderr if not given
+        :param queue_size: maximum number of records waiting to be written, after which records are dropped
+        :param sample_rate: proportion (0 to 1) of records at INFO and below to write
+        """
+        logging.Handler.__init__(self)
+        self.target = logging.StreamHandler(stream)
+        self.queue_size = queue_size
+        self.sample_rate = sample_rate
+        self.dropped = 0
+        self._queue = None
+        self._writer = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.target.setFormatter(fmt)
+
+    def emit(self, record):
+        """
+        Queue the record to be written, unless it is sampled out or the queue is full
+        """
+        if self.sample_rate < 1 and record.levelno <= logging.INFO and random.random() >= self.sample_rate:
+            return
+
+        # anything which depends on the calling thread must be captured now, rather than by the writer
+        record.request_id = request_id()
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        self.target.flush()
+
+    def close(self):
+        """
+        Stop the writer thread, waiting briefly for it to write the records already queued.  This is called by
+        logging when the process exits.
+        """
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._writer.join(5)
+            self._pid = None
+        self.target.flush()
+        logging.Handler.close(self)
+
+    def _ensure_writer(self):
+        """
+        Start the writer thread for this process, if it is not already running.  Threads do not survive a fork,
+        so each gunicorn worker starts its own.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # if the process was forked while the parent's writer was writing, the lock on the stream was copied
+            # held, and would never be released
+            self.target.createLock()
+            self._queue = Queue.Queue(self.queue_size)
+            self._writer = threading.Thread(target=self._write, args=(self._queue,), name="log-writer")
+            self._writer.daemon = True
+            self._writer.start()
+            self._pid = os.getpid()
+
+    def _write(self, q):
+        """
+        Write the records from the queue until told to stop, reporting any which had to be dropped
+        """
+        while True:
+            record = q.get()
+            if record is None:
+                break
+            if self.dropped > 0:
+                dropped, self.dropped = self.dropped, 0
+                self.target.handle(logging.makeLogRecord({"name" : __name__, "levelno" : logging.WARNING, "levelname" : "WARNING",
+                                                          "msg" : "Dropped %s log records as the log queue was full", "args" : (dropped,)}))
+            self.target.handle(record)
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formatter which writes each record as a single line of JSON
+    """
+    def format(self, record):
+        data = {
+            "time" : self.formatTime(record, self.datefmt),
+            "level" : record.levelname,
+            "logger" : record.name,
+            "message" : record.getMessage(),
+            "request_id" : getattr(record, "request_id", None),
+            "pid" : record.process,
+            "thread" : record.threadName
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data)
+
+_exception_formatter = logging.Formatter()
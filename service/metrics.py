@@ -0,0 +1,162 @@
+"""
+Prometheus metrics for the SWORD endpoint and its use of JPER
+
+This records the number and latency of requests to each SWORD operation, the latency and failures of requests
+to JPER, the number of bytes deposited and forwarded, and the usage of the caches and the state of the JPER
+circuit breaker.  start_timer and record_request are registered as before_request and after_request
+handlers in service.web, and the metrics are served in the Prometheus text format by render, at /metrics.  The
+/metrics route is only registered if METRICS_ENDPOINT is enabled, and if METRICS_TOKEN is set, scrapes must
+present it as a bearer token.
+
+Under gunicorn each worker process keeps its own metrics, so they are recorded with the prometheus_client
+multiprocess support: if the prometheus_multiproc_dir environment variable is set (as it is by the gunicorn
+configurations in deployment/) each worker writes its metrics to its own files in that directory, and render
+adds up the files of all of the workers, whichever worker happens to serve the scrape.  The directory must be
+emptied when gunicorn starts, and the files of each worker that exits marked as dead, which the gunicorn
+configurations also do.  Without the environment variable (e.g. under the flask development server) the
+metrics of the single process are served.
+
+The cache counters are exported as totals rather than ratios, so that they add up across workers; the hit ratio
+of a cache is rate(sword_cache_hits) / (rate(sword_cache_hits) + rate(sword_cache_misses)).
+"""
+
+import hmac, os, time
+
+from flask import g, request
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+from octopus.core import app
+from service import breaker, cache
+
+SWORD_OPERATIONS = {
+    "swordv2_server.service_document" : "service_document",
+    "swordv2_server.entry" : "receipt",
+    "swordv2_server.content" : "media_resource",
+    "swordv2_server.statement" : "statement"
+}
+"""names of the SWORD operations served by each endpoint of the swordv2 blueprint, other than the collections"""
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+REQUESTS = Counter("sword_requests_total", "Requests to the SWORD endpoint", ["operation", "collection", "status"])
+REQUEST_LATENCY = Histogram("sword_request_duration_seconds", "Time taken to answer requests to the SWORD endpoint",
+                            ["operation", "collection"], buckets=LATENCY_BUCKETS)
+DEPOSIT_BYTES = Counter("sword_deposit_bytes_total", "Bytes of content deposited with the SWORD endpoint", ["collection"])
+
+UPSTREAM_LATENCY = Histogram("jper_request_duration_seconds", "Time taken by requests to JPER", ["operation"],
+                             buckets=LATENCY_BUCKETS)
+UPSTREAM_ERRORS = Counter("jper_request_errors_total", "Requests to JPER which failed", ["operation", "reason"])
+UPLOAD_BYTES = Counter("jper_upload_bytes_total", "Bytes of content sent to JPER", ["operation"])
+
+CACHE_HITS = Gauge("sword_cache_hits", "Lookups in the in-process cache which found a live entry", ["cache"], multiprocess_mode="livesum")
+CACHE_MISSES = Gauge("sword_cache_misses", "Lookups in the in-process cache which found no live entry", ["cache"], multiprocess_mode="livesum")
+CACHE_ENTRIES = Gauge("sword_cache_entries", "Entries held in the in-process cache", ["cache"], multiprocess_mode="livesum")
+CACHE_SHARED_ENTRIES = Gauge("sword_shared_cache_entries", "Entries held in the cache shared by all workers on the host", ["cache"], multiprocess_mode="max")
+CACHE_EVICTIONS = Gauge("sword_cache_evictions", "Entries evicted from the in-process cache to make room", ["cache"], multiprocess_mode="livesum")
+BREAKER_OPEN = Gauge("jper_breaker_open", "Number of workers whose circuit breaker for JPER is open", ["breaker"], multiprocess_mode="livesum")
+BREAKER_TRIPS = Gauge("jper_breaker_trips", "Number of times the circuit breaker for JPER has opened", ["breaker"], multiprocess_mode="livesum")
+
+_gauges_updated = 0
+
+def operation():
+    """
+    Identify the SWORD operation requested by the current request
+
+    :return: tuple of the operation name and the collection (or "" if not a request to a collection), or
+        (None, None) if the request is not to the SWORD endpoint
+    """
+    if request.endpoint == "swordv2_server.collection":
+        name = "deposit_new" if request.method == "POST" else "list_collection"
+        return name, request.view_args.get("collection_id", "")
+    name = SWORD_OPERATIONS.get(request.endpoint)
+    if name is None and request.endpoint is not None and request.endpoint.startswith("swordv2_server."):
+        name = request.endpoint[len("swordv2_server."):]
+    if name is not None and request.method != "GET":
+        name = name + "_" + request.method.lower()
+    return name, ("" if name is not None else None)
+
+def start_timer():
+    """
+    Note the time at which the current request started
+    """
+    g.metrics_start = time.time()
+
+def record_request(response):
+    """
+    Record the count and latency of the current request, if it was to the SWORD endpoint
+
+    :param response: the response being sent
+    :return: the response, unchanged
+    """
+    start = getattr(g, "metrics_start", None)
+    name, collection = operation()
+    if start is not None and name is not None:
+        REQUESTS.labels(name, collection, str(response.status_code)).inc()
+        REQUEST_LATENCY.labels(name, collection).observe(time.time() - start)
+        if name == "deposit_new" and request.content_length is not None:
+            DEPOSIT_BYTES.labels(collection).inc(request.content_length)
+    _update_gauges()
+    return response
+
+def upstream_request(operation, duration, error=None):
+    """
+    Record the outcome of a request to JPER
+
+    :param operation: the name of the operation requested
+    :param duration: seconds the request took
+    :param error: the reason the request failed, or None if it succeeded
+    """
+    UPSTREAM_LATENCY.labels(operation or "other").observe(duration)
+    if error is not None:
+        UPSTREAM_ERRORS.labels(operation or "other", error).inc()
+
+def scrape_authorised():
+    """
+    Does the current request to /metrics carry the METRICS_TOKEN, if one is configured?
+
+    :return: True if the metrics may be served
+    """
+    token = app.config.get("METRICS_TOKEN")
+    if not token:
+        return True
+    given = request.headers.get("Authorization", u"")
+    expected = u"Bearer " + token
+    return hmac.compare_digest(given.encode("utf-8"), expected.encode("utf-8"))
+
+def render():
+    """
+    Render the metrics of all of the workers in the Prometheus text format
+
+    :return: flask response tuple
+    """
+    _update_gauges(force=True)
+    registry = REGISTRY
+    if os.environ.get("prometheus_multiproc_dir"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), 200, {"Content-Type" : CONTENT_TYPE_LATEST}
+
+def _update_gauges(force=False):
+    """
+    Copy the usage counters of the caches and circuit breakers of this process into the gauges, at most once a
+    second unless forced, so that they can be added up across the workers
+    """
+    global _gauges_updated
+    now = time.time()
+    if not force and now - _gauges_updated < 1:
+        return
+    _gauges_updated = now
+
+    for name, stats in cache.all_stats().items():
+        CACHE_HITS.labels(name).set(stats.get("hits", 0))
+        CACHE_MISSES.labels(name).set(stats.get("misses", 0))
+        if stats.get("shared"):
+            # every worker sees the whole of a shared cache, so its size must not be added up across them
+            CACHE_SHARED_ENTRIES.labels(name).set(stats.get("size", 0))
+        else:
+            CACHE_ENTRIES.labels(name).set(stats.get("size", 0))
+        CACHE_EVICTIONS.labels(name).set(stats.get("evictions", 0))
+    for name, stats in breaker.all_stats().items():
+        BREAKER_OPEN.labels(name).set(1 if stats["state"] == breaker.OPEN else 0)
+        BREAKER_TRIPS.labels(name).set(stats["trips"])
@@ -0,0 +1,247 @@
+"""
+Size-bounded on-disk cache of notification packages retrieved from JPER
+
+When MEDIA_RESOURCE_PROXY is enabled, requests for a notification's media resource are answered with the package
+itself, rather than with a redirect to it in JPER.  The package is downloaded from JPER into this cache the first
+time it is requested, and served from the cache from then on, so repeated harvests of the same package do not go
+to JPER at all.  Packages do not change once created, so cached copies are never revalidated with JPER; they are
+only removed, least recently used first, to keep the cache within PACKAGE_CACHE_MAX_BYTES.
+
+Each package is downloaded to a temporary file, and only entered in the cache if the number of bytes received
+matches the Content-Length JPER sent.  Before a cached package is served, its size on disk is checked against the
+size recorded for it, and it is discarded if they differ.  The ETag JPER sent with the package (or one derived
+from its url and size, if there was none) is served with it.
+
+The index of the cache is kept in an SQLite database, shared by all of the workers on the host.
+
+A package is only served from the cache to the accounts which JPER has allowed to retrieve it.  The index records
+each account (by a digest of its API key) for which JPER answered a request for the package successfully, either
+by sending the package when it was downloaded, or by answering a check of access made when an account first asks
+for a package someone else has already cached.  An account's access is checked with JPER again once it is older
+than PACKAGE_ACCESS_TTL, so that access JPER has since withdrawn is noticed.
+"""
+
+import hashlib, os, time, uuid
+
+from octopus.core import app
+from octopus.modules.jper import client
+from service import cache
+from service.auth import account_id
+from service.store import SQLiteStore
+
+class PackageCache(SQLiteStore):
+    """
+    The package directory and its index
+    """
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS packages (
+            key TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            etag TEXT NOT NULL,
+            content_type TEXT,
+            created REAL NOT NULL,
+            last_access REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS packages_access ON packages (last_access)",
+        """CREATE TABLE IF NOT EXISTS package_access (
+            key TEXT NOT NULL,
+            account TEXT NOT NULL,
+            granted REAL NOT NULL,
+            PRIMARY KEY (key, account)
+        )"""
+    ]
+
+    TOUCH_INTERVAL = 60
+    """seconds within which repeated accesses to a package are not recorded again, to save writes to the index"""
+
+    def __init__(self, directory, index, max_bytes, access_ttl=86400):
+        """
+        :param directory: directory to keep the packages in
+        :param index: path to the index database
+        :param max_bytes: maximum total size of the packages to keep
+        :param access_ttl: seconds for which JPER's answer that an account may retrieve a package is relied on
+        """
+        super(PackageCache, self).__init__(index)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.access_ttl = access_ttl
+        self._fetches = cache.SingleFlight()
+
+    def get(self, url):
+        """
+        Get the cache entry for a package, if it is cached and intact
+
+        :param url: the url of the package in JPER
+        :return: the entry as a dict, including the path to the package, or None if it is not cached
+        """
+        key = self.key(url)
+        row = self.execute("SELECT * FROM packages WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        entry = dict(row)
+        entry["path"] = self.content_path(key)
+        try:
+            size = os.path.getsize(entry["path"])
+        except OSError:
+            size = None
+        if size != entry["size"]:
+            app.logger.info(u"Discarding cached Package:%s as its size on disk does not match", url)
+            self._remove(key)
+            return None
+
+        now = time.time()
+        if now - entry["last_access"] > self.TOUCH_INTERVAL:
+            self.execute("UPDATE packages SET last_access = ? WHERE key = ?", (now, key))
+        return entry
+
+    def fetch(self, url, jper):
+        """
+        Get the cache entry for a package on behalf of the account of the JPER client, downloading it from JPER if
+        it is not cached.  A cached package is only returned if JPER has allowed the account to retrieve it; if
+        that is not yet known, JPER is asked.  Concurrent requests in this process for the same package from the
+        same account share a single download or check.
+
+        :param url: the url of the package in JPER
+        :param jper: the JPER client to download it with, holding the API key of the account asking for it
+        :return: the entry as a dict, or None if JPER has no such package, or will not let the account have it
+        """
+        account = account_id(jper.api_key)
+        entry = self.get(url)
+        if entry is not None and self.allowed(entry["key"], account):
+            return entry
+        return self._fetches.do((url, account), lambda: self._fetch(url, jper, account))
+
+    def allowed(self, key, account):
+        """
+        Has JPER allowed the account to retrieve the package, recently enough to be relied on?
+
+        :param key: the key of the package
+        :param account: the account identifier, from service.auth.account_id
+        :return: True if the account may be sent the cached package
+        """
+        row = self.execute("SELECT granted FROM package_access WHERE key = ? AND account = ?", (key, account)).fetchone()
+        return row is not None and row["granted"] > time.time() - self.access_ttl
+
+    def _fetch(self, url, jper, account):
+        """
+        Download a package which is not cached, or check with JPER that the account may retrieve one which is,
+        and record that the account may have it
+        """
+        entry = self.get(url)
+        if entry is None:
+            entry = self._download(url, jper)
+        elif not jper.content_accessible(url):
+            app.logger.info(u"JPER does not allow Account:%s to retrieve cached Package:%s", account, url)
+            self.execute("DELETE FROM package_access WHERE key = ? AND account = ?", (entry["key"], account))
+            return None
+        if entry is not None:
+            self.execute("INSERT OR REPLACE INTO package_access (key, account, granted) VALUES (?, ?, ?)",
+                         (entry["key"], account, time.time()))
+        return entry
+
+    def key(self, url):
+        return hashlib.sha256(url.encode("utf-8") if isinstance(url, unicode) else url).hexdigest()
+
+    def content_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _download(self, url, jper):
+        """
+        Download a package into the cache, and evict the least recently used packages to make room for it
+        """
+        resp = jper.get_content(url)
+        if resp is None:
+            return None
+
+        key = self.key(url)
+        path = self.content_path(key)
+        d = os.path.dirname(path)
+        if not os.path.exists(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                pass
+
+        tmp = path + "." + uuid.uuid4().hex + ".part"
+        size = 0
+        try:
+            with open(tmp, "wb") as out:
+                for chunk in resp.iter_content(app.config.get("JPER_UPLOAD_CHUNK_SIZE", 1048576)):
+                    out.write(chunk)
+                    size += len(chunk)
+            expected = resp.headers.get("Content-Length")
+            if expected is not None and int(expected) != size:
+                raise client.JPERException(u"Received {x} bytes of Package:{y}, expected {z}".format(x=size, y=url, z=expected))
+            os.rename(tmp, path)
+        finally:
+            resp.close()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        etag = resp.headers.get("ETag")
+        if etag is not None:
+            etag = etag.strip()
+            if etag.startswith("W/"):
+                etag = etag[2:]
+            etag = etag.strip('"')
+        else:
+            etag = key[:32] + "-" + str(size)
+
+        now = time.time()
+        self.execute("INSERT OR REPLACE INTO packages (key, url, size, etag, content_type, created, last_access) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (key, url, size, etag, resp.headers.get("Content-Type"), now, now))
+        app.logger.info(u"Cached Package:%s (%s bytes)", url, size)
+        self._evict(keep=key)
+        return self.get(url)
+
+    def _evict(self, keep=None):
+        """
+        Remove the least recently used packages until the cache is within its size limit
+
+        :param keep: key of a package not to remove, even if it is larger than the limit by itself
+        """
+        with self.transaction() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM packages").fetchone()[0]
+            evicted = []
+            if total > self.max_bytes:
+                for row in conn.execute("SELECT key, size FROM packages WHERE key != ? ORDER BY last_access", (keep,)):
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append(row["key"])
+                    total -= row["size"]
+                for key in evicted:
+                    conn.execute("DELETE FROM packages WHERE key = ?", (key,))
+                    conn.execute("DELETE FROM package_access WHERE key = ?", (key,))
+        for key in evicted:
+            self._remove_content(key)
+
+    def _remove(self, key):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM packages WHERE key = ?", (key,))
+            conn.execute("DELETE FROM package_access WHERE key = ?", (key,))
+        self._remove_content(key)
+
+    def _remove_content(self, key):
+        # a worker may still be sending the file, but it keeps its open handle to it after it is removed
+        try:
+            os.remove(self.content_path(key))
+        except OSError:
+            pass
+
+_package_cache = None
+
+def get_package_cache():
+    """
+    Get the package cache, as configured by PACKAGE_CACHE_DIR, PACKAGE_CACHE_INDEX_PATH, PACKAGE_CACHE_MAX_BYTES
+    and PACKAGE_ACCESS_TTL
+
+    :return: the PackageCache
+    """
+    global _package_cache
+    if _package_cache is None:
+        _package_cache = PackageCache(app.config.get("PACKAGE_CACHE_DIR"), app.config.get("PACKAGE_CACHE_INDEX_PATH"),
+                                      app.config.get("PACKAGE_CACHE_MAX_BYTES", 10737418240),
+                                      app.config.get("PACKAGE_ACCESS_TTL", 86400))
+    return _package_cache
@@ -0,0 +1,318 @@
+"""
+Request-level handling of SWORD requests, before the swordv2 blueprint sees them
+
+reject_early refuses deposits which are certain to fail before their body has been read: those to a collection
+which does not exist and, if JPER_VERIFY_CREDENTIALS is enabled, those with an API key which JPER does not accept.
+It is registered as a before_request handler in service.web, and saves the worker from forwarding the body to JPER.
+It does not save the client from sending the body: gunicorn answers "Expect: 100-continue" as soon as it has read
+the headers, before the application sees the request.  So a refused body is read and discarded, up to
+EARLY_REJECT_DRAIN_LIMIT bytes, before the response is sent, and the connection is only closed if it is larger.
+
+Normally the swordv2 blueprint receives the whole of a deposit into its temporary directory before handing it to
+JperSword.deposit_new, which then reads it all over again to send it to JPER.  When DEPOSIT_STREAMING is enabled,
+stream_deposit, which is registered as a before_request handler in service.web, takes over POSTs to the
+collections, and hands the body of the incoming request straight to deposit_new, so that it is forwarded to JPER
+as it arrives.  Memory and disk use then stay flat, whatever the size of the package.
+
+When DEPOSIT_BUFFERING is enabled instead, stream_deposit takes over the same POSTs, but receives the body itself
+with service.uploads: into memory if it is small, and into a temporary file otherwise, in large blocks rather than
+the blueprint's small ones.  Unlike a streamed deposit, it can then be checked locally and deduplicated before it
+is sent to JPER.
+
+Since the deposit never reaches the blueprint, its checks on the deposit (such as Content-MD5) are not applied.
+
+When MEDIA_RESOURCE_PROXY is enabled, proxy_media_resource, which is also registered as a before_request handler,
+takes over requests for media resources, and answers them with the package itself from the local package cache
+(see service.packages), rather than letting the blueprint redirect the client to JPER.  The package is sent with
+flask.send_file, which under gunicorn is sent with sendfile where the platform supports it, and Range and
+conditional requests are supported.
+
+stream_collection, also a before_request handler, answers requests to list a collection with the Atom feed from
+JperSword.iter_collection, sent as it is serialised rather than built up in memory first.
+
+upstream_unavailable is registered as the error handler for upstream.JPERUnavailableException, so that any request
+which needs JPER while its circuit breaker is open is answered with a SWORD error and a 503 Service Unavailable.
+It also handles client.JPERConnectionException, so that a request for which every attempt to reach JPER failed,
+with a connection error or a 5xx response, is answered in the same way, rather than with a 500.
+"""
+
+from flask import request, make_response, send_file, Response, stream_with_context
+
+from sss.config import Configuration
+from sss.core import DepositRequest, SwordError
+from sss.spec import Errors
+
+from octopus.core import app
+from service.sword import JperSword, JperAuthenticator, DEPOSIT_COLLECTIONS
+from service import auth, uploads, upstream
+
+UNAVAILABLE_ERROR_URI = "https://www.oa-deepgreen.de/sword/error/unavailable"
+"""SWORD error uri for requests refused because JPER is unavailable"""
+
+def reject_early():
+    """
+    Refuse a deposit to one of the collections if it is certain to fail, without reading its body
+
+    :return: the error response, or None to let the request continue
+    """
+    if request.method != "POST" or request.endpoint != "swordv2_server.collection":
+        return None
+
+    collection = request.view_args.get("collection_id")
+    if collection not in DEPOSIT_COLLECTIONS:
+        app.logger.debug(u"Refusing deposit to unknown Collection:%s before reading it", collection)
+        return _early_response(404)
+
+    if app.config.get("JPER_VERIFY_CREDENTIALS", False):
+        creds = request.authorization
+        if creds is None or not auth.credentials_valid(creds.password):
+            app.logger.debug(u"Refusing deposit with invalid credentials before reading it")
+            resp = _early_response(401)
+            resp.headers["WWW-Authenticate"] = 'Basic realm="SWORD"'
+            return resp
+
+    return None
+
+def _early_response(status):
+    """
+    Make an empty response to a request whose body has not been read.  The body is read and discarded first, up
+    to EARLY_REJECT_DRAIN_LIMIT bytes, so that a client still sending it is not cut off before it sees the
+    response.  If the body is larger than that, or can't be read, the connection is closed afterwards instead, so
+    that the server does not try to read the rest of the body as the next request.
+
+    :param status: the HTTP status
+    :return: the flask response
+    """
+    resp = make_response("", status)
+    if not _drain_body(app.config.get("EARLY_REJECT_DRAIN_LIMIT", 1048576)):
+        resp.headers["Connection"] = "close"
+    return resp
+
+def _drain_body(limit, block_size=65536):
+    """
+    Read and discard the body of the request, if it is no larger than limit
+
+    :param limit: the most bytes to read
+    :param block_size: the number of bytes to read at a time
+    :return: True if the whole body was read, False if some of it may remain unread
+    """
+    length = request.content_length
+    if length is None:
+        # without a Content-Length, the body can only be read to its end if the server has marked it as terminated
+        if not request.environ.get("wsgi.input_terminated", False):
+            return False
+    elif length > limit:
+        return False
+
+    stream = request.stream
+    read = 0
+    while read <= limit:
+        data = stream.read(block_size)
+        if not data:
+            return True
+        read += len(data)
+    return False
+
+def stream_deposit():
+    """
+    Handle a deposit to one of the collections by streaming it to JPER, if DEPOSIT_STREAMING is enabled, or by
+    receiving it with service.uploads, if DEPOSIT_BUFFERING is enabled
+
+    :return: the response to the deposit, or None to let the swordv2 blueprint handle the request
+    """
+    streaming = app.config.get("DEPOSIT_STREAMING", False)
+    if not streaming and not app.config.get("DEPOSIT_BUFFERING", False):
+        return None
+    if request.method != "POST" or request.endpoint != "swordv2_server.collection":
+        return None
+
+    collection = request.view_args.get("collection_id")
+    if streaming:
+        app.logger.info(u"Streaming deposit to Collection:%s through to JPER", collection)
+    else:
+        app.logger.info(u"Receiving deposit to Collection:%s", collection)
+
+    creds = request.authorization
+    if creds is None:
+        resp = make_response("", 401)
+        resp.headers["WWW-Authenticate"] = 'Basic realm="SWORD"'
+        return resp
+
+    # without a Content-Length, the body can only be read if the server marks it as terminated (as gunicorn does
+    # for chunked requests); otherwise it would be read as empty
+    if request.content_length is None and not request.environ.get("wsgi.input_terminated", False):
+        app.logger.debug(u"Refusing deposit with no Content-Length, whose body can't be read")
+        return _early_response(411)
+
+    config = Configuration(config_obj=app.config.get("SWORDV2_SERVER_CONFIG"))
+    max_size = app.config.get("DEPOSIT_STREAMING_MAX_UPLOAD_SIZE")
+    received = None
+    try:
+        if max_size is not None and request.content_length is not None and request.content_length > max_size:
+            raise SwordError(error_uri=Errors.max_upload_size_exceeded, status=413,
+                             msg=u"Deposits may be at most {x} bytes".format(x=max_size))
+
+        auth = JperAuthenticator(config).basic_authenticate(creds.username, creds.password, request.headers.get("On-Behalf-Of"))
+
+        deposit = DepositRequest()
+        deposit.auth = auth
+        deposit.packaging = request.headers.get("Packaging")
+        deposit.content_type = request.headers.get("Content-Type")
+        if streaming:
+            if request.content_length is not None:
+                deposit.content_file = upstream.SizedStream(request.stream, request.content_length)
+            elif max_size is not None:
+                # the size of a chunked body is only known once it has been read, so count it as it is forwarded
+                deposit.content_file = uploads.CappedStream(request.stream, max_size)
+            else:
+                deposit.content_file = request.stream
+        else:
+            received = _receive_body(max_size)
+            deposit.content_file = received
+
+        dr = JperSword(config, auth).deposit_new(collection, deposit)
+    except uploads.UploadTooLargeException as e:
+        app.logger.info(u"Refused deposit to Collection:%s: %s", collection, e.message)
+        return _error_response(SwordError(error_uri=Errors.max_upload_size_exceeded, status=413, msg=e.message))
+    except SwordError as e:
+        return _error_response(e)
+    finally:
+        # a body received to a temporary file is removed when it is closed
+        if received is not None:
+            received.close()
+
+    return _deposit_response(dr)
+
+def _receive_body(max_size):
+    """
+    Receive the body of the current request, into memory or into a temporary file depending on its size
+
+    :param max_size: largest body to accept, or None for no limit
+    :return: seekable file-like object holding the body
+    :raises uploads.UploadTooLargeException: if the body is larger than max_size
+    """
+    return uploads.receive(request.stream, request.content_length,
+                           threshold=app.config.get("DEPOSIT_BUFFER_MEMORY_THRESHOLD", 8388608),
+                           buffer_size=app.config.get("DEPOSIT_BUFFER_BLOCK_SIZE", 1048576),
+                           directory=app.config.get("DEPOSIT_BUFFER_DIR"),
+                           max_size=max_size)
+
+def stream_collection():
+    """
+    Answer a request to list a collection with a streamed Atom feed
+
+    :return: the response, or None to let the swordv2 blueprint handle the request
+    """
+    if request.method != "GET" or request.endpoint != "swordv2_server.collection":
+        return None
+
+    creds = request.authorization
+    if creds is None:
+        resp = make_response("", 401)
+        resp.headers["WWW-Authenticate"] = 'Basic realm="SWORD"'
+        return resp
+
+    config = Configuration(config_obj=app.config.get("SWORDV2_SERVER_CONFIG"))
+    try:
+        auth = JperAuthenticator(config).basic_authenticate(creds.username, creds.password, request.headers.get("On-Behalf-Of"))
+        feed = JperSword(config, auth).iter_collection(request.view_args.get("collection_id"))
+    except SwordError as e:
+        return _error_response(e)
+
+    return Response(stream_with_context(feed), content_type="application/atom+xml;type=feed")
+
+def proxy_media_resource():
+    """
+    Answer a request for a media resource with the package itself, if MEDIA_RESOURCE_PROXY is enabled
+
+    :return: the response, or None to let the swordv2 blueprint handle the request
+    """
+    if not app.config.get("MEDIA_RESOURCE_PROXY", False):
+        return None
+    if request.method not in ["GET", "HEAD"] or request.endpoint != "swordv2_server.content":
+        return None
+
+    creds = request.authorization
+    if creds is None:
+        resp = make_response("", 401)
+        resp.headers["WWW-Authenticate"] = 'Basic realm="SWORD"'
+        return resp
+
+    config = Configuration(config_obj=app.config.get("SWORDV2_SERVER_CONFIG"))
+    try:
+        auth = JperAuthenticator(config).basic_authenticate(creds.username, creds.password, request.headers.get("On-Behalf-Of"))
+        entry = JperSword(config, auth).get_package(request.view_args.get("entry_id"))
+    except SwordError as e:
+        return _error_response(e)
+
+    return _package_response(entry)
+
+def _package_response(entry):
+    """
+    Send a cached package, honouring Range, If-None-Match and If-Modified-Since
+
+    :param entry: the package cache entry
+    :return: the flask response
+    """
+    resp = send_file(entry["path"], mimetype=entry["content_type"] or "application/zip", conditional=False, add_etags=False)
+    resp.headers["Content-Length"] = str(entry["size"])
+    resp.set_etag(entry["etag"])
+    resp.last_modified = int(entry["created"])
+    return resp.make_conditional(request, accept_ranges=True, complete_length=entry["size"])
+
+def upstream_unavailable(e):
+    """
+    Answer a request which could not be served because JPER is unavailable, telling the client when to try again.
+    This is the case both when the circuit breaker refused to send the request to JPER (a JPERUnavailableException),
+    and when it was sent but every attempt failed, with a connection error or a 5xx response (a
+    JPERConnectionException); in the latter case the client is told to try again once the breaker would next let a
+    request through, if it is now open.
+
+    :param e: the JPERUnavailableException or JPERConnectionException
+    :return: the flask response
+    """
+    if isinstance(e, upstream.JPERUnavailableException):
+        app.logger.info(u"Refusing request to %s as JPER is unavailable", request.path)
+        retry_after = e.retry_after
+    else:
+        app.logger.warning(u"Failed to communicate with JPER for request to %s: %s", request.path, e)
+        retry_after = upstream.jper_breaker().retry_after()
+    resp = _error_response(SwordError(status=503, error_uri=UNAVAILABLE_ERROR_URI, author="DeepGreen",
+                                      msg=u"The DeepGreen router is temporarily unavailable, please try again later",
+                                      treatment="request refused"))
+    resp.headers["Retry-After"] = str(max(1, retry_after or 0))
+    return resp
+
+def _deposit_response(dr):
+    """
+    Convert a DepositResponse into an HTTP response, as the swordv2 blueprint would
+
+    :param dr: the DepositResponse
+    :return: the flask response
+    """
+    status = 200
+    if dr.created:
+        status = 201
+    elif dr.accepted:
+        status = 202
+
+    resp = make_response(dr.receipt if dr.receipt is not None else "", status)
+    if dr.receipt is not None:
+        resp.headers["Content-Type"] = "application/atom+xml;type=entry"
+    if dr.location is not None:
+        resp.headers["Location"] = dr.location
+    return resp
+
+def _error_response(e):
+    """
+    Convert a SwordError into an HTTP response, as the swordv2 blueprint would
+
+    :param e: the SwordError
+    :return: the flask response
+    """
+    status = e.status if e.status is not None else 400
+    if e.empty:
+        return make_response("", status)
+    resp = make_response(e.error_document, status)
+    resp.headers["Content-Type"] = "text/xml"
+    return resp
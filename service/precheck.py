@@ -0,0 +1,82 @@
+"""
+Local checks on deposited packages, made before they are sent to JPER
+
+These catch packages which JPER would certainly reject - those which are not zip files at all, or which do not
+contain a JATS XML file - without uploading them.  Only the zip central directory and the root elements of the
+XML files in the package are read.
+"""
+
+import hashlib, zipfile, zlib
+from lxml import etree
+
+def seekable(file_handle):
+    """
+    Can the file be read more than once?  The checks here need to rewind the file after reading it.
+
+    :param file_handle: the file-like object
+    :return: True if the file can be rewound
+    """
+    try:
+        file_handle.seek(0, 1)
+        return True
+    except (AttributeError, IOError, ValueError):
+        return False
+
+def content_digest(file_handle, chunk_size=1048576):
+    """
+    Calculate the SHA-256 digest of the remaining content of the file, and then rewind it to where it was
+
+    :param file_handle: the seekable file-like object
+    :param chunk_size: size of the chunks to read the file in
+    :return: the hex digest
+    """
+    start = file_handle.tell()
+    h = hashlib.sha256()
+    while True:
+        chunk = file_handle.read(chunk_size)
+        if not chunk:
+            break
+        h.update(chunk)
+    file_handle.seek(start)
+    return h.hexdigest()
+
+def check_package(file_handle):
+    """
+    Check that the package is a readable zip file which contains a JATS XML file, and then rewind the file to
+    where it was
+
+    :param file_handle: the seekable file-like object holding the package
+    :return: None if the package passes the checks, or a message explaining the problem if not
+    """
+    start = file_handle.tell()
+    try:
+        try:
+            z = zipfile.ZipFile(file_handle)
+        except (zipfile.BadZipfile, zipfile.LargeZipFile):
+            return u"Package is not a valid zip file"
+
+        xml_files = [n for n in z.namelist() if n.lower().endswith(".xml")]
+        if len(xml_files) == 0:
+            return u"Package does not contain any XML files, so has no JATS metadata"
+
+        for name in xml_files:
+            if _root_element(z, name) == "article":
+                return None
+        return u"Package does not contain a JATS XML file (an XML file whose root element is <article>)"
+    finally:
+        file_handle.seek(start)
+
+def _root_element(z, name):
+    """
+    Get the local name of the root element of an XML file in a zip, reading only as far as that element
+
+    :param z: the ZipFile
+    :param name: the name of the XML file in the zip
+    :return: the local name of the root element, or None if the file cannot be parsed
+    """
+    try:
+        for event, element in etree.iterparse(z.open(name), events=("start",), resolve_entities=False, no_network=True):
+            return etree.QName(element).localname
+    except (etree.XMLSyntaxError, zipfile.BadZipfile, zlib.error, IOError, RuntimeError):
+        return None
+    return None
@@ -0,0 +1,71 @@
+"""
+Response header support for the SWORD endpoints
+
+The HTTP responses for the SwordServer implementation are built by the swordv2 blueprint, so JperSword has no
+direct access to them.  Instead it records the headers it would like on the response using the functions here,
+and apply_headers, which is registered as an after_request handler in service.web, adds them to the response
+on the way out.
+
+Answering conditional requests with a 304 is left to conditional_response, a separate after_request handler
+which service.web runs after the response has been compressed (see service.compression), so that the client's
+ETag is compared with that of the variant it would be sent, and the 304 carries the same Vary header as that
+variant would.
+"""
+
+from flask import g, request
+
+def conditional(etag=None, last_modified=None):
+    """
+    Mark the current response as cacheable by the client, so that it can be revalidated with If-None-Match
+    and If-Modified-Since, and answered with a 304 if it has not changed
+
+    :param etag: strong entity tag for the response body
+    :param last_modified: datetime at which the resource last changed
+    """
+    g.sword_etag = etag
+    g.sword_last_modified = last_modified
+
+def header(name, value):
+    """
+    Add a header to the current response
+
+    :param name: header name
+    :param value: header value
+    """
+    if not hasattr(g, "sword_headers"):
+        g.sword_headers = {}
+    g.sword_headers[name] = value
+
+def apply_headers(response):
+    """
+    Add any headers recorded during the request to the response, including its ETag and Last-Modified if it
+    is conditional
+
+    :param response: the response being sent
+    :return: the response to send
+    """
+    for name, value in getattr(g, "sword_headers", {}).iteritems():
+        response.headers[name] = value
+
+    etag = getattr(g, "sword_etag", None)
+    last_modified = getattr(g, "sword_last_modified", None)
+    if response.status_code == 200:
+        if etag is not None:
+            response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+    return response
+
+def conditional_response(response):
+    """
+    Turn the response into a 304 Not Modified if it is conditional and the client already has the current
+    version.  This must run after anything which changes the body or ETag of the response.
+
+    :param response: the response being sent
+    :return: the response to send
+    """
+    if response.status_code != 200:
+        return response
+    if getattr(g, "sword_etag", None) is None and getattr(g, "sword_last_modified", None) is None:
+        return response
+    return response.make_conditional(request)
@@ -0,0 +1,53 @@
+"""
+Benchmark the per-request latency of retrieving notifications from JPER, with the original octopus client
+(a new connection for every call) and with the pooled client from service.upstream.
+
+This runs against the local stand-in JPER in fakejper.py, so it needs no network access.  Over plain HTTP on
+localhost it measures only the TCP setup saving; against a real JPER over TLS the difference is larger.
+
+::
+
+    python bench_jper_client.py -n 500 -l 0.005
+"""
+
+import time
+
+from octopus.core import app, initialise
+from octopus.modules.jper import client
+from service import upstream
+
+from fakejper import FakeJPER
+
+def run(make_client, n):
+    timings = []
+    for i in range(n):
+        start = time.time()
+        make_client().get_notification(notification_id="bench" + str(i % 10))
+        timings.append(time.time() - start)
+    return timings
+
+def report(name, timings):
+    timings = sorted(timings)
+    mean = sum(timings) / len(timings)
+    p50 = timings[int(len(timings) * 0.5)]
+    p95 = timings[int(len(timings) * 0.95)]
+    print "{n:<10} mean {m:8.3f}ms   p50 {a:8.3f}ms   p95 {b:8.3f}ms".format(n=name, m=mean * 1000, a=p50 * 1000, b=p95 * 1000)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=200, help="number of requests to make with each client")
+    parser.add_argument("-l", "--latency", type=float, default=0.0, help="latency of the fake JPER, in seconds")
+    args = parser.parse_args()
+
+    initialise()
+    server = FakeJPER(latency=args.latency).start()
+    app.config["JPER_BASE_URL"] = server.base_url()
+
+    # warm up both code paths before timing them
+    run(lambda: client.JPER(api_key="bench", base_url=server.base_url()), 5)
+    run(lambda: upstream.get_client("bench"), 5)
+
+    report("unpooled", run(lambda: client.JPER(api_key="bench", base_url=server.base_url()), args.number))
+    report("pooled", run(lambda: upstream.get_client("bench"), args.number))
+    server.shutdown()
@@ -0,0 +1,97 @@
+"""
+Benchmark the cost to a request thread of the logging done while handling a request
+
+Each simulated request makes the mix of log calls a typical JperSword request makes: several at DEBUG (disabled,
+with the logger at INFO) and a couple at INFO.  This is timed with the calls formatted eagerly with
+u"...".format() and written by a synchronous StreamHandler, as they used to be, and with lazy %-style calls
+written through service.logs.AsyncStreamHandler, with text and JSON output.
+
+The output goes to a stream which can be made slow (-w), to simulate a supervisor pipe applying backpressure.
+
+::
+
+    python bench_logging.py -n 20000 -w 0.0001
+"""
+
+import logging, os, time
+
+from service import logs
+
+class SlowStream(object):
+    """
+    Stream which discards what is written to it, after a delay
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.out = open(os.devnull, "w")
+
+    def write(self, data):
+        if self.delay > 0:
+            time.sleep(self.delay)
+        self.out.write(data)
+
+    def flush(self):
+        self.out.flush()
+
+def eager_request(logger, i):
+    nid = "notification" + str(i)
+    logger.debug(u"Request received for Basic Auth on Username:{x} - credentials to be forwarded to JPER, not checked here".format(x="bench"))
+    logger.info(u"Received request for Statement for Notification:{x} in Mimetype:{y}".format(x=nid, y="application/atom+xml;type=feed"))
+    logger.debug(u"Notification:{x} recently found not to exist, not requesting it again".format(x=nid))
+    logger.debug(u"Returning ATOM Feed Statement for Notification:{x}".format(x=nid))
+    logger.info(u"Sent {x} bytes of content to JPER in {y:.3f}s ({z:.0f} bytes/sec)".format(x=1048576, y=0.25, z=1048576 / 0.25))
+
+def lazy_request(logger, i):
+    nid = "notification" + str(i)
+    logger.debug(u"Request received for Basic Auth on Username:%s - credentials to be forwarded to JPER, not checked here", "bench")
+    logger.info(u"Received request for Statement for Notification:%s in Mimetype:%s", nid, "application/atom+xml;type=feed")
+    logger.debug(u"Notification:%s recently found not to exist, not requesting it again", nid)
+    logger.debug(u"Returning ATOM Feed Statement for Notification:%s", nid)
+    logger.info(u"Sent %s bytes of content to JPER in %.3fs (%.0f bytes/sec)", 1048576, 0.25, 1048576 / 0.25)
+
+def run(name, handler, request, n):
+    logger = logging.getLogger("bench." + name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    start = time.time()
+    for i in range(n):
+        request(logger, i)
+    elapsed = time.time() - start
+
+    # wait for any queued records to be written, outside of the timing
+    handler.close()
+    logger.removeHandler(handler)
+    print "{n:<20} {t:8.2f}us per request".format(n=name, t=elapsed / n * 1000000)
+
+def text_formatter():
+    return logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=20000, help="number of requests to simulate")
+    parser.add_argument("-w", "--write-delay", type=float, default=0.0, help="seconds each write to the output takes")
+    parser.add_argument("-s", "--sample-rate", type=float, default=0.1, help="sample rate for the sampled run")
+    args = parser.parse_args()
+
+    h = logging.StreamHandler(SlowStream(args.write_delay))
+    h.setFormatter(text_formatter())
+    run("eager, sync", h, eager_request, args.number)
+
+    h = logging.StreamHandler(SlowStream(args.write_delay))
+    h.setFormatter(text_formatter())
+    run("lazy, sync", h, lazy_request, args.number)
+
+    h = logs.AsyncStreamHandler(SlowStream(args.write_delay), queue_size=args.number * 2)
+    h.setFormatter(text_formatter())
+    run("lazy, async", h, lazy_request, args.number)
+
+    h = logs.AsyncStreamHandler(SlowStream(args.write_delay), queue_size=args.number * 2)
+    h.setFormatter(logs.JSONFormatter())
+    run("lazy, async, json", h, lazy_request, args.number)
+
+    h = logs.AsyncStreamHandler(SlowStream(args.write_delay), queue_size=args.number * 2, sample_rate=args.sample_rate)
+    h.setFormatter(logs.JSONFormatter())
+    run("lazy, async, sampled", h, lazy_request, args.number)
@@ -0,0 +1,51 @@
+"""
+Micro-benchmark of deposit receipt construction, with urls built by a url_for call per url (as URIManager used to
+do) and with URIManager's precompiled url templates.
+
+::
+
+    python bench_receipts.py -n 10000
+"""
+
+import time
+from flask import url_for
+
+from service.web import app
+from service.sword import JperSword, JperAuth, URIManager
+from sss.config import Configuration
+
+class UrlForURIManager(URIManager):
+    """
+    URIManager which resolves every url with url_for, for comparison
+    """
+    def _uri(self, endpoint, id_arg=None, id=None, **kwargs):
+        if id_arg is not None:
+            kwargs[id_arg] = id
+        return self.configuration.base_url[:-1] + url_for(endpoint, **kwargs)
+
+def bench(sword, n):
+    start = time.time()
+    for i in range(n):
+        sword._make_receipt("bench" + str(i), "https://datahub.deepgreen.org/FilesAndJATS", "Notification has been accepted for routing")
+    return (time.time() - start) / n
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=10000, help="number of receipts to build")
+    args = parser.parse_args()
+
+    config = Configuration(config_obj=app.config.get("SWORDV2_SERVER_CONFIG"))
+    with app.test_request_context("/"):
+        sword = JperSword(config, JperAuth("bench", None, "bench"))
+
+        sword.um = UrlForURIManager(config)
+        bench(sword, 100)
+        before = bench(sword, args.number)
+
+        sword.um = URIManager(config)
+        bench(sword, 100)
+        after = bench(sword, args.number)
+
+    print "url_for per url:    {x:8.2f}us per receipt".format(x=before * 1000000)
+    print "precompiled urls:   {x:8.2f}us per receipt".format(x=after * 1000000)
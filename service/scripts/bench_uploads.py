@@ -0,0 +1,103 @@
+"""
+Benchmark the CPU time taken to receive a deposit and read it back to send to JPER, per MB of the deposit
+
+Each run receives a package of the given size from a stream and then reads it back in JPER_UPLOAD_CHUNK_SIZE
+chunks, as the multipart body sent to JPER is built, discarding them.  This is timed for:
+
+* the swordv2 blueprint's copy of the body to its temporary directory, in pieces of copy_chunk_size, with the
+  SSS default of 8096 bytes and with 1MB, followed by reading the file back
+* service.uploads.receive, into memory (for packages up to the threshold) and into a temporary file, followed by
+  reading the body back, through a memory map in the case of the file
+
+The incoming stream only has a read method, as gunicorn's request body does, unless -r is given, in which case it
+also has readinto.  CPU time (user and system) is reported rather than elapsed time, as the aim is to reduce the
+work each worker does for a deposit, rather than to measure the disk.
+
+::
+
+    python bench_uploads.py -s 1 -s 16 -s 64 -n 10
+"""
+
+import io, os, resource, shutil, tempfile
+
+from service import uploads
+
+SEND_CHUNK_SIZE = 1048576
+
+class ReadOnlyStream(object):
+    """
+    Stream which can only be read, like the body of a request under gunicorn
+    """
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.data.read(size)
+
+def blueprint_receive(stream, length, directory, copy_chunk_size):
+    """
+    Receive the body as the swordv2 blueprint does: copied to a file in its temporary directory
+    """
+    path = os.path.join(directory, "deposit")
+    with open(path, "wb") as out:
+        while True:
+            chunk = stream.read(copy_chunk_size)
+            if not chunk:
+                break
+            out.write(chunk)
+    return open(path, "rb")
+
+def send(f, mapped):
+    """
+    Read the body back as it is sent to JPER, discarding it
+    """
+    chunks = uploads.mapped_chunks(f, SEND_CHUNK_SIZE) if mapped else None
+    if chunks is None:
+        chunks = uploads.read_chunks(f, SEND_CHUNK_SIZE)
+    sent = 0
+    for chunk in chunks:
+        sent += len(chunk)
+    return sent
+
+def cpu():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+def run(name, data, receive, mapped, n, readinto):
+    total = 0.0
+    for i in range(n):
+        stream = io.BytesIO(data) if readinto else ReadOnlyStream(data)
+        start = cpu()
+        f = receive(stream, len(data))
+        sent = send(f, mapped)
+        f.close()
+        total += cpu() - start
+        assert sent == len(data)
+    mb = len(data) / 1048576.0
+    print "{n:<32} {s:8.1f}MB {t:10.2f}ms CPU per MB".format(n=name, s=mb, t=total / n / mb * 1000)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--size", type=int, action="append", help="size of the package in MB (may be repeated); 1, 16 and 64 if not given")
+    parser.add_argument("-n", "--number", type=int, default=10, help="number of times to receive each package")
+    parser.add_argument("-t", "--threshold", type=int, default=8388608, help="largest body in bytes to receive into memory")
+    parser.add_argument("-b", "--block-size", type=int, default=1048576, help="size of the blocks to receive the body in")
+    parser.add_argument("-r", "--readinto", action="store_true", help="give the incoming stream a readinto method")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="sword-bench-uploads-")
+    try:
+        for size in (args.size or [1, 16, 64]):
+            data = os.urandom(size * 1048576)
+            run("blueprint, 8096 byte copy", data,
+                lambda s, l: blueprint_receive(s, l, directory, 8096), False, args.number, args.readinto)
+            run("blueprint, 1MB copy", data,
+                lambda s, l: blueprint_receive(s, l, directory, 1048576), False, args.number, args.readinto)
+            if len(data) <= args.threshold:
+                run("buffered, memory", data,
+                    lambda s, l: uploads.receive(s, l, threshold=args.threshold, buffer_size=args.block_size), False, args.number, args.readinto)
+            run("buffered, file, mmap", data,
+                lambda s, l: uploads.receive(s, l, threshold=0, buffer_size=args.block_size, directory=directory), True, args.number, args.readinto)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
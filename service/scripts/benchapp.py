@@ -0,0 +1,17 @@
+"""
+WSGI entry point for benchmark runs
+
+This is the application from service.web, with configuration overrides taken from the SWORD_BENCH_CONFIG
+environment variable (a JSON object), so that benchmark.py can point it at the stand-in JPER without touching
+local.cfg.
+
+::
+
+    SWORD_BENCH_CONFIG='{"JPER_BASE_URL" : "http://127.0.0.1:5998"}' gunicorn -c deployment/gconf.py --pythonpath service/scripts benchapp:app
+"""
+
+import json, os
+
+from service.web import app
+
+app.config.update(json.loads(os.environ.get("SWORD_BENCH_CONFIG", "{}")))
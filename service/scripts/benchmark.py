@@ -0,0 +1,308 @@
+"""
+Reproducible benchmark suite for the SWORD endpoint, run against the local stand-in JPER
+
+For each scenario this starts the stand-in JPER from fakejper.py with the scenario's latency and error rate, starts
+the application under gunicorn (through benchapp.py, which points it at the stand-in), and drives it with a mix of
+service document requests, validate and notify deposits of the given package sizes, and statement and receipt
+polling of the notifications created.  It reports throughput, latency percentiles for each operation and the peak
+memory use of the gunicorn processes as JSON, along with the commit benchmarked, so that runs can be compared
+between commits.
+
+Run it from the root of the repository, with gunicorn installed, e.g.
+
+::
+
+    python service/scripts/benchmark.py -o bench-$(git rev-parse --short HEAD).json
+    python service/scripts/benchmark.py -s read_heavy -g deployment/gconf_threaded.py
+
+Memory is measured from /proc, so is only reported on Linux.
+"""
+
+import json, os, random, shutil, subprocess, sys, tempfile, threading, time, zipfile
+import requests
+
+from fakejper import FakeJPER
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+PACKAGING = "https://datahub.deepgreen.org/FilesAndJATS"
+
+SCENARIOS = {
+    "read_heavy" : {
+        "latency" : 0.05, "error_rate" : 0.0, "clients" : 32, "requests" : 2000, "package_sizes" : [20000],
+        "mix" : {"service_document" : 10, "notify" : 2, "statement" : 58, "receipt" : 30}
+    },
+    "deposit_mix" : {
+        "latency" : 0.05, "error_rate" : 0.0, "clients" : 16, "requests" : 600, "package_sizes" : [20000, 1000000, 10000000],
+        "mix" : {"service_document" : 5, "validate" : 20, "notify" : 30, "statement" : 30, "receipt" : 15}
+    },
+    "large_uploads" : {
+        "latency" : 0.05, "error_rate" : 0.0, "clients" : 4, "requests" : 40, "package_sizes" : [50000000],
+        "mix" : {"notify" : 100},
+        # the packages are larger than the SWORD server's max_upload_size, so are received by service.uploads
+        "config" : {"DEPOSIT_BUFFERING" : True, "DEPOSIT_STREAMING_MAX_UPLOAD_SIZE" : 104857600}
+    },
+    "degraded_upstream" : {
+        "latency" : 0.5, "error_rate" : 0.2, "clients" : 32, "requests" : 600, "package_sizes" : [20000],
+        "mix" : {"service_document" : 10, "validate" : 10, "notify" : 10, "statement" : 50, "receipt" : 20}
+    }
+}
+"""the benchmark scenarios: fake JPER latency and error rate, number of concurrent clients, total number of requests,
+sizes in bytes of the packages deposited, the relative weights of the operations, and any overrides of the
+application's configuration"""
+
+SUCCESS = [200, 201, 202, 204]
+
+ARTICLE = """<?xml version="1.0" encoding="UTF-8"?>
+<article xmlns:xlink="http://www.w3.org/1999/xlink" article-type="research-article">
+  <front><article-meta><title-group><article-title>Benchmark article {n}</article-title></title-group></article-meta></front>
+</article>
+"""
+
+def make_package(directory, size, n):
+    """
+    Make a package of about the given size: a zip of a minimal JATS file and incompressible padding
+
+    :return: path to the package
+    """
+    path = os.path.join(directory, "package-{x}.zip".format(x=size))
+    z = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED)
+    z.writestr("article.xml", ARTICLE.format(n=n))
+    z.writestr("padding.bin", os.urandom(max(0, size - 1024)))
+    z.close()
+    return path
+
+class RSSMonitor(threading.Thread):
+    """
+    Samples the resident memory of a process and all of its descendants, recording the peak total and the peak
+    of any single process
+    """
+    def __init__(self, pid, interval=0.2):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.peak_total = 0
+        self.peak_process = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            rss = [self._rss(p) for p in self._tree()]
+            if len(rss) > 0:
+                self.peak_total = max(self.peak_total, sum(rss))
+                self.peak_process = max(self.peak_process, max(rss))
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def _tree(self):
+        children = {}
+        for d in os.listdir("/proc"):
+            if not d.isdigit():
+                continue
+            try:
+                with open("/proc/" + d + "/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (IOError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(d))
+        tree = [self.pid]
+        i = 0
+        while i < len(tree):
+            tree += children.get(tree[i], [])
+            i += 1
+        return tree
+
+    def _rss(self, pid):
+        try:
+            with open("/proc/" + str(pid) + "/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except IOError:
+            pass
+        return 0
+
+def start_app(port, gconf, config, workdir):
+    """
+    Start the application under gunicorn, and wait for it to answer
+
+    :return: the gunicorn process
+    """
+    env = dict(os.environ)
+    env["SWORD_BENCH_CONFIG"] = json.dumps(config)
+    env["prometheus_multiproc_dir"] = os.path.join(workdir, "metrics")
+    proc = subprocess.Popen(["gunicorn", "-c", gconf, "--bind", "127.0.0.1:" + str(port), "--chdir", ROOT,
+                             "--pythonpath", SCRIPTS + "," + ROOT, "benchapp:app"],
+                            env=env, stdout=open(os.path.join(workdir, "gunicorn.log"), "w"), stderr=subprocess.STDOUT)
+
+    url = "http://127.0.0.1:{x}/sword/service-document".format(x=port)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise Exception("gunicorn exited on startup, see " + os.path.join(workdir, "gunicorn.log"))
+        try:
+            requests.get(url, auth=("bench", "bench"), timeout=1)
+            return proc
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    proc.terminate()
+    raise Exception("gunicorn did not start answering requests within 60s")
+
+def client_loop(base_url, scenario, packages, seed, state):
+    """
+    Make requests in the scenario's mix until the scenario's total has been made
+    """
+    rnd = random.Random(seed)
+    ops = []
+    for op, weight in sorted(scenario["mix"].items()):
+        ops += [op] * weight
+    s = requests.Session()
+    s.auth = ("bench", "bench")
+
+    while True:
+        with state["lock"]:
+            if state["remaining"] <= 0:
+                return
+            state["remaining"] -= 1
+            created = list(state["created"][-100:])
+
+        op = rnd.choice(ops)
+        kwargs = {}
+        if op == "service_document":
+            method, url = "GET", base_url + "/service-document"
+        elif op in ["validate", "notify"]:
+            size = rnd.choice(scenario["package_sizes"])
+            method, url = "POST", base_url + "/collection/" + op
+            kwargs["headers"] = {"Content-Type" : "application/zip", "Content-Disposition" : "filename=package.zip", "Packaging" : PACKAGING}
+        else:
+            nid = rnd.choice(created) if len(created) > 0 else "bench" + str(rnd.randint(0, 1000))
+            method, url = "GET", base_url + "/entry/" + nid
+            if op == "statement":
+                url += "/statement/atom"
+
+        start = time.time()
+        status = None
+        location = None
+        try:
+            if method == "POST":
+                with open(packages[size], "rb") as f:
+                    resp = s.request(method, url, data=f, **kwargs)
+            else:
+                resp = s.request(method, url, **kwargs)
+            resp.content
+            status = resp.status_code
+            location = resp.headers.get("Location")
+        except requests.exceptions.RequestException:
+            pass
+        elapsed = time.time() - start
+
+        with state["lock"]:
+            state["results"].append((op, status, elapsed, size if method == "POST" else 0))
+            if op == "notify" and location is not None:
+                state["created"].append(location.rstrip("/").rsplit("/", 1)[1])
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def summarise(results, elapsed):
+    """
+    Summarise the results of a run, overall and for each operation
+    """
+    def stats(rs):
+        latencies = sorted([r[2] for r in rs])
+        return {
+            "requests" : len(rs),
+            "errors" : len([r for r in rs if r[1] not in SUCCESS]),
+            "throughput" : len(rs) / elapsed,
+            "mean" : sum(latencies) / len(latencies) if len(latencies) > 0 else None,
+            "p50" : percentile(latencies, 0.5),
+            "p95" : percentile(latencies, 0.95),
+            "p99" : percentile(latencies, 0.99),
+            "bytes_uploaded" : sum([r[3] for r in rs])
+        }
+    summary = stats(results)
+    summary["elapsed"] = elapsed
+    summary["operations"] = dict([(op, stats([r for r in results if r[0] == op])) for op in set([r[0] for r in results])])
+    return summary
+
+def run_scenario(name, scenario, gconf, port, jper_port):
+    workdir = tempfile.mkdtemp(prefix="sword-bench-")
+    jper = FakeJPER(jper_port, latency=scenario["latency"], error_rate=scenario["error_rate"]).start()
+    proc = None
+    try:
+        packages = dict([(size, make_package(workdir, size, i)) for i, size in enumerate(scenario["package_sizes"])])
+        config = {
+            "JPER_BASE_URL" : jper.base_url(),
+            "DEPOSIT_INDEX_PATH" : os.path.join(workdir, "deposits.sqlite"),
+            "SPOOL_DIR" : os.path.join(workdir, "spool"),
+            "SPOOL_JOURNAL_PATH" : os.path.join(workdir, "spool.sqlite")
+        }
+        config.update(scenario.get("config", {}))
+        proc = start_app(port, gconf, config, workdir)
+
+        monitor = RSSMonitor(proc.pid)
+        monitor.start()
+        state = {"lock" : threading.Lock(), "remaining" : scenario["requests"], "results" : [], "created" : []}
+        base_url = "http://127.0.0.1:{x}/sword".format(x=port)
+        threads = [threading.Thread(target=client_loop, args=(base_url, scenario, packages, i, state)) for i in range(scenario["clients"])]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        monitor.stop()
+
+        summary = summarise(state["results"], elapsed)
+        summary["peak_rss_total"] = monitor.peak_total
+        summary["peak_rss_process"] = monitor.peak_process
+        summary["scenario"] = scenario
+        summary["gconf"] = gconf
+        return summary
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        jper.shutdown()
+        jper.server_close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--scenario", action="append", help="scenario to run (may be repeated); all of them if not given: " + ", ".join(sorted(SCENARIOS.keys())))
+    parser.add_argument("-g", "--gconf", default=os.path.join(ROOT, "deployment", "gconf.py"), help="gunicorn configuration to run the application with")
+    parser.add_argument("-p", "--port", type=int, default=5026, help="port to run the application on")
+    parser.add_argument("-j", "--jper-port", type=int, default=5999, help="port to run the stand-in JPER on")
+    parser.add_argument("-o", "--output", help="file to write the results to; stdout if not given")
+    args = parser.parse_args()
+
+    results = {"commit" : commit(), "started" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "scenarios" : {}}
+    for name in (args.scenario or sorted(SCENARIOS.keys())):
+        print >> sys.stderr, "Running scenario " + name
+        results["scenarios"][name] = run_scenario(name, SCENARIOS[name], args.gconf, args.port, args.jper_port)
+        r = dict(results["scenarios"][name])
+        # the percentiles are None if no request was made
+        for p in ["p50", "p95", "p99"]:
+            r[p] = "-" if r[p] is None else "{x:.3f}s".format(x=r[p])
+        print >> sys.stderr, "  {requests} requests, {errors} errors, {throughput:.1f} req/s, p50 {p50}, p95 {p95}, p99 {p99}, peak RSS {peak_rss_total} bytes".format(**r)
+
+    out = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out)
+    else:
+        print out
@@ -0,0 +1,72 @@
+"""
+Exercise the timeouts, retries and circuit breaker around the JPER client against the local stand-in JPER in
+fakejper.py, by taking it through a period of slowness, an outage and a recovery, and reporting how the client
+and the breaker behave in each.
+
+::
+
+    python check_resilience.py
+"""
+
+import time
+
+from octopus.core import app, initialise
+from octopus.modules.jper import client
+from service import breaker, upstream
+
+from fakejper import FakeJPER
+
+def attempt(n):
+    """
+    Request n notifications, and count the outcomes
+
+    :return: dict of outcome to count, and the mean time taken per request
+    """
+    outcomes = {}
+    start = time.time()
+    for i in range(n):
+        try:
+            upstream.get_client("check").get_notification(notification_id="check" + str(i))
+            outcome = "ok"
+        except upstream.JPERUnavailableException:
+            outcome = "refused"
+        except client.JPERException:
+            outcome = "failed"
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return outcomes, (time.time() - start) / n
+
+def report(phase, n):
+    outcomes, mean = attempt(n)
+    stats = upstream.jper_breaker().stats()
+    print "{p:<10} {o:<40} mean {m:8.3f}ms   breaker {s} (retry after {r}s)".format(
+        p=phase, o=outcomes, m=mean * 1000, s=stats["state"], r=stats["retry_after"])
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=20, help="number of requests to make in each phase")
+    args = parser.parse_args()
+
+    initialise()
+    server = FakeJPER().start()
+    app.config["JPER_BASE_URL"] = server.base_url()
+    app.config["JPER_TIMEOUTS"] = {"get_notification" : (1, 0.5)}
+    app.config["JPER_BREAKER_RESET_TIMEOUT"] = 2
+
+    report("healthy", args.number)
+
+    server.latency = 1.0
+    report("slow", 3)
+
+    server.latency = 0.0
+    server.error_rate = 1.0
+    server.error_status = 503
+    report("outage", args.number)
+
+    server.error_rate = 0.0
+    report("recovered", args.number)
+    time.sleep(app.config["JPER_BREAKER_RESET_TIMEOUT"] + 0.5)
+    report("reset", args.number)
+
+    print breaker.all_stats()
+    server.shutdown()
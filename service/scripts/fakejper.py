@@ -0,0 +1,247 @@
+"""
+A local stand-in for the JPER API, for use in benchmarks and load tests
+
+This implements just enough of the JPER API for this application to talk to it: retrieving notifications (and
+checking they exist with HEAD), listing them, validating them and creating them.  Responses can be delayed, made
+to fail at random with an error status, or dropped without a response at all, to simulate a slow or unreliable
+JPER.  The latency and failure settings are attributes of the server, and may be changed while it is running,
+for example to simulate an outage and a recovery.
+
+To run it standalone, use
+
+::
+
+    python fakejper.py -p 5998 -l 0.05
+
+and set JPER_BASE_URL to http://localhost:5998 in your local.cfg
+"""
+
+import json, random, socket, threading, time, uuid
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+BAD_API_KEY = "bad"
+"""API key which the fake JPER will always reject"""
+
+MISSING_PREFIX = "missing"
+"""notification ids starting with this will never be found"""
+
+LISTED_PREFIX = "listed"
+"""prefix of the ids of the notifications in the listing of routed notifications, which are always routed"""
+
+ROUTED_DATE = "2016-01-01T00:05:00Z"
+"""the date on which every routed notification was routed"""
+
+class FakeJPERHandler(BaseHTTPRequestHandler):
+    """
+    Request handler for the fake JPER API.  It speaks HTTP/1.1, so that clients can keep connections alive.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        url, api_key = self._parse()
+        if not self._before(api_key):
+            return
+
+        parts = url.path.strip("/").split("/")
+        if len(parts) >= 2 and parts[-2] == "notification":
+            nid = parts[-1]
+            if nid.startswith(MISSING_PREFIX):
+                return self._send(404, {"error" : "Notification not found"})
+            return self._send(200, self.server.notification(nid))
+        if len(parts) >= 1 and parts[-1] == "routed":
+            return self._send(200, self.server.listing(parse_qs(url.query)))
+
+        self._send(404, {"error" : "Unknown endpoint"})
+
+    def do_HEAD(self):
+        url, api_key = self._parse()
+        if not self._before(api_key):
+            return
+
+        parts = url.path.strip("/").split("/")
+        if len(parts) >= 2 and parts[-2] == "notification":
+            return self._send(404 if parts[-1].startswith(MISSING_PREFIX) else 200, head=True)
+        self._send(404, head=True)
+
+    def do_POST(self):
+        url, api_key = self._parse()
+        self._drain()
+        if not self._before(api_key):
+            return
+
+        if url.path.endswith("/validate"):
+            return self._send(204)
+        if url.path.endswith("/notification"):
+            nid = uuid.uuid4().hex
+            return self._send(202, {"status" : "accepted", "id" : nid, "location" : self.server.base_url() + "/notification/" + nid})
+
+        self._send(404, {"error" : "Unknown endpoint"})
+
+    def _parse(self):
+        url = urlparse(self.path)
+        api_key = parse_qs(url.query).get("api_key", [None])[0]
+        return url, api_key
+
+    def _before(self, api_key):
+        """
+        Apply the configured latency and failures, and authenticate the request
+
+        :return: True if the request should now be handled, False if a response has already been sent
+        """
+        delay = self.server.latency
+        if self.server.latency_jitter > 0:
+            delay += random.uniform(0, self.server.latency_jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.server.drop_rate > 0 and random.random() < self.server.drop_rate:
+            # close the connection without answering, as a crashed or overloaded server would
+            self.close_connection = 1
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return False
+        if self.server.error_rate > 0 and random.random() < self.server.error_rate:
+            self._send(self.server.error_status, {"error" : "Injected failure"})
+            return False
+        if api_key is None or api_key == BAD_API_KEY:
+            self._send(401, {"error" : "Invalid API key"})
+            return False
+        return True
+
+    def _drain(self):
+        """
+        Read and discard the request body, whether it is sent with a content length or chunked
+        """
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                self._discard(size)
+                self.rfile.readline()
+        else:
+            self._discard(int(self.headers.get("Content-Length", 0)))
+
+    def _discard(self, size):
+        while size > 0:
+            chunk = self.rfile.read(min(size, 65536))
+            if not chunk:
+                break
+            size -= len(chunk)
+
+    def _send(self, status, body=None, head=False):
+        data = json.dumps(body) if body is not None else ""
+        self.send_response(status)
+        if body is not None or head:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+
+class FakeJPER(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server which provides the fake JPER API
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, routed_ratio=0.5, verbose=False,
+                 latency_jitter=0.0, error_status=500, drop_rate=0.0):
+        """
+        :param port: port to listen on; 0 to pick a free port
+        :param latency: seconds to delay every response by
+        :param error_rate: proportion of requests (0 to 1) which should fail with error_status
+        :param routed_ratio: proportion of notifications (0 to 1) which are reported as routed
+        :param verbose: log every request to stderr
+        :param latency_jitter: further random delay of up to this many seconds to add to each response
+        :param error_status: HTTP status of the injected failures
+        :param drop_rate: proportion of requests (0 to 1) whose connection should be closed without a response
+        """
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakeJPERHandler)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.routed_ratio = routed_ratio
+        self.listing_size = 1000
+        self.verbose = verbose
+
+    def base_url(self):
+        return "http://127.0.0.1:{x}".format(x=self.server_address[1])
+
+    def notification(self, nid):
+        """
+        Make an outgoing notification record for the given id.  Whether it is routed is decided by the id,
+        so repeated requests for the same id are consistent, and those in the listing are always routed.
+        """
+        note = {
+            "id" : nid,
+            "created_date" : "2016-01-01T00:00:00Z",
+            "content" : {"packaging_format" : "https://datahub.deepgreen.org/FilesAndJATS"},
+            "links" : [
+                {"type" : "package", "format" : "application/zip", "access" : "router",
+                 "url" : self.base_url() + "/notification/" + nid + "/content",
+                 "packaging" : "https://datahub.deepgreen.org/FilesAndJATS"}
+            ]
+        }
+        if nid.startswith(LISTED_PREFIX) or (hash(nid) % 100) < self.routed_ratio * 100:
+            note["analysis_date"] = ROUTED_DATE
+        return note
+
+    def listing(self, query):
+        """
+        Make a page of the listing of routed notifications, as JPER's /routed does: it holds only notifications
+        which have been routed, whoever deposited them, and only those routed on or after the since date.  There
+        are listing_size of them, all routed on ROUTED_DATE, so any account listing from before then sees all of
+        them, and from after then sees none.
+        """
+        since = query.get("since", ["1970-01-01T00:00:00Z"])[0]
+        page = int(query.get("page", ["1"])[0])
+        page_size = int(query.get("pageSize", ["25"])[0])
+        # the dates are all YYYY-MM-DDThh:mm:ssZ, so compare as strings
+        total = self.listing_size if since <= ROUTED_DATE else 0
+        first = (page - 1) * page_size
+        ids = [LISTED_PREFIX + str(i) for i in range(first, min(first + page_size, total))]
+        return {
+            "since" : since,
+            "page" : page,
+            "pageSize" : page_size,
+            "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "total" : total,
+            "notifications" : [self.notification(nid) for nid in ids]
+        }
+
+    def start(self):
+        """
+        Serve requests on a background daemon thread
+
+        :return: this server
+        """
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, default=5998, help="port to listen on")
+    parser.add_argument("-l", "--latency", type=float, default=0.0, help="seconds to delay each response by")
+    parser.add_argument("-j", "--latency-jitter", type=float, default=0.0, help="maximum further random delay for each response, in seconds")
+    parser.add_argument("-e", "--error-rate", type=float, default=0.0, help="proportion of requests to fail with an error status")
+    parser.add_argument("-s", "--error-status", type=int, default=500, help="HTTP status of the failed requests")
+    parser.add_argument("-d", "--drop-rate", type=float, default=0.0, help="proportion of requests to drop without a response")
+    parser.add_argument("-r", "--routed-ratio", type=float, default=0.5, help="proportion of notifications that are routed")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    server = FakeJPER(args.port, args.latency, args.error_rate, args.routed_ratio, args.verbose,
+                      args.latency_jitter, args.error_status, args.drop_rate)
+    print "Fake JPER listening on " + server.base_url()
+    server.serve_forever()
@@ -0,0 +1,76 @@
+"""
+Concurrency load test for a running instance of the application
+
+This fires statement requests at the application from a number of concurrent clients, and reports the throughput
+and the effective concurrency achieved (throughput multiplied by mean latency).  Run the application against the
+stand-in JPER in fakejper.py with some latency, so that every request spends its time waiting upstream (set
+JPER_BASE_URL = "http://localhost:5998" in your local.cfg):
+
+::
+
+    python fakejper.py -p 5998 -l 0.2 &
+    gunicorn -c deployment/gconf.py service.web:app &
+    python loadtest.py -u http://localhost:5025/sword -c 32 -n 640
+
+With the 4 sync workers in gconf.py the effective concurrency cannot exceed 4.  With gconf_threaded.py it should
+approach the number of clients, up to workers * threads.
+"""
+
+import threading, time, uuid
+import requests
+
+def client_loop(base_url, api_key, count, results, lock):
+    s = requests.Session()
+    s.auth = ("loadtest", api_key)
+    for i in range(count):
+        # unique ids, so that every request goes through to the fake JPER
+        url = base_url + "/entry/" + uuid.uuid4().hex + "/statement/atom"
+        start = time.time()
+        try:
+            resp = s.get(url)
+            status = resp.status_code
+        except requests.exceptions.RequestException:
+            status = None
+        with lock:
+            results.append((status, time.time() - start))
+
+def run(base_url, api_key, clients, total):
+    results = []
+    lock = threading.Lock()
+    per_client = total // clients
+    threads = [threading.Thread(target=client_loop, args=(base_url, api_key, per_client, results, lock)) for i in range(clients)]
+
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    latencies = sorted([r[1] for r in results])
+    errors = len([r for r in results if r[0] != 200])
+    throughput = len(results) / elapsed
+    mean = sum(latencies) / len(latencies)
+    return {
+        "requests" : len(results),
+        "errors" : errors,
+        "elapsed" : elapsed,
+        "throughput" : throughput,
+        "mean_latency" : mean,
+        "p95_latency" : latencies[int(len(latencies) * 0.95)],
+        "effective_concurrency" : throughput * mean
+    }
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", "--url", default="http://localhost:5025/sword", help="base url of the SWORD endpoints")
+    parser.add_argument("-k", "--key", default="loadtest", help="API key to send as the password")
+    parser.add_argument("-c", "--clients", type=int, default=32, help="number of concurrent clients")
+    parser.add_argument("-n", "--number", type=int, default=640, help="total number of requests")
+    args = parser.parse_args()
+
+    r = run(args.url, args.key, args.clients, args.number)
+    print "{requests} requests ({errors} errors) in {elapsed:.2f}s".format(**r)
+    print "throughput {throughput:.1f} req/s, mean latency {mean_latency:.3f}s, p95 latency {p95_latency:.3f}s".format(**r)
+    print "effective concurrency {effective_concurrency:.1f}".format(**r)
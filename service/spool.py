@@ -0,0 +1,334 @@
+"""
+Durable local spool for notify deposits, with background forwarding to JPER
+
+When NOTIFY_ASYNC is enabled, a deposit to the notify collection is written to the spool and answered at once
+with a 202 Accepted, rather than holding the worker while JPER creates the notification.  Forwarder threads in
+each worker process then take items from the spool and send them to JPER, retrying with backoff when JPER is
+unavailable, until each item is either forwarded or has failed permanently.
+
+The spool is a directory of content files, along with a journal in an SQLite database which records the state of
+each item: spooled, forwarding, forwarded or failed.  The journal is shared by all the workers on the host, and
+items are claimed from it atomically, so each item is forwarded by only one of them.  Since the forwarders must
+create the notifications as the depositing user, the journal holds users' API keys, so it (and the spool
+directory) must be kept private to the application's user.
+"""
+
+import os, random, threading, time, uuid
+from contextlib import contextmanager
+
+from octopus.core import app
+from octopus.modules.jper import client, models
+from service import upstream
+from service.auth import account_id
+from service.store import SQLiteStore
+
+SPOOL_PREFIX = "spool-"
+"""prefix of the ids of spooled items, which distinguishes them from JPER's notification ids"""
+
+SPOOLED = "spooled"
+FORWARDING = "forwarding"
+FORWARDED = "forwarded"
+FAILED = "failed"
+
+def is_spool_id(id):
+    """
+    Is the id that of a spooled item, rather than of a notification in JPER?
+
+    :param id: the id
+    :return: True if it is a spooled item id
+    """
+    return id is not None and id.startswith(SPOOL_PREFIX)
+
+class Spool(SQLiteStore):
+    """
+    The spool directory and its journal
+    """
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS spool (
+            id TEXT PRIMARY KEY,
+            account TEXT NOT NULL,
+            api_key TEXT NOT NULL,
+            packaging TEXT,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL,
+            claimed_at REAL,
+            notification_id TEXT,
+            location TEXT,
+            error TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS spool_due ON spool (state, next_attempt)"
+    ]
+
+    def __init__(self, directory, journal):
+        """
+        :param directory: directory to keep the spooled content files in
+        :param journal: path to the journal database
+        """
+        super(Spool, self).__init__(journal)
+        self.directory = directory
+
+    def add(self, api_key, packaging, file_handle, chunk_size=1048576):
+        """
+        Write a deposit to the spool.  The content is safely on disk before the item is entered in the journal.
+
+        :param api_key: the API key of the depositing user
+        :param packaging: the packaging format of the deposit
+        :param file_handle: file-like object holding the content of the deposit
+        :param chunk_size: size of the chunks to copy the content in
+        :return: the id of the spooled item
+        """
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory, 0700)
+            except OSError:
+                pass
+
+        id = SPOOL_PREFIX + uuid.uuid4().hex
+        path = self.content_path(id)
+        tmp = path + ".part"
+        try:
+            with open(tmp, "wb") as out:
+                while True:
+                    chunk = file_handle.read(chunk_size)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                out.flush()
+                os.fsync(out.fileno())
+            os.rename(tmp, path)
+        finally:
+            # e.g. the deposit turned out to be too large, or the client went away
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        now = time.time()
+        self.execute("INSERT INTO spool (id, account, api_key, packaging, state, next_attempt, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (id, account_id(api_key), api_key, packaging, SPOOLED, now, now, now))
+        return id
+
+    def get(self, id):
+        """
+        Get the journal entry for a spooled item
+
+        :param id: the id of the item
+        :return: the entry as a dict, or None if there is no such item
+        """
+        row = self.execute("SELECT * FROM spool WHERE id = ?", (id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def claim(self, stale_after=600):
+        """
+        Claim the next item which is due to be forwarded.  Items which were claimed longer than stale_after
+        seconds ago and never finished (e.g. because the worker died) are claimed again.
+
+        :param stale_after: seconds after which a claimed item is considered abandoned
+        :return: the journal entry of the claimed item as a dict, or None if there are none due
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute("SELECT * FROM spool WHERE (state = ? AND next_attempt <= ?) OR (state = ? AND claimed_at < ?) ORDER BY next_attempt LIMIT 1",
+                               (SPOOLED, now, FORWARDING, now - stale_after)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE spool SET state = ?, claimed_at = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                         (FORWARDING, now, now, row["id"]))
+        item = dict(row)
+        item["attempts"] += 1
+        return item
+
+    def heartbeat(self, id):
+        """
+        Renew the claim on an item which is still being forwarded, so that it is not taken for abandoned and
+        claimed again by another forwarder, however long sending it to JPER takes
+
+        :param id: the id of the item
+        """
+        now = time.time()
+        self.execute("UPDATE spool SET claimed_at = ?, updated = ? WHERE id = ? AND state = ?", (now, now, id, FORWARDING))
+
+    def forwarded(self, id, notification_id, location):
+        """
+        Record that an item has been forwarded to JPER, and remove its content from the spool
+
+        :param id: the id of the item
+        :param notification_id: the id JPER assigned to the notification
+        :param location: the location of the notification in JPER
+        """
+        self.execute("UPDATE spool SET state = ?, notification_id = ?, location = ?, error = NULL, updated = ? WHERE id = ?",
+                     (FORWARDED, notification_id, location, time.time(), id))
+        self._remove_content(id)
+
+    def retry(self, id, error, delay):
+        """
+        Return an item to the spool to be tried again later
+
+        :param id: the id of the item
+        :param error: description of why this attempt failed
+        :param delay: seconds to wait before trying again
+        """
+        now = time.time()
+        self.execute("UPDATE spool SET state = ?, next_attempt = ?, claimed_at = NULL, error = ?, updated = ? WHERE id = ?",
+                     (SPOOLED, now + delay, error, now, id))
+
+    def failed(self, id, error):
+        """
+        Record that an item could not be forwarded and will not be tried again, and remove its content from the spool
+
+        :param id: the id of the item
+        :param error: description of why it failed
+        """
+        self.execute("UPDATE spool SET state = ?, error = ?, updated = ? WHERE id = ?", (FAILED, error, time.time(), id))
+        self._remove_content(id)
+
+    def purge(self, older_than):
+        """
+        Remove the journal entries of items which were finished with (forwarded or failed) more than older_than
+        seconds ago
+
+        :param older_than: seconds to keep finished items for
+        """
+        self.execute("DELETE FROM spool WHERE state IN (?, ?) AND updated < ?", (FORWARDED, FAILED, time.time() - older_than))
+
+    def content_path(self, id):
+        """
+        :param id: the id of the item
+        :return: the path to the spooled content of the item
+        """
+        return os.path.join(self.directory, id + ".zip")
+
+    def _remove_content(self, id):
+        try:
+            os.remove(self.content_path(id))
+        except OSError:
+            pass
+
+_spool = None
+
+def get_spool():
+    """
+    Get the spool, as configured by SPOOL_DIR and SPOOL_JOURNAL_PATH
+
+    :return: the Spool
+    """
+    global _spool
+    if _spool is None:
+        _spool = Spool(app.config.get("SPOOL_DIR"), app.config.get("SPOOL_JOURNAL_PATH"))
+    return _spool
+
+_forwarders = []
+_forwarders_pid = None
+_forwarders_lock = threading.Lock()
+
+def start_forwarders():
+    """
+    Start the forwarder threads for this process, if they are not already running.  There are SPOOL_FORWARDERS of
+    them in each process, which bounds the number of items each worker sends to JPER at once.
+    """
+    global _forwarders, _forwarders_pid
+    if _forwarders_pid == os.getpid():
+        return
+    with _forwarders_lock:
+        if _forwarders_pid == os.getpid():
+            return
+        _forwarders = []
+        for i in range(app.config.get("SPOOL_FORWARDERS", 2)):
+            t = threading.Thread(target=_forward_loop, name="spool-forwarder-" + str(i))
+            t.daemon = True
+            t.start()
+            _forwarders.append(t)
+        _forwarders_pid = os.getpid()
+        app.logger.info(u"Started %s spool forwarders", len(_forwarders))
+
+def _forward_loop():
+    """
+    Forward spooled items to JPER for as long as the process runs, polling the journal when it is empty
+    """
+    spool = get_spool()
+    last_purge = 0
+    while True:
+        try:
+            if time.time() - last_purge > 3600:
+                spool.purge(app.config.get("SPOOL_RETENTION", 604800))
+                last_purge = time.time()
+
+            item = spool.claim(app.config.get("SPOOL_STALE_AFTER", 600))
+            if item is None:
+                time.sleep(app.config.get("SPOOL_POLL_INTERVAL", 1))
+                continue
+            forward(spool, item)
+        except Exception:
+            app.logger.exception(u"Spool forwarder encountered an unexpected error")
+            time.sleep(app.config.get("SPOOL_POLL_INTERVAL", 1))
+
+def forward(spool, item):
+    """
+    Send a claimed item to JPER, and record the outcome in the journal.  Items refused by JPER (for invalid
+    credentials or content) fail at once; any other error is retried with exponential backoff and jitter, up to
+    SPOOL_MAX_ATTEMPTS attempts.
+
+    :param spool: the Spool
+    :param item: the journal entry of the claimed item
+    """
+    notification = models.IncomingNotification()
+    notification.packaging_format = item["packaging"]
+    jper = upstream.get_client(item["api_key"])
+    try:
+        with open(spool.content_path(item["id"]), "rb") as f, heartbeat(spool, item["id"]):
+            id, loc = jper.create_notification(notification, file_handle=f)
+    except client.JPERAuthException as e:
+        app.logger.info(u"JPER refused the credentials for Spooled Item:%s", item["id"])
+        spool.failed(item["id"], u"JPER did not accept the API key")
+        return
+    except client.ValidationException as e:
+        app.logger.info(u"JPER refused the content of Spooled Item:%s", item["id"])
+        spool.failed(item["id"], e.message)
+        return
+    except (client.JPERException, IOError) as e:
+        if item["attempts"] >= app.config.get("SPOOL_MAX_ATTEMPTS", 10):
+            app.logger.info(u"Giving up on Spooled Item:%s after %s attempts", item["id"], item["attempts"])
+            spool.failed(item["id"], unicode(e))
+            return
+        delay = min(app.config.get("SPOOL_RETRY_BASE", 5) * (2 ** (item["attempts"] - 1)), app.config.get("SPOOL_RETRY_MAX", 3600))
+        delay = delay * random.uniform(0.5, 1.0)
+        app.logger.info(u"Failed to forward Spooled Item:%s, will retry in %.0fs", item["id"], delay)
+        spool.retry(item["id"], unicode(e), delay)
+        return
+
+    app.logger.info(u"Forwarded Spooled Item:%s to JPER as Notification:%s", item["id"], id)
+    spool.forwarded(item["id"], id, loc)
+
+@contextmanager
+def heartbeat(spool, id):
+    """
+    Renew the claim on an item every SPOOL_HEARTBEAT_INTERVAL seconds for as long as the block runs, from a
+    separate thread, so that the claim only goes stale if the worker forwarding the item dies
+
+    ::
+
+        with heartbeat(spool, item["id"]):
+            jper.create_notification(...)
+
+    :param spool: the Spool
+    :param id: the id of the claimed item
+    """
+    interval = app.config.get("SPOOL_HEARTBEAT_INTERVAL", 60)
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                spool.heartbeat(id)
+            except Exception:
+                app.logger.exception(u"Failed to renew the claim on Spooled Item:%s", id)
+
+    t = threading.Thread(target=beat, name="spool-heartbeat-" + id)
+    t.daemon = True
+    t.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        t.join()
@@ -0,0 +1,89 @@
+"""
+Application start-up: timing of each phase, and preloading of what requests would otherwise load on first use
+
+service.web times each phase of starting the application (importing octopus, registering the swordv2 blueprint,
+importing this application's modules, preloading) with phase, and logs how long each took with report, so that
+slow start-ups can be traced to their cause.
+
+preload imports the modules of the classes named in SWORDV2_SERVER_CONFIG which every request uses (the
+SwordServer and the Authenticator), and loads the other things which would otherwise be loaded by the first request
+to need them.  The swordv2 blueprint still looks the classes up by name on each request, as it always has, but
+finds their modules already imported, so that first request does not pay for importing them.
+The package ingesters and disseminators, and the web interface, are deliberately left alone: they are only
+named as strings in the configuration, and are only imported by the swordv2 blueprint if a request needs them,
+which with this application's SwordServer none does.
+
+The gunicorn configurations in deployment/ set preload_app, so that all of this is done once, in the gunicorn
+master, and the workers are forked from it with everything already loaded, sharing its memory copy-on-write.
+Without preload_app, each worker does it when it starts, rather than during its first requests.
+
+This module is imported before octopus, so that importing octopus can be timed, so must not import it itself
+at module level.
+"""
+
+import importlib, os, time
+from contextlib import contextmanager
+
+_phases = []
+
+@contextmanager
+def phase(name):
+    """
+    Time a phase of start-up
+
+    ::
+
+        with startup.phase("import octopus"):
+            from octopus.core import app
+
+    :param name: name of the phase, for the report
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.time() - start))
+
+def phases():
+    """
+    :return: list of (name, seconds) of the phases of start-up timed so far, in the order they were timed
+    """
+    return list(_phases)
+
+def load_class(path):
+    """
+    Import the class named by a dotted path, e.g. "service.sword.JperSword"
+
+    :param path: the dotted path to the class
+    :return: the class
+    """
+    module, name = path.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)
+
+def preload():
+    """
+    Load everything which requests use, so that the first requests handled by each worker do not have to.  This
+    only warms up what requests load lazily (module imports and compiled templates); it does not change how the
+    swordv2 blueprint finds the classes it uses.
+    """
+    from octopus.core import app
+
+    # importing the classes' modules here means the blueprint's lookup of them by name finds them in sys.modules
+    config = app.config.get("SWORDV2_SERVER_CONFIG", {})
+    for key in ["sword_server", "authenticator"]:
+        if config.get(key) is not None:
+            load_class(config[key])
+
+    # templates are otherwise compiled by the first request which renders them
+    for template in app.config.get("PRELOAD_TEMPLATES", []):
+        app.jinja_env.get_template(template)
+
+def report():
+    """
+    Log the time taken by each phase of start-up, and in total
+    """
+    from octopus.core import app
+
+    total = sum([t for n, t in _phases])
+    app.logger.info(u"Started in %.3fs (pid %s): %s", total, os.getpid(),
+                    u", ".join([u"%s %.3fs" % (n, t) for n, t in _phases]))
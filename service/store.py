@@ -0,0 +1,87 @@
+"""
+Local SQLite storage
+
+This provides the base for the small pieces of persistent state this application keeps on the local machine.  An
+SQLite database in WAL mode can be used safely by all of the gunicorn workers on a host at once; each thread in
+each process gets its own connection.
+"""
+
+import os, sqlite3, threading
+
+class SQLiteStore(object):
+    """
+    Base class for a store kept in a local SQLite database.  Subclasses provide the SCHEMA, a list of SQL statements
+    which create the tables they need if they do not already exist.
+    """
+    SCHEMA = []
+
+    def __init__(self, path, timeout=30):
+        """
+        :param path: path to the database file, which will be created (along with its directory) if necessary
+        :param timeout: seconds to wait for another process to release a lock on the database
+        """
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def connection(self):
+        """
+        Get the connection to the database for the current thread, opening it and creating the schema if necessary
+
+        :return: the sqlite3 connection
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            d = os.path.dirname(self.path)
+            if d and not os.path.exists(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    # another process got there first
+                    pass
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def execute(self, sql, params=()):
+        """
+        Execute a single statement in its own transaction
+
+        :param sql: the SQL
+        :param params: the parameters for the SQL
+        :return: the cursor
+        """
+        return self.connection().execute(sql, params)
+
+    def transaction(self):
+        """
+        Get a context manager for a transaction on the current thread's connection, which takes the write lock
+        on the database immediately so that read-then-write sequences are atomic across processes
+
+        :return: the context manager, which gives the connection
+        """
+        return _Transaction(self.connection())
+
+class _Transaction(object):
+    """
+    Context manager for an immediate transaction, committed on success and rolled back on error
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
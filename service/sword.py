@@ -5,11 +5,138 @@ This provides an implenentation of sss.core.SwordServer and related support clas
 module.
 """
 
-from sss.core import SwordServer, ServiceDocument, SDCollection, SwordError, Authenticator, Auth, DepositResponse, EntryDocument, Statement, MediaResourceResponse
+from sss.core import SwordServer, ServiceDocument, SDCollection, SwordError, Authenticator, Auth, DepositRequest, DepositResponse, EntryDocument, Statement, MediaResourceResponse
 from sss.spec import Errors
-from flask import url_for
+from flask import url_for, request
+from lxml import etree
+from multiprocessing.pool import ThreadPool
 from octopus.modules.jper import client, models
 from octopus.core import app
+from service import auth, cache, idempotency, packages, precheck, responses, spool, upstream
+import hashlib, json, logging, shutil, tempfile, threading, zipfile
+from urllib import quote, urlencode
+from datetime import datetime
+
+DEPOSIT_COLLECTIONS = ["validate", "notify", "bulk"]
+"""the collections which may be deposited to"""
+
+LISTED_COLLECTIONS = ["notify"]
+"""the collections whose contents may be listed"""
+
+ATOM = "{http://www.w3.org/2005/Atom}"
+SWORD = "{http://purl.org/net/sword/terms/}"
+
+def notification_cache():
+    """
+    Get the cache of notifications retrieved from JPER
+
+    Notifications are cached against the notification id and the API key that was used to retrieve them,
+    so that one user's cached copy is never served to another.
+
+    :return: the cache holding the notifications
+    """
+    return cache.get_cache("notifications",
+                           maxsize=app.config.get("NOTIFICATION_CACHE_SIZE", 1000),
+                           ttl=app.config.get("NOTIFICATION_CACHE_PENDING_TTL", 10))
+
+def missing_notification_cache():
+    """
+    Get the cache of notifications which JPER reported did not exist
+
+    This is kept separate from the notification cache, with a much shorter time-to-live, so that repeated
+    requests for unknown ids do not each go to JPER, but new notifications are noticed quickly.
+
+    :return: the cache holding the ids which were not found
+    """
+    return cache.get_cache("missing_notifications",
+                           maxsize=app.config.get("NOTIFICATION_NEGATIVE_CACHE_SIZE", 1000),
+                           ttl=app.config.get("NOTIFICATION_NEGATIVE_CACHE_TTL", 30))
+
+PACKAGE_UNKNOWN = 0
+PACKAGE_PRESENT = 1
+PACKAGE_ABSENT = 2
+
+def existence_index():
+    """
+    Get the process-wide index of notification ids known to exist, used to answer existence checks without
+    retrieving the notification
+
+    Like the notification cache, entries are keyed by the notification id and the API key, since whether a
+    notification can be seen depends on who is asking.  Each holds a small flag saying whether the notification
+    is known to have a package (PACKAGE_PRESENT), known not to (PACKAGE_ABSENT), or has not been seen in full yet
+    (PACKAGE_UNKNOWN).
+
+    :return: the TTLCache holding the flags
+    """
+    return cache.get_cache("existence",
+                           maxsize=app.config.get("EXISTENCE_INDEX_SIZE", 100000),
+                           ttl=app.config.get("EXISTENCE_INDEX_TTL", 86400))
+
+def collection_page_cache():
+    """
+    Get the cache of pages of notification listings retrieved from JPER
+
+    Pages are cached against the API key and the since/page/page size requested, for only a short while,
+    so that clients paging through a listing, or polling it, do not each go to JPER.
+
+    :return: the cache holding the pages
+    """
+    return cache.get_cache("collection_pages",
+                           maxsize=app.config.get("COLLECTION_PAGE_CACHE_SIZE", 1000),
+                           ttl=app.config.get("COLLECTION_PAGE_CACHE_TTL", 30))
+
+def rendered_cache():
+    """
+    Get the cache of rendered statements and deposit receipts
+
+    :return: the cache holding the rendered documents and their ETags
+    """
+    return cache.get_cache("rendered",
+                           maxsize=app.config.get("RENDERED_CACHE_SIZE", 1000),
+                           ttl=app.config.get("RENDERED_CACHE_TTL", 3600))
+
+def package_check_cache():
+    """
+    Get the process-wide cache of the outcomes of local package checks
+
+    :return: the TTLCache holding the check outcomes, keyed by the SHA-256 digest of the package
+    """
+    return cache.get_cache("package_checks",
+                           maxsize=app.config.get("PACKAGE_PRECHECK_CACHE_SIZE", 1000),
+                           ttl=app.config.get("PACKAGE_PRECHECK_CACHE_TTL", 86400))
+
+_deposit_index = None
+
+def deposit_index():
+    """
+    Get the index of recent notify deposits, used to recognise retried deposits
+
+    :return: the DepositIndex
+    """
+    global _deposit_index
+    if _deposit_index is None:
+        _deposit_index = idempotency.DepositIndex(app.config.get("DEPOSIT_INDEX_PATH"),
+                                                  window=app.config.get("DEPOSIT_DEDUP_WINDOW", 86400),
+                                                  max_entries=app.config.get("DEPOSIT_INDEX_MAX_ENTRIES", 100000))
+    return _deposit_index
+
+def etag(doc):
+    """
+    Compute a strong ETag for a serialised document
+
+    :param doc: the document
+    :return: the ETag value
+    """
+    return hashlib.sha1(doc.encode("utf-8") if isinstance(doc, unicode) else doc).hexdigest()
+
+_notification_fetches = cache.SingleFlight()
+"""coalesces concurrent requests to JPER for the same notification"""
+
+_existence_probes = cache.SingleFlight()
+"""coalesces concurrent existence probes to JPER for the same notification"""
+
+_service_documents = {}
+"""serialised service documents, keyed by base url, as tuples of (config fingerprint, document, etag)"""
 
 class JperAuth(Auth):
     """
@@ -30,21 +157,44 @@ class JperAuthenticator(Authenticator):
 
     def basic_authenticate(self, username, password, obo):
         """
-        Basic authenticate the user.  Though in reality this does nothing.
+        Basic authenticate the user.  Though in reality this does nothing, unless JPER_VERIFY_CREDENTIALS is enabled.
 
         Since the actual authentication will be done at JPER rather than here, all we need to do
-        is create a JperAuth object and let that service bounce the response if the creds are wrong
+        is create a JperAuth object and let that service bounce the response if the creds are wrong.
+
+        If JPER_VERIFY_CREDENTIALS is enabled, the API key is checked with JPER (or the cached outcome of
+        a previous check is used), and the request is refused here if it is not valid.
 
         :param username:    the username
         :param password: the password
         :param obo: not used - here for method sig compliance on superclass
         :return: a JperAuth object representing these
         """
+        if app.config.get("JPER_VERIFY_CREDENTIALS", False):
+            app.logger.debug(u"Request received for Basic Auth on Username:%s - checking credentials with JPER", username)
+            if not auth.credentials_valid(password):
+                app.logger.debug(u"User provided invalid authentication credentials for JPER")
+                raise SwordError(status=401, empty=True)
+            return JperAuth(username, obo, password)
+
         # we don't even attempt to auth the user, just let the
         # JPER API do that
-        app.logger.debug(u"Request received for Basic Auth on Username:{x} - credentials to be forwarded to JPER, not checked here".format(x=username))
+        app.logger.debug(u"Request received for Basic Auth on Username:%s - credentials to be forwarded to JPER, not checked here", username)
         return JperAuth(username, obo, password)
 
+def _is_package_member(name):
+    """
+    Is the named member of a bulk deposit one of its packages?  Directories, and the hidden files which archivers
+    add (such as the __MACOSX/._<name>.zip resource forks of zip files made on macOS), are not.
+
+    :param name: the name of the member in the zip file
+    :return: True if the member is a package
+    """
+    if name.endswith("/") or not name.lower().endswith(".zip"):
+        return False
+    parts = name.split("/")
+    return parts[0] != "__MACOSX" and not any([p.startswith(".") for p in parts])
+
 class JperSword(SwordServer):
     """
     Implementation of the sss.core.SwordServer which provides implementations only for the methods
@@ -56,12 +206,19 @@ class JperSword(SwordServer):
         # create a URIManager for us to use
         self.um = URIManager(self.configuration)
 
-        # instance of the jper client to communicate via
-        self.jper = client.JPER(api_key=self.auth_credentials.password)
+        # instance of the jper client to communicate via, which shares its connection pool with all other requests
+        self.jper = upstream.get_client(self.auth_credentials.password)
 
-        # a place to cache the notes we retrieve from the server
+        # the notes we have used during this request.  These are backed by the process-wide
+        # notification cache, which is shared between requests
         self.notes = {}
 
+        # SHA-256 digests of the content of deposits made in this request
+        self.digests = {}
+
+        # journal entries for spooled deposits which have not yet been forwarded to JPER
+        self.spooled = {}
+
     ##############################################
     ## Methods required by the JPER integration
 
@@ -69,27 +226,45 @@ class JperSword(SwordServer):
         """
         Does the url path provided refer to a notification that already exists?
 
-        Note that this queries the JPER API and caches a copy of the notification
+        A GET of the container (its deposit receipt or statement) goes on to need the whole notification, so for
+        those the notification is retrieved (or taken from the cache) here, which answers the question and leaves
+        it cached for the rest of the request, with a single request to JPER.  For anything else, which only needs
+        to know that the notification exists, this is answered from the existence index if possible, and otherwise
+        by asking JPER whether the notification exists, without retrieving it.
 
         :param path: url path (e.g. the notification id)
         :return: True if the notification exists, False if not
         """
-        app.logger.info(u"Request received to check existence of Notification:{x}".format(x=path))
-        return self._cache_notification(path)
+        app.logger.info(u"Request received to check existence of Notification:%s", path)
+        if request.method == "GET":
+            return self._cache_notification(path)
+        return self._notification_exists(path)
 
     def media_resource_exists(self, path):
         """
         Does the media resource (content file) as referenced by the url path exist
 
-        Note that this queries the JPER API and caches a copy of the notification
+        This is answered from the existence index if the notification has been seen in full before, and
+        otherwise the notification is retrieved from JPER (and cached) to find out.
 
         :param path: url path for the notification content file
         :return: True if the file exists, False if not
         """
-        app.logger.info(u"Request received to check existence of Media Resource for Notification:{x}".format(x=path))
+        app.logger.info(u"Request received to check existence of Media Resource for Notification:%s", path)
+        flag = existence_index().get((path, self.auth_credentials.password))
+        if flag == PACKAGE_PRESENT:
+            return True
+        if flag == PACKAGE_ABSENT:
+            return False
+
         cached = self._cache_notification(path)
         if not cached:
-            app.logger.info(u"Unable to retrieve and cache Notification:{x}".format(x=path))
+            app.logger.info(u"Unable to retrieve and cache Notification:%s", path)
+            return False
+
+        # a spooled deposit has no media resource until it reaches JPER
+        if path in self.spooled:
+            app.logger.info(u"No Media Resource available yet for Spooled Item:%s", path)
             return False
 
         # get the note from the cache
@@ -98,66 +273,34 @@ class JperSword(SwordServer):
         # a note has a media resource if there is a content link associated with it
         packs = note.get_urls(type="package")
         if len(packs) == 0:
-            app.logger.info(u"No Media Resource available for Notification:{x}".format(x=path))
+            app.logger.info(u"No Media Resource available for Notification:%s", path)
         else:
-            app.logger.info(u"One or more Media Resources found for Notification:{x}".format(x=path))
+            app.logger.info(u"One or more Media Resources found for Notification:%s", path)
         return len(packs) > 0
 
     def service_document(self, path=None):
         """
-        Construct the Service Document for JPER.  This takes the set of collections that are in the store, and places them in
-        an Atom Service document as the individual entries
+        Get the Service Document for JPER.
 
-        This will provide two collections for deposit: one for validation requests and the other for create requests.
+        The document depends only on the server configuration, so it is built once and then served from memory,
+        with an ETag so that clients can revalidate their copy.  It is rebuilt if the configuration changes.
 
         :param path: url path sent to the server (for supporting sub-service documents, which we don't in this implementation)
         :return: serialised service document
         """
         app.logger.info(u"Request received for SWORD Service Document")
-        service = ServiceDocument(version=self.configuration.sword_version,
-                                    max_upload_size=self.configuration.max_upload_size)
+        base_url = self.configuration.base_url
+        fingerprint = self._service_document_fingerprint()
 
-        # Our service document always consists of exactly 2 collections - one for validation
-        # and the other for actual deposit
+        cached = _service_documents.get(base_url)
+        if cached is None or cached[0] != fingerprint:
+            app.logger.debug(u"Building Service Document for Base URL:%s", base_url)
+            doc = self._build_service_document()
+            cached = (fingerprint, doc, etag(doc))
+            _service_documents[base_url] = cached
 
-        accept = self.configuration.app_accept
-        multipart_accept = self.configuration.multipart_accept
-        accept_package = self.configuration.sword_accept_package
-
-        validate = SDCollection(
-            href=self.um.col_uri("validate"),
-            title="Validate",
-            accept=accept,
-            multipart_accept=multipart_accept,
-            description="Deposit here to validate the format of your notification files",
-            accept_package=accept_package,
-            collection_policy="This collection will take any deposit package intended for the DeepGreen service",
-            mediation=self.configuration.mediation,
-            treatment="Packages sent here will be validated, and you will receive an error document or a deposit receipt.  " +
-                      "The deposit will not subsequently be stored, so you will not be able to retrieve it again afterwards.",
-            sub_service=[]
-        )
-
-        notify = SDCollection(
-            href=self.um.col_uri("notify"),
-            title="Notify",
-            accept=accept,
-            multipart_accept=multipart_accept,
-            description="Deposit here to deliver a publication event notification",
-            accept_package=accept_package,
-            collection_policy="This collection will take any deposit package intended for the DeepGreen service",
-            mediation=self.configuration.mediation,
-            treatment="Packages sent here will be analysed for metadata suitable for routing to appropriate repository systems, " +
-                      "and then delivered onward.",
-            sub_service=[]
-        )
-
-        # service.add_workspace("JPER", [validate, notify])
-        # 2016-10-25 TD : title adjustment of the Service-Document for DeepGreen
-        service.add_workspace("DeepGreen Prototype", [validate, notify])
-
-        # serialise and return
-        return service.serialise()
+        responses.conditional(etag=cached[2])
+        return cached[1]
 
     def deposit_new(self, path, deposit):
         """
@@ -167,7 +310,7 @@ class JperSword(SwordServer):
         :param deposit:       the DepositRequest object to be processed
         :return: a DepositResponse object which will contain the Deposit Receipt or a SWORD Error
         """
-        app.logger.info(u"Request received to deposit new notification to Location:{x}".format(x=path))
+        app.logger.info(u"Request received to deposit new notification to Location:%s", path)
 
         # make a notification that we can use to go along with the deposit
         # it doesn't need to contain anything
@@ -175,7 +318,13 @@ class JperSword(SwordServer):
         notification.packaging_format = deposit.packaging
 
         # instance of the jper client to communicate via
-        jper = client.JPER(api_key=deposit.auth.password)
+        jper = self.jper
+        if deposit.auth.password != self.auth_credentials.password:
+            jper = upstream.get_client(deposit.auth.password)
+
+        # reject packages which are certainly broken before we send them anywhere
+        if path in ["validate", "notify"]:
+            self._precheck(deposit)
 
         # the deposit could be on the validate or the notify endpoint
         receipt = None
@@ -194,24 +343,52 @@ class JperSword(SwordServer):
             app.logger.debug("Validation succeeded on user's notification")
             accepted = True
         elif path == "notify":
-            try:
-                id, loc = jper.create_notification(notification, file_handle=deposit.content_file)
+            # if this is a retry of a deposit we have already passed on, answer it with the original notification
+            keys = self._deposit_keys(deposit)
+            original = deposit_index().lookup(deposit.auth.password, keys) if len(keys) > 0 else None
+            if original is not None:
+                id, loc = original
+                app.logger.info(u"Deposit repeats the one which created Notification:%s, returning its receipt", id)
+            elif app.config.get("NOTIFY_ASYNC", False):
+                # write the deposit to the spool, and let the forwarders deliver it to JPER
+                id = spool.get_spool().add(deposit.auth.password, deposit.packaging, deposit.content_file,
+                                           chunk_size=app.config.get("JPER_UPLOAD_CHUNK_SIZE", 1048576))
+                loc = self.um.edit_uri(id)
+                spool.start_forwarders()
+                app.logger.debug(u"Spooled user's notification as Spooled Item:%s", id)
+                if len(keys) > 0:
+                    deposit_index().record(deposit.auth.password, keys, id, loc)
+            else:
+                try:
+                    id, loc = jper.create_notification(notification, file_handle=deposit.content_file)
+                except client.JPERAuthException as e:
+                    app.logger.debug(u"User provided invalid authentication credentials for JPER")
+                    raise SwordError(status=401, empty=True)
+                except client.ValidationException as e:
+                    app.logger.debug("Validation failed for user's notification")
+                    raise SwordError(error_uri=Errors.bad_request, msg=e.message, author="JPER", treatment="validation failed")
+                app.logger.debug("Create succeeded on user's notification")
+                existence_index().set((id, deposit.auth.password), PACKAGE_UNKNOWN)
+                if len(keys) > 0:
+                    deposit_index().record(deposit.auth.password, keys, id, loc)
+            if spool.is_spool_id(id):
+                receipt = self._make_receipt(id, deposit.packaging, "Notification has been received, and will be delivered for routing shortly")
+                accepted = True
+            else:
                 receipt = self._make_receipt(id, deposit.packaging, "Notification has been accepted for routing")
-            except client.JPERAuthException as e:
-                app.logger.debug(u"User provided invalid authentication credentials for JPER")
-                raise SwordError(status=401, empty=True)
-            except client.ValidationException as e:
-                app.logger.debug("Validation failed for user's notification")
-                raise SwordError(error_uri=Errors.bad_request, msg=e.message, author="JPER", treatment="validation failed")
-            app.logger.debug("Create succeeded on user's notification")
-            create = True
+                create = True
+        elif path == "bulk":
+            receipt = self._deposit_bulk(jper, deposit)
+            responses.header("Content-Type", "application/atom+xml;type=feed")
         else:
             app.logger.debug(u"Create request was not made to a valid endpoint")
             raise SwordError(status=404, empty=True)
 
         # finally, assemble the deposit response and return
         dr = DepositResponse()
-        if receipt is not None:
+        if isinstance(receipt, basestring):
+            dr.receipt = receipt
+        elif receipt is not None:
             dr.receipt = receipt.serialise()
         if loc is not None:
             dr.location = loc
@@ -231,10 +408,13 @@ class JperSword(SwordServer):
         :param content_type   A ContentType object describing the type of the object to be retrieved
         :return: the media resource wrapped in a MediaResourceResponse object
         """
-        app.logger.info(u"Request received to retrieve Media Resource from Notification:{x}".format(x=path))
+        app.logger.info(u"Request received to retrieve Media Resource from Notification:%s", path)
         cached = self._cache_notification(path)
         if not cached:
-            app.logger.debug(u"Unable to retrieve and cache Notification:{x}".format(x=path))
+            app.logger.debug(u"Unable to retrieve and cache Notification:%s", path)
+            raise SwordError(status=404, empty=True)
+        if path in self.spooled:
+            app.logger.debug(u"No Media Resource available yet for Spooled Item:%s", path)
             raise SwordError(status=404, empty=True)
 
         # get the note from the cache
@@ -243,15 +423,92 @@ class JperSword(SwordServer):
         # a note has a media resource if there is a content link associated with it
         packs = note.get_urls(type="package")
         if len(packs) == 0:
-            app.logger.debug(u"No Media Resource associated with Notification:{x}".format(x=path))
+            app.logger.debug(u"No Media Resource associated with Notification:%s", path)
             raise SwordError(status=404, empty=True)
 
         mr = MediaResourceResponse()
         mr.redirect = True
         mr.url = packs[0]
-        app.logger.debug(u"Returned Media Resource:{x}".format(x=packs[0]))
+        app.logger.debug(u"Returned Media Resource:%s", packs[0])
         return mr
 
+    def get_package(self, path):
+        """
+        Get the package for the given id from the local package cache, downloading it from JPER if necessary.
+        This is used in place of get_media_resource when MEDIA_RESOURCE_PROXY is enabled.
+
+        :param path: The ID of the object in the store
+        :return: the package cache entry, as a dict including the path to the package file
+        """
+        app.logger.info(u"Request received to retrieve Package from Notification:%s", path)
+        cached = self._cache_notification(path)
+        if not cached or path in self.spooled:
+            app.logger.debug(u"No Package available for Notification:%s", path)
+            raise SwordError(status=404, empty=True)
+
+        packs = self.notes[path].get_urls(type="package")
+        if len(packs) == 0:
+            app.logger.debug(u"No Package associated with Notification:%s", path)
+            raise SwordError(status=404, empty=True)
+
+        try:
+            entry = packages.get_package_cache().fetch(packs[0], self.jper)
+        except client.JPERAuthException:
+            raise SwordError(status=401, empty=True)
+        if entry is None:
+            app.logger.debug(u"JPER has no Package at %s", packs[0])
+            raise SwordError(status=404, empty=True)
+        return entry
+
+    def list_collection(self, path):
+        """
+        List the contents of the collection, as a page of an Atom feed of the notifications JPER has routed (see
+        upstream.JPERClient.list_notifications).  The page is selected by the "since" and "page" parameters of the
+        current request.
+
+        The swordv2 blueprint serialises the whole feed before sending it; the same feed is streamed out by
+        iter_collection (see service.passthrough.stream_collection) wherever possible.
+
+        :param path: the collection id
+        :return: the serialised Atom feed
+        """
+        return "".join(self.iter_collection(path))
+
+    def iter_collection(self, path, since=None, page=None):
+        """
+        List the contents of the collection, as a page of an Atom feed of the notifications JPER has routed, which
+        can be sent as it is serialised.  Each page holds the notifications from one page of JPER's listing of the
+        notifications routed since the given date, with links to the next and previous pages.  JPER has no listing
+        of the notifications deposited by an account, so this is not limited to the user's own, nor does it hold
+        notifications which have not yet been routed.
+
+        The page from JPER is retrieved (or taken from the cache) before this returns, so that errors are raised
+        here, rather than once the feed has started to be sent.
+
+        :param path: the collection id
+        :param since: the date from which to list notifications; taken from the request if not given
+        :param page: the page number to list; taken from the request if not given
+        :return: iterator over the parts of the serialised feed
+        """
+        app.logger.info(u"Request received to list Collection:%s", path)
+        if path not in LISTED_COLLECTIONS:
+            raise SwordError(status=404, empty=True)
+
+        since = since if since is not None else request.args.get("since", "1970-01-01T00:00:00Z")
+        page = page if page is not None else request.args.get("page", "1")
+        try:
+            datetime.strptime(since, "%Y-%m-%dT%H:%M:%SZ")
+            page = int(page)
+            if page < 1:
+                raise ValueError()
+        except ValueError:
+            raise SwordError(error_uri=Errors.bad_request, msg=u"since must be a date of the form YYYY-MM-DDThh:mm:ssZ, and page a number from 1",
+                             author="DeepGreen", treatment="listing refused")
+
+        page_size = app.config.get("COLLECTION_PAGE_SIZE", 100)
+        listing = self._collection_page(since, page, page_size)
+        return self._collection_feed(path, since, page, page_size, listing)
+
     def get_container(self, path, accept_parameters):
         """
         Get a representation of the container in the requested content type
@@ -260,17 +517,17 @@ class JperSword(SwordServer):
         :param accept_parameters:   An AcceptParameters object describing the required format
         :return: a representation of the container in the appropriate format
         """
-        app.logger.info(u"Received request to retrieve Notification:{x}".format(x=path))
+        app.logger.info(u"Received request to retrieve Notification:%s", path)
 
         # by the time this is called, we should already know that we can return this type, so there is no need for
         # any checking, we just get on with it
 
         # pick either the deposit receipt or the pure statement to return to the client
         if accept_parameters.content_type.mimetype() == "application/atom+xml;type=entry":
-            app.logger.info(u"Returning deposit receipt for Notification:{x}".format(x=path))
+            app.logger.info(u"Returning deposit receipt for Notification:%s", path)
             return self._get_deposit_receipt(path)
         else:
-            app.logger.info(u"Returning statement for Notification:{x}".format(x=path))
+            app.logger.info(u"Returning statement for Notification:%s", path)
             return self.get_statement(path, accept_parameters.content_type.mimetype())
 
     def get_statement(self, path, type=None):
@@ -283,14 +540,36 @@ class JperSword(SwordServer):
         """
         if type is None:
             type = "application/atom+xml;type=feed"
-        app.logger.info(u"Received request for Statement for Notification:{x} in Mimetype:{y}".format(x=path, y=type))
+        app.logger.info(u"Received request for Statement for Notification:%s in Mimetype:%s", path, type)
 
         cached = self._cache_notification(path)
         if not cached:
-            app.logger.debug(u"Unable to retrieve and cache Notification:{x}".format(x=path))
+            app.logger.debug(u"Unable to retrieve and cache Notification:%s", path)
             raise SwordError(status=404, empty=True)
+
+        # a spooled deposit which has not yet reached JPER reports the state of the spooled item
+        if path in self.spooled:
+            return self._build_spooled_statement(path, self.spooled[path], type)
         note = self.notes[path]
 
+        # the rendered statement depends only on the state of the notification and on who is asking for it
+        state = "routed" if note.analysis_date is not None else "pending"
+        key = ("statement", path, state, type, self.auth_credentials.username, self.auth_credentials.on_behalf_of)
+        return self._render_cached(key, note, lambda: self._build_statement(path, note, type))
+
+
+    #############################################
+    ## some internal methods
+
+    def _build_statement(self, path, note, type):
+        """
+        Construct and serialise the statement for the notification
+
+        :param path: the id of the notification
+        :param note: the notification
+        :param type: the mimetype of statement to return
+        :return: the serialised statement, or None if the mimetype is not supported
+        """
         # State information
         #state_uri = "http://router2.mimas.ac.uk/swordv2/state/pending"
         state_uri = "https://www.oa-deepgreen.de/sword/state/pending"
@@ -304,6 +583,38 @@ class JperSword(SwordServer):
         # the derived resources/provided links
         derived_resources = [l.get("url") for l in note.links]
 
+        return self._serialise_statement(path, note.created_datestamp, note.packaging_format, state_uri, state_description, derived_resources, type)
+
+    def _build_spooled_statement(self, path, item, type):
+        """
+        Construct and serialise the statement for a spooled deposit which has not yet been forwarded to JPER
+
+        :param path: the id of the spooled item
+        :param item: the journal entry for the spooled item
+        :param type: the mimetype of statement to return
+        :return: the serialised statement, or None if the mimetype is not supported
+        """
+        state_uri = "https://www.oa-deepgreen.de/sword/state/spooled"
+        state_description = "Notification has been received, and is waiting to be delivered for routing"
+        if item["state"] == spool.FAILED:
+            state_uri = "https://www.oa-deepgreen.de/sword/state/failed"
+            state_description = u"Notification could not be delivered for routing: {x}".format(x=item["error"])
+        created = datetime.utcfromtimestamp(item["created"])
+        return self._serialise_statement(path, created, item["packaging"], state_uri, state_description, [], type)
+
+    def _serialise_statement(self, path, created, packaging, state_uri, state_description, derived_resources, type):
+        """
+        Construct and serialise a statement
+
+        :param path: the id of the notification
+        :param created: datetime at which the notification was deposited
+        :param packaging: packaging format of the deposit
+        :param state_uri: uri identifying the state of the notification
+        :param state_description: human readable description of the state
+        :param derived_resources: urls of the resources provided with the notification
+        :param type: the mimetype of statement to return
+        :return: the serialised statement, or None if the mimetype is not supported
+        """
         # the various urls
         agg_uri = self.um.agg_uri(path)
         edit_uri = self.um.edit_uri(path)
@@ -317,43 +628,291 @@ class JperSword(SwordServer):
         s = Statement()
         s.aggregation_uri = agg_uri
         s.rem_uri = edit_uri
-        s.original_deposit(deposit_uri, note.created_datestamp, note.packaging_format, by, obo)
+        s.original_deposit(deposit_uri, created, packaging, by, obo)
         s.add_state(state_uri, state_description)
         s.aggregates = derived_resources
 
         # now serve the relevant serialisation
         if type == "application/rdf+xml":
-            app.logger.debug(u"Returning RDF/XML Statement for Notification:{x}".format(x=path))
+            app.logger.debug(u"Returning RDF/XML Statement for Notification:%s", path)
             return s.serialise_rdf()
         elif type == "application/atom+xml;type=feed":
-            app.logger.debug(u"Returning ATOM Feed Statement for Notification:{x}".format(x=path))
+            app.logger.debug(u"Returning ATOM Feed Statement for Notification:%s", path)
             return s.serialise_atom()
         else:
-            app.logger.debug(u"Mimetype unrecognised, so not returning Statement for Notification:{x}".format(x=path))
+            app.logger.debug(u"Mimetype unrecognised, so not returning Statement for Notification:%s", path)
             return None
 
+    def _service_document_fingerprint(self):
+        """
+        Get a fingerprint of the configuration options which go into the service document
 
-    #############################################
-    ## some internal methods
+        :return: a hash of the relevant configuration
+        """
+        c = self.configuration
+        opts = [c.sword_version, c.max_upload_size, c.app_accept, c.multipart_accept, c.sword_accept_package, c.mediation]
+        return hashlib.sha1(json.dumps(opts, sort_keys=True)).hexdigest()
+
+    def _build_service_document(self):
+        """
+        Construct the Service Document for JPER.  This takes the set of collections that are in the store, and places them in
+        an Atom Service document as the individual entries
+
+        This will provide three collections for deposit: one for validation requests, one for create requests and one
+        for bulk create requests.
+
+        :return: serialised service document
+        """
+        service = ServiceDocument(version=self.configuration.sword_version,
+                                    max_upload_size=self.configuration.max_upload_size)
+
+        # Our service document always consists of exactly 3 collections - one for validation,
+        # one for actual deposit and one for bulk deposit
+
+        accept = self.configuration.app_accept
+        multipart_accept = self.configuration.multipart_accept
+        accept_package = self.configuration.sword_accept_package
+
+        validate = SDCollection(
+            href=self.um.col_uri("validate"),
+            title="Validate",
+            accept=accept,
+            multipart_accept=multipart_accept,
+            description="Deposit here to validate the format of your notification files",
+            accept_package=accept_package,
+            collection_policy="This collection will take any deposit package intended for the DeepGreen service",
+            mediation=self.configuration.mediation,
+            treatment="Packages sent here will be validated, and you will receive an error document or a deposit receipt.  " +
+                      "The deposit will not subsequently be stored, so you will not be able to retrieve it again afterwards.",
+            sub_service=[]
+        )
+
+        notify = SDCollection(
+            href=self.um.col_uri("notify"),
+            title="Notify",
+            accept=accept,
+            multipart_accept=multipart_accept,
+            description="Deposit here to deliver a publication event notification",
+            accept_package=accept_package,
+            collection_policy="This collection will take any deposit package intended for the DeepGreen service",
+            mediation=self.configuration.mediation,
+            treatment="Packages sent here will be analysed for metadata suitable for routing to appropriate repository systems, " +
+                      "and then delivered onward.",
+            sub_service=[]
+        )
+
+        bulk = SDCollection(
+            href=self.um.col_uri("bulk"),
+            title="Bulk Notify",
+            accept=accept,
+            multipart_accept=multipart_accept,
+            description="Deposit here to deliver many publication event notifications at once, as a zip file of packages",
+            accept_package=accept_package,
+            collection_policy="This collection will take a zip file of deposit packages intended for the DeepGreen service",
+            mediation=self.configuration.mediation,
+            treatment="Each package in the zip file will be treated as a separate deposit to the Notify collection.  " +
+                      "You will receive an Atom feed holding a deposit receipt or an error for each package.",
+            sub_service=[]
+        )
+
+        # service.add_workspace("JPER", [validate, notify])
+        # 2016-10-25 TD : title adjustment of the Service-Document for DeepGreen
+        service.add_workspace("DeepGreen Prototype", [validate, notify, bulk])
+
+        # serialise and return
+        return service.serialise()
 
     def _cache_notification(self, path):
         """
         Get a copy of the notification specified by the path, and store a copy of it
         in memory for fast access later
 
+        The notification is taken from the process-wide notification cache if possible, and is otherwise
+        retrieved from JPER and added to that cache.  Routed notifications (those with an analysis_date)
+        will not change again, so are cached for longer than pending ones.  Ids which JPER reports do not
+        exist are remembered briefly in a separate cache, and not requested again until that expires.
+        Concurrent requests for the same uncached notification wait for a single request to JPER.
+
+        Spooled deposits are looked up in the spool journal instead, and once they have been forwarded, the
+        notification JPER created for them is used.
+
         :param path:
         :return: True if exists, False if not
         """
-        # if we haven't got a cached copy, get one
-        if path not in self.notes:
-            note = self.jper.get_notification(notification_id=path)
-            if note is not None:
-                # cache the result
-                self.notes[path] = note
-            else:
+        if path in self.notes or path in self.spooled:
+            return True
+        if spool.is_spool_id(path):
+            return self._cache_spooled(path)
+
+        # look for a copy cached by an earlier request with the same credentials
+        key = (path, self.auth_credentials.password)
+        nc = notification_cache()
+        note = nc.get(key)
+
+        # if we haven't got a cached copy, get one, unless we recently found that it doesn't exist
+        if note is None:
+            mc = missing_notification_cache()
+            if mc.get(key) is not None:
+                app.logger.debug(u"Notification:%s recently found not to exist, not requesting it again", path)
+                return False
+
+            def fetch():
+                n = self.jper.get_notification(notification_id=path)
+                if n is None:
+                    mc.set(key, True)
+                    existence_index().delete(key)
+                    return n
+                if n.analysis_date is not None:
+                    nc.set(key, n, ttl=app.config.get("NOTIFICATION_CACHE_ROUTED_TTL", 3600))
+                else:
+                    nc.set(key, n, ttl=app.config.get("NOTIFICATION_CACHE_PENDING_TTL", 10))
+                self._index_notification(key, n)
+                return n
+
+            # concurrent requests for the same notification share a single request to JPER
+            note = _notification_fetches.do(key, fetch)
+            if app.logger.isEnabledFor(logging.DEBUG):
+                app.logger.debug(u"Notification cache stats: %s", nc.stats())
+            if note is None:
                 return False
+
+        self.notes[path] = note
         return True
 
+    def _notification_exists(self, path):
+        """
+        Does the notification exist?  This is answered, in order of preference, from the notifications already
+        retrieved for this request, the existence index, and the record of recently missing notifications, and
+        otherwise by a probe to JPER which does not retrieve the notification.
+
+        :param path: the id of the notification
+        :return: True if it exists, False if not
+        """
+        if path in self.notes or path in self.spooled:
+            return True
+        if spool.is_spool_id(path):
+            return self._cache_spooled(path)
+
+        key = (path, self.auth_credentials.password)
+        if existence_index().get(key) is not None:
+            return True
+        mc = missing_notification_cache()
+        if mc.get(key) is not None:
+            app.logger.debug(u"Notification:%s recently found not to exist, not requesting it again", path)
+            return False
+
+        exists = _existence_probes.do(key, lambda: self.jper.notification_exists(path))
+        if exists:
+            existence_index().set(key, PACKAGE_UNKNOWN)
+        else:
+            mc.set(key, True)
+        return exists
+
+    def _index_notification(self, key, note):
+        """
+        Record a notification retrieved in full in the existence index, with whether it has a package.  A
+        notification which has not yet been routed may still gain one, so its absence is not recorded.
+
+        :param key: the cache key of the notification
+        :param note: the notification
+        """
+        if len(note.get_urls(type="package")) > 0:
+            existence_index().set(key, PACKAGE_PRESENT)
+        elif note.analysis_date is not None:
+            existence_index().set(key, PACKAGE_ABSENT)
+        else:
+            existence_index().set(key, PACKAGE_UNKNOWN)
+
+    def _cache_spooled(self, path):
+        """
+        Look up a spooled deposit in the spool journal.  If it has been forwarded to JPER, the notification which
+        was created for it is cached as the notification for this path; otherwise the journal entry is kept
+        in self.spooled.
+
+        :param path: the id of the spooled item
+        :return: True if the item exists and belongs to the current user, False if not
+        """
+        item = spool.get_spool().get(path)
+        if item is None or item["account"] != auth.account_id(self.auth_credentials.password):
+            return False
+        if item["state"] == spool.FORWARDED:
+            if not self._cache_notification(item["notification_id"]):
+                return False
+            self.notes[path] = self.notes[item["notification_id"]]
+            return True
+        self.spooled[path] = item
+        return True
+
+    def _collection_page(self, since, page, page_size):
+        """
+        Get a page of JPER's listing of routed notifications, or from the cache of recently retrieved pages
+
+        :return: dict of the total number of notifications and the notifications on the page
+        """
+        key = (self.auth_credentials.password, since, page, page_size)
+        def fetch():
+            try:
+                return self.jper.list_notifications(since, page=page, page_size=page_size)
+            except client.JPERAuthException:
+                raise SwordError(status=401, empty=True)
+        return collection_page_cache().get_or_set(key, fetch)
+
+    def _collection_feed(self, path, since, page, page_size, listing):
+        """
+        Serialise a page of the user's notifications as an Atom feed, one entry at a time
+
+        :return: generator over the parts of the serialised feed
+        """
+        collection_uri = self.um.col_uri(path)
+        def page_uri(n):
+            return collection_uri + "?" + urlencode([("since", since), ("page", n)])
+
+        feed = etree.Element(ATOM + "feed", nsmap={None : ATOM[1:-1], "sword" : SWORD[1:-1]})
+        etree.SubElement(feed, ATOM + "id").text = page_uri(page)
+        etree.SubElement(feed, ATOM + "title").text = "DeepGreen Notifications"
+        etree.SubElement(feed, ATOM + "updated").text = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        etree.SubElement(feed, ATOM + "link", rel="self", href=page_uri(page))
+        etree.SubElement(feed, ATOM + "link", rel="first", href=page_uri(1))
+        if page > 1:
+            etree.SubElement(feed, ATOM + "link", rel="previous", href=page_uri(page - 1))
+        notes = listing.get("notifications", [])
+        total = listing.get("total")
+        if (total is not None and page * page_size < total) or (total is None and len(notes) == page_size):
+            etree.SubElement(feed, ATOM + "link", rel="next", href=page_uri(page + 1))
+
+        # send the feed header, then each entry as it is serialised, then close the feed
+        head = etree.tostring(feed, xml_declaration=True, encoding="utf-8")
+        yield head[:head.rindex("</")]
+        for note in notes:
+            yield self._collection_entry(feed, note)
+        yield "</feed>"
+        app.logger.debug(u"Listed %s notifications in Collection:%s", len(notes), path)
+
+    def _collection_entry(self, feed, note):
+        """
+        Serialise the Atom entry for a notification in a collection listing
+
+        :param feed: the feed element, which provides the namespace declarations
+        :param note: the notification
+        :return: the serialised entry
+        """
+        updated = self._last_modified(note)
+        entry = etree.SubElement(feed, ATOM + "entry")
+        etree.SubElement(entry, ATOM + "id").text = self.um.atom_id(note.id)
+        etree.SubElement(entry, ATOM + "title").text = "DeepGreen Notification"
+        if updated is not None:
+            etree.SubElement(entry, ATOM + "updated").text = updated.strftime("%Y-%m-%dT%H:%M:%SZ")
+        etree.SubElement(entry, ATOM + "link", rel="edit", href=self.um.edit_uri(note.id))
+        etree.SubElement(entry, ATOM + "link", rel="edit-media", href=self.um.em_uri(note.id))
+        etree.SubElement(entry, ATOM + "link", rel="http://purl.org/net/sword/terms/statement",
+                         type="application/atom+xml;type=feed", href=self.um.state_uri(note.id, "atom"))
+        if note.packaging_format is not None:
+            etree.SubElement(entry, SWORD + "packaging").text = note.packaging_format
+        state = "routed" if note.analysis_date is not None else "pending"
+        etree.SubElement(entry, SWORD + "state", href="https://www.oa-deepgreen.de/sword/state/" + state)
+        feed.remove(entry)
+        return etree.tostring(entry, encoding="utf-8")
+
     def _make_receipt(self, id, packaging, treatment):
         """
         Create an EntryDocument representing the notification with the specified identifier, packaging and treatment
@@ -377,6 +936,195 @@ class JperSword(SwordServer):
         receipt.original_deposit_uri = self.um.em_uri(id)
         return receipt
 
+    def _precheck(self, deposit):
+        """
+        If PACKAGE_PRECHECK is enabled, check the deposited package locally, and reject it if it is certainly not
+        acceptable to JPER.  The outcome is cached against the SHA-256 digest of the package, so a resubmission of
+        the same package is answered without checking it again.
+
+        Deposits which are being streamed through to JPER can't be read twice, so are not checked.
+
+        :param deposit: the DepositRequest
+        """
+        if not app.config.get("PACKAGE_PRECHECK", False):
+            return
+        fh = deposit.content_file
+        if fh is None or deposit.packaging not in app.config.get("PACKAGE_PRECHECK_FORMATS", []):
+            return
+        if not precheck.seekable(fh):
+            app.logger.debug(u"Deposit is being streamed, so cannot be checked locally")
+            return
+
+        error = self._precheck_error(deposit)
+        if error:
+            app.logger.debug(u"Local check failed for user's notification: %s", error)
+            raise SwordError(error_uri=Errors.bad_request, msg=error, author="DeepGreen", treatment="validation failed")
+
+    def _precheck_error(self, deposit):
+        """
+        Check the deposited package locally, using the cached outcome of checking the same package before if
+        there is one
+
+        :param deposit: the DepositRequest, whose content can be read more than once
+        :return: a description of what is wrong with the package, or an empty string if nothing is
+        """
+        pc = package_check_cache()
+        key = (self._content_digest(deposit), deposit.packaging)
+        error = pc.get(key)
+        if error is None:
+            error = precheck.check_package(deposit.content_file) or u""
+            pc.set(key, error)
+        else:
+            app.logger.debug(u"Using cached outcome of local check for Package:%s", key[0])
+        return error
+
+    def _content_digest(self, deposit):
+        """
+        Get the SHA-256 digest of the deposit's content, calculating it only once per deposit
+
+        :param deposit: the DepositRequest
+        :return: the hex digest, or None if there is no content or it can't be read twice
+        """
+        fh = deposit.content_file
+        if fh is None or not precheck.seekable(fh):
+            return None
+        if id(fh) not in self.digests:
+            self.digests[id(fh)] = precheck.content_digest(fh)
+        return self.digests[id(fh)]
+
+    def _deposit_keys(self, deposit, idempotency=True):
+        """
+        Get the keys under which a notify deposit is recorded in the deposit index, if DEPOSIT_DEDUP is enabled:
+        the digest of its content, and the idempotency key the client sent, if any
+
+        :param deposit: the DepositRequest
+        :param idempotency: whether the idempotency key of the request applies to this deposit; it does not to
+            each of the packages in a bulk deposit
+        :return: list of keys, which is empty if the deposit can't be deduplicated
+        """
+        if not app.config.get("DEPOSIT_DEDUP", False):
+            return []
+        keys = []
+        digest = self._content_digest(deposit)
+        if digest is not None:
+            keys.append(u"sha256:" + digest + u":" + unicode(deposit.packaging))
+        idem = request.headers.get(app.config.get("IDEMPOTENCY_HEADER", "Idempotency-Key")) if idempotency else None
+        if idem:
+            keys.append(u"key:" + idem)
+        return keys
+
+    def _deposit_bulk(self, jper, deposit):
+        """
+        Create a notification for each of the packages in a bulk deposit.  The deposit is a zip file containing
+        one zip file per package, and the packages are sent to JPER concurrently, by a pool of BULK_DEPOSIT_WORKERS
+        threads.  Each package is checked locally and deduplicated as a single notify deposit would be.  A package
+        which fails for any reason is reported as an error in the feed, without affecting the others, so that the
+        notifications which were created are always reported.
+
+        :param jper: the JPER client to create the notifications with
+        :param deposit: the DepositRequest holding the zip file of packages
+        :return: a serialised Atom feed of the deposit receipts and errors for the packages
+        """
+        archive = deposit.content_file
+        try:
+            archive.seek(0)
+        except (AttributeError, IOError):
+            # the deposit is being streamed to us, so spool it locally to read its directory
+            spooled = tempfile.TemporaryFile()
+            shutil.copyfileobj(archive, spooled, app.config.get("JPER_UPLOAD_CHUNK_SIZE", 1048576))
+            spooled.seek(0)
+            archive = spooled
+
+        try:
+            z = zipfile.ZipFile(archive)
+        except zipfile.BadZipfile:
+            raise SwordError(error_uri=Errors.bad_request, msg="Bulk deposits must be a zip file of packages", author="DeepGreen", treatment="bulk deposit rejected")
+
+        names = [i.filename for i in z.infolist() if _is_package_member(i.filename)]
+        max_packages = app.config.get("BULK_DEPOSIT_MAX_PACKAGES", 1000)
+        if len(names) == 0:
+            raise SwordError(error_uri=Errors.bad_request, msg="Bulk deposit contains no zip packages", author="DeepGreen", treatment="bulk deposit rejected")
+        if len(names) > max_packages:
+            raise SwordError(error_uri=Errors.bad_request, msg=u"Bulk deposits may contain at most {x} packages".format(x=max_packages),
+                             author="DeepGreen", treatment="bulk deposit rejected")
+        app.logger.info(u"Bulk deposit received containing %s packages", len(names))
+
+        # the zip file can only be read by one thread at a time, but the packages are extracted to their
+        # own temporary files, so the uploads themselves can run concurrently
+        zip_lock = threading.Lock()
+
+        def submit(name):
+            content = tempfile.TemporaryFile()
+            member = DepositRequest()
+            member.auth = deposit.auth
+            member.packaging = deposit.packaging
+            member.content_file = content
+            try:
+                with zip_lock:
+                    shutil.copyfileobj(z.open(name), content, app.config.get("JPER_UPLOAD_CHUNK_SIZE", 1048576))
+                content.seek(0)
+
+                if app.config.get("PACKAGE_PRECHECK", False) and member.packaging in app.config.get("PACKAGE_PRECHECK_FORMATS", []):
+                    error = self._precheck_error(member)
+                    if error:
+                        app.logger.debug(u"Local check failed for Package:%s in bulk deposit: %s", name, error)
+                        return name, None, client.ValidationException(error)
+
+                keys = self._deposit_keys(member, idempotency=False)
+                original = deposit_index().lookup(deposit.auth.password, keys) if len(keys) > 0 else None
+                if original is not None:
+                    app.logger.info(u"Package:%s in bulk deposit repeats the one which created Notification:%s", name, original[0])
+                    return name, original[0], None
+
+                notification = models.IncomingNotification()
+                notification.packaging_format = deposit.packaging
+                note_id, loc = jper.create_notification(notification, file_handle=content)
+                app.logger.debug(u"Bulk deposit created Notification:%s from Package:%s", note_id, name)
+                existence_index().set((note_id, deposit.auth.password), PACKAGE_UNKNOWN)
+                if len(keys) > 0:
+                    deposit_index().record(deposit.auth.password, keys, note_id, loc)
+                return name, note_id, None
+            except client.JPERException as e:
+                app.logger.debug(u"Bulk deposit failed to create notification from Package:%s", name)
+                return name, None, e
+            except Exception as e:
+                # e.g. a corrupt or encrypted member, or no room for it in the temporary directory
+                app.logger.warning(u"Bulk deposit could not send Package:%s", name, exc_info=True)
+                return name, None, e
+            finally:
+                self.digests.pop(id(content), None)
+                content.close()
+
+        pool = ThreadPool(min(app.config.get("BULK_DEPOSIT_WORKERS", 8), len(names)))
+        try:
+            results = pool.map(submit, names)
+        finally:
+            pool.close()
+            pool.join()
+
+        if len([r for r in results if isinstance(r[2], client.JPERAuthException)]) > 0:
+            app.logger.debug(u"User provided invalid authentication credentials for JPER")
+            raise SwordError(status=401, empty=True)
+
+        feed = etree.Element(ATOM + "feed", nsmap={None : ATOM[1:-1], "sword" : SWORD[1:-1]})
+        etree.SubElement(feed, ATOM + "title").text = "DeepGreen Bulk Deposit"
+        for name, note_id, error in results:
+            if error is None:
+                receipt = self._make_receipt(note_id, deposit.packaging, "Notification has been accepted for routing").serialise()
+                entry = etree.fromstring(receipt.encode("utf-8") if isinstance(receipt, unicode) else receipt)
+                etree.SubElement(entry, ATOM + "category", scheme="http://purl.org/net/sword/terms/bulk", term="created", label=name)
+            else:
+                entry = etree.Element(ATOM + "entry")
+                etree.SubElement(entry, ATOM + "title").text = name
+                etree.SubElement(entry, ATOM + "summary").text = error.message if error.message else unicode(error)
+                etree.SubElement(entry, SWORD + "treatment").text = "Notification could not be created"
+                etree.SubElement(entry, ATOM + "category", scheme="http://purl.org/net/sword/terms/bulk", term="error", label=name)
+            feed.append(entry)
+
+        created = len([r for r in results if r[2] is None])
+        app.logger.info(u"Bulk deposit created %s of %s notifications", created, len(results))
+        return etree.tostring(feed, xml_declaration=True, encoding="utf-8")
+
     def _get_deposit_receipt(self, path):
         """
         Get a deposit receipt for the notificiation identified by the path
@@ -387,13 +1135,64 @@ class JperSword(SwordServer):
         cached = self._cache_notification(path)
         if not cached:
             raise SwordError(status=404, empty=True)
+
+        if path in self.spooled:
+            item = self.spooled[path]
+            treatment = "Notification has been received, and will be delivered for routing shortly"
+            if item["state"] == spool.FAILED:
+                treatment = u"Notification could not be delivered for routing: {x}".format(x=item["error"])
+            return self._make_receipt(path, item["packaging"], treatment).serialise()
+
         note = self.notes[path]
         ad = note.analysis_date
+        state = "pending"
         treatment = "Notification has been accepted for routing"
         if ad is not None:
+            state = "routed"
             treatment = "Notification has been routed for appropriate repositories"
-        receipt = self._make_receipt(note.id, note.packaging_format, treatment)
-        return receipt.serialise()
+        key = ("receipt", path, state, "application/atom+xml;type=entry")
+        return self._render_cached(key, note, lambda: self._make_receipt(note.id, note.packaging_format, treatment).serialise())
+
+    def _render_cached(self, key, note, render):
+        """
+        Get a rendered document from the process-wide cache of rendered documents, rendering and caching it if
+        necessary, and mark the response as conditional on its ETag and on the last time the notification changed
+
+        :param key: the cache key, which must capture everything the rendered document depends on
+        :param note: the notification the document describes
+        :param render: function which renders the document
+        :return: the rendered document
+        """
+        def render_tagged():
+            doc = render()
+            if doc is None:
+                return None
+            return (doc, etag(doc))
+
+        cached = rendered_cache().get_or_set(key, render_tagged)
+        if cached is None:
+            return None
+        responses.conditional(etag=cached[1], last_modified=self._last_modified(note))
+        return cached[0]
+
+    def _last_modified(self, note):
+        """
+        Get the time at which the notification last changed state: when it was routed, or if it has not been
+        routed yet, when it was created
+
+        :param note: the notification
+        :return: the datetime, or None if it is not known
+        """
+        for d in [note.analysis_date, note.created_date]:
+            if d is None:
+                continue
+            if isinstance(d, datetime):
+                return d
+            try:
+                return datetime.strptime(d, "%Y-%m-%dT%H:%M:%SZ")
+            except ValueError:
+                pass
+        return None
 
 
     #############################################
@@ -401,12 +1200,6 @@ class JperSword(SwordServer):
     ## Integration, and which are therefore not implemented
     ## Left here to remind us
 
-    def list_collection(self, path):
-        """
-        NOT IMPLEMENTED
-        """
-        raise NotImplementedError()
-
     def replace(self, path, deposit):
         """
         NOT IMPLEMENTED
@@ -441,7 +1234,17 @@ class JperSword(SwordServer):
 class URIManager(object):
     """
     Class for providing a single point of access to all identifiers used by SSS
+
+    Each url is resolved with url_for only once per route (and base url), with a placeholder in place of the
+    id.  The result is kept as a template, so building a url after that is just a matter of inserting the
+    escaped id into it.
     """
+    ID_PLACEHOLDER = "SWORDIDPLACEHOLDER"
+    """stands in for the id when resolving a route, and is left untouched by url escaping"""
+
+    _templates = {}
+    """url templates, as tuples of the url before and after the id, keyed by base url, endpoint and any other route arguments"""
+
     def __init__(self, config):
         self.configuration = config
 
@@ -460,7 +1263,7 @@ class URIManager(object):
 
         :return: the url for the service doc
         """
-        return self.configuration.base_url[:-1] + url_for("swordv2_server.service_document")
+        return self._uri("swordv2_server.service_document")
 
     def col_uri(self, id):
         """
@@ -469,7 +1272,7 @@ class URIManager(object):
         :param id: the id of the collection (validate/notify)
         :return: the url to the collection
         """
-        return self.configuration.base_url[:-1] + url_for("swordv2_server.collection", collection_id=id)
+        return self._uri("swordv2_server.collection", "collection_id", id)
 
     def edit_uri(self, id):
         """
@@ -478,7 +1281,7 @@ class URIManager(object):
         :param id: the id of the notification
         :return: the url for the container
         """
-        return self.configuration.base_url[:-1] + url_for("swordv2_server.entry", entry_id=id)
+        return self._uri("swordv2_server.entry", "entry_id", id)
 
     def em_uri(self, id):
         """
@@ -487,7 +1290,7 @@ class URIManager(object):
         :param id: the id of the notification
         :return: the url for media resource in the container
         """
-        return self.configuration.base_url[:-1] + url_for("swordv2_server.content", entry_id=id)
+        return self._uri("swordv2_server.content", "entry_id", id)
 
     def cont_uri(self, id):
         """
@@ -506,7 +1309,7 @@ class URIManager(object):
         :param type: the type of statement (e.g. atom/rdf)
         :return: the url for the statment
         """
-        return self.configuration.base_url[:-1] + url_for("swordv2_server.statement", entry_id=id, type=type)
+        return self._uri("swordv2_server.statement", "entry_id", id, type=type)
 
     def agg_uri(self, id):
         """
@@ -517,3 +1320,29 @@ class URIManager(object):
         """
         return "tag:aggregation@deepgreen/" + id
 
+    def _uri(self, endpoint, id_arg=None, id=None, **kwargs):
+        """
+        Build the url for a route, from its template if it has already been resolved, or by resolving it with
+        url_for and keeping the template for next time
+
+        :param endpoint: the flask endpoint for the route
+        :param id_arg: the name of the route argument which carries the id, if any
+        :param id: the id to put in the url
+        :param kwargs: any other route arguments, which become part of the template
+        :return: the full url
+        """
+        key = (self.configuration.base_url, endpoint, tuple(sorted(kwargs.items())))
+        template = URIManager._templates.get(key)
+        if template is None:
+            if id_arg is not None:
+                kwargs[id_arg] = self.ID_PLACEHOLDER
+            url = self.configuration.base_url[:-1] + url_for(endpoint, **kwargs)
+            template = tuple(url.split(self.ID_PLACEHOLDER, 1)) if id_arg is not None else (url, "")
+            URIManager._templates[key] = template
+
+        if id_arg is None:
+            return template[0]
+        # escape the id in the same way as url_for does
+        if isinstance(id, unicode):
+            id = id.encode("utf-8")
+        return template[0] + quote(id, safe="/:") + template[1]
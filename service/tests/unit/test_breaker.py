@@ -0,0 +1,178 @@
+"""
+Unit tests for the circuit breaker guarding JPER, and the retry policy of requests to JPER
+"""
+import time, unittest
+
+import requests
+
+from octopus.core import app
+from octopus.modules.jper import client, models
+from service import breaker, passthrough, upstream
+
+class StubResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def close(self):
+        pass
+
+class StubSession(object):
+    """
+    Stand-in for the shared requests.Session, which counts the requests made and answers them all in the same way
+    """
+    def __init__(self, status_code=None):
+        self.status_code = status_code
+        self.requests = []
+
+    def request(self, method, url, params=None, **kwargs):
+        self.requests.append(method)
+        if self.status_code is None:
+            raise requests.exceptions.ConnectionError("connection refused")
+        return StubResponse(self.status_code)
+
+class FakeTime(object):
+    """
+    Stand-in for the time module as used by service.upstream, which records backoffs rather than sleeping
+    """
+    def __init__(self):
+        self.sleeps = []
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+class TestBreaker(unittest.TestCase):
+
+    def test_01_opens_after_threshold(self):
+        b = breaker.CircuitBreaker("test", threshold=3, reset_timeout=30)
+        for i in range(2):
+            self.assertTrue(b.allow())
+            b.failure()
+        self.assertEqual(b.state, breaker.CLOSED)
+        self.assertTrue(b.allow())
+        b.failure()
+        self.assertEqual(b.state, breaker.OPEN)
+        self.assertFalse(b.allow())
+        self.assertTrue(1 <= b.retry_after() <= 30)
+
+    def test_02_success_resets_consecutive_failures(self):
+        b = breaker.CircuitBreaker("test", threshold=3, reset_timeout=30)
+        b.failure()
+        b.failure()
+        b.success()
+        b.failure()
+        b.failure()
+        self.assertEqual(b.state, breaker.CLOSED)
+
+    def test_03_half_open_recovery(self):
+        b = breaker.CircuitBreaker("test", threshold=1, reset_timeout=0)
+        b.failure()
+        self.assertEqual(b.state, breaker.OPEN)
+
+        # once the reset timeout has passed, one trial call is let through, and the rest refused until it finishes
+        self.assertTrue(b.allow())
+        self.assertEqual(b.state, breaker.HALF_OPEN)
+        self.assertFalse(b.allow())
+        b.success()
+        self.assertEqual(b.state, breaker.CLOSED)
+        self.assertTrue(b.allow())
+
+    def test_04_failed_trial_reopens(self):
+        b = breaker.CircuitBreaker("test", threshold=1, reset_timeout=0)
+        b.failure()
+        self.assertTrue(b.allow())
+        b.failure()
+        self.assertEqual(b.state, breaker.OPEN)
+        self.assertEqual(b.trips, 2)
+
+class TestRequestPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.config = dict([(k, app.config.get(k)) for k in ["JPER_RETRIES", "JPER_BREAKER_THRESHOLD", "JPER_BREAKER_RESET_TIMEOUT"]])
+        app.config["JPER_RETRIES"] = 2
+        app.config["JPER_BREAKER_THRESHOLD"] = 3
+        app.config["JPER_BREAKER_RESET_TIMEOUT"] = 30
+        breaker._breakers.pop("jper", None)
+
+        self.old_session = upstream.session
+        self.session = StubSession()
+        upstream.session = lambda: self.session
+        self.old_time = upstream.time
+        upstream.time = FakeTime()
+
+        self.jper = upstream.JPERClient(api_key="api-key", base_url="http://jper.test/api/v1")
+
+    def tearDown(self):
+        upstream.session = self.old_session
+        upstream.time = self.old_time
+        breaker._breakers.pop("jper", None)
+        for k, v in self.config.items():
+            if v is None:
+                app.config.pop(k, None)
+            else:
+                app.config[k] = v
+
+    def test_01_reads_are_retried_with_jitter(self):
+        with self.assertRaises(client.JPERConnectionException):
+            self.jper.get_notification(notification_id="1234")
+        self.assertEqual(self.session.requests, ["GET"] * 3)
+
+        sleeps = upstream.time.sleeps
+        self.assertEqual(len(sleeps), 2)
+        backoff = app.config.get("JPER_RETRY_BACKOFF", 0.1)
+        self.assertTrue(backoff * 0.5 <= sleeps[0] <= backoff)
+        self.assertTrue(backoff * 2 * 0.5 <= sleeps[1] <= backoff * 2)
+
+    def test_02_server_errors_on_reads_are_retried_then_503(self):
+        # with the breaker still closed, the client is told to try again straight away
+        app.config["JPER_BREAKER_THRESHOLD"] = 10
+        self.session.status_code = 503
+        with self.assertRaises(client.JPERConnectionException) as cm:
+            self.jper.get_notification(notification_id="1234")
+        self.assertEqual(self.session.requests, ["GET"] * 3)
+
+        with app.test_request_context("/sword/entry/1234"):
+            resp = passthrough.upstream_unavailable(cm.exception)
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers.get("Retry-After"), "1")
+
+    def test_03_creates_are_not_retried(self):
+        note = models.IncomingNotification()
+        with self.assertRaises(client.JPERConnectionException):
+            self.jper.create_notification(note)
+        self.assertEqual(self.session.requests, ["POST"])
+        self.assertEqual(upstream.time.sleeps, [])
+
+        self.session.status_code = 503
+        with self.assertRaises(client.JPERConnectionException):
+            self.jper.create_notification(note)
+        self.assertEqual(self.session.requests, ["POST", "POST"])
+
+    def test_04_open_breaker_refuses_requests(self):
+        for i in range(3):
+            with self.assertRaises(client.JPERConnectionException):
+                self.jper.create_notification(models.IncomingNotification())
+        self.assertEqual(upstream.jper_breaker().state, breaker.OPEN)
+
+        with self.assertRaises(upstream.JPERUnavailableException) as cm:
+            self.jper.get_notification(notification_id="1234")
+        self.assertEqual(len(self.session.requests), 3)
+        self.assertTrue(1 <= cm.exception.retry_after <= 30)
+
+    def test_05_unavailable_is_503_with_retry_after(self):
+        with app.test_request_context("/sword/collection/notify"):
+            resp = passthrough.upstream_unavailable(upstream.JPERUnavailableException(u"unavailable", 17))
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers.get("Retry-After"), "17")
+
+    def test_06_exhausted_retries_are_503(self):
+        # with the breaker still closed, the client is told to try again straight away
+        app.config["JPER_BREAKER_THRESHOLD"] = 10
+        with self.assertRaises(client.JPERConnectionException) as cm:
+            self.jper.get_notification(notification_id="1234")
+        with app.test_request_context("/sword/collection/notify"):
+            resp = passthrough.upstream_unavailable(cm.exception)
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers.get("Retry-After"), "1")
@@ -0,0 +1,88 @@
+"""
+Unit tests for bulk deposits, in which each package of a zip file of packages becomes its own notification
+"""
+import io, unittest, uuid, zipfile
+
+from lxml import etree
+from sss.core import DepositRequest
+
+from octopus.core import app
+from octopus.modules.jper import client
+from service import sword
+
+PACKAGING = "https://datahub.deepgreen.org/FilesAndJATS"
+
+class StubReceipt(object):
+    def __init__(self, id):
+        self.id = id
+
+    def serialise(self):
+        return '<entry xmlns="http://www.w3.org/2005/Atom"><id>' + self.id + '</id></entry>'
+
+class StubJPER(object):
+    """
+    Stand-in for the JPER client, which refuses packages containing "bad" and creates a notification for any other
+    """
+    def __init__(self):
+        self.created = []
+
+    def create_notification(self, notification, file_handle=None):
+        content = file_handle.read()
+        if "bad" in content:
+            raise client.ValidationException(u"Package is not valid")
+        note_id = "note-" + str(len(self.created) + 1)
+        self.created.append(note_id)
+        return note_id, "http://jper.test/api/v1/notification/" + note_id
+
+def bulk_zip(members):
+    data = io.BytesIO()
+    z = zipfile.ZipFile(data, "w")
+    for name, content in members:
+        z.writestr(name, content)
+    z.close()
+    data.seek(0)
+    return data
+
+def make_sword():
+    s = sword.JperSword.__new__(sword.JperSword)
+    s.auth_credentials = sword.JperAuth("user", None, "api-key-" + uuid.uuid4().hex)
+    s.notes = {}
+    s.spooled = {}
+    s.digests = {}
+    s._make_receipt = lambda id, packaging, treatment: StubReceipt(id)
+    return s
+
+class TestBulkDeposit(unittest.TestCase):
+
+    def setUp(self):
+        self.config = dict([(k, app.config.get(k)) for k in ["DEPOSIT_DEDUP", "PACKAGE_PRECHECK"]])
+        app.config["DEPOSIT_DEDUP"] = False
+        app.config["PACKAGE_PRECHECK"] = False
+
+    def tearDown(self):
+        for k, v in self.config.items():
+            app.config[k] = v
+
+    def _deposit(self, members):
+        s = make_sword()
+        deposit = DepositRequest()
+        deposit.auth = s.auth_credentials
+        deposit.packaging = PACKAGING
+        deposit.content_file = bulk_zip(members)
+        jper = StubJPER()
+        with app.test_request_context("/sword/collection/bulk", method="POST"):
+            feed = etree.fromstring(s._deposit_bulk(jper, deposit))
+        categories = feed.findall(".//" + sword.ATOM + "category")
+        return jper, dict([(c.get("label"), c.get("term")) for c in categories])
+
+    def test_01_created_and_rejected(self):
+        jper, outcomes = self._deposit([("good.zip", "good package"), ("bad.zip", "bad package")])
+        self.assertEqual(jper.created, ["note-1"])
+        self.assertEqual(outcomes, {"good.zip" : "created", "bad.zip" : "error"})
+
+    def test_02_hidden_members_and_directories_are_skipped(self):
+        jper, outcomes = self._deposit([("packages/", ""), ("packages/good.zip", "good package"),
+                                        ("__MACOSX/packages/._good.zip", "resource fork"),
+                                        (".hidden.zip", "hidden"), ("notes.txt", "not a package")])
+        self.assertEqual(jper.created, ["note-1"])
+        self.assertEqual(outcomes, {"packages/good.zip" : "created"})
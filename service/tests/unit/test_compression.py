@@ -0,0 +1,55 @@
+"""
+Unit tests for the order in which responses are compressed, answered with a 304, and recorded in the metrics
+"""
+import unittest
+
+from flask import Response
+
+from octopus.core import app
+from service import compression, metrics, responses
+
+ETAG = "0123456789abcdef"
+BODY = "<feed>" + "<entry>statement</entry>" * 200 + "</feed>"
+
+def send(headers):
+    """
+    Run a conditional XML response through the after_request handlers, in the order service.web runs them
+    """
+    with app.test_request_context("/sword/entry/1234/statement/atom", headers=headers):
+        responses.conditional(etag=ETAG)
+        resp = Response(BODY, mimetype="application/atom+xml")
+        for handler in [responses.apply_headers, compression.compress_response, responses.conditional_response]:
+            resp = handler(resp)
+        return resp
+
+class TestCompression(unittest.TestCase):
+
+    def test_01_handlers_run_in_order(self):
+        from service import web
+        # flask runs after_request handlers in the reverse of the order they were registered
+        handlers = list(reversed(app.after_request_funcs[None]))
+        order = [handlers.index(h) for h in [responses.apply_headers, compression.compress_response,
+                                             responses.conditional_response, metrics.record_request]]
+        self.assertEqual(order, sorted(order))
+
+    def test_02_compressed(self):
+        resp = send({"Accept-Encoding" : "gzip"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers.get("Content-Encoding"), "gzip")
+        self.assertEqual(resp.get_etag()[0], ETAG + "-gzip")
+        self.assertIn("Accept-Encoding", resp.vary)
+
+    def test_03_not_modified_compressed(self):
+        resp = send({"Accept-Encoding" : "gzip", "If-None-Match" : '"' + ETAG + '-gzip"'})
+        self.assertEqual(resp.status_code, 304)
+        self.assertIn("Accept-Encoding", resp.vary)
+
+    def test_04_not_modified_uncompressed(self):
+        resp = send({"If-None-Match" : '"' + ETAG + '"'})
+        self.assertEqual(resp.status_code, 304)
+        self.assertIn("Accept-Encoding", resp.vary)
+
+    def test_05_uncompressed_etag_does_not_match_compressed_variant(self):
+        resp = send({"Accept-Encoding" : "gzip", "If-None-Match" : '"' + ETAG + '"'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers.get("Content-Encoding"), "gzip")
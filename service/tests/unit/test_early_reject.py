@@ -0,0 +1,30 @@
+"""
+Unit tests for refusing deposits before their body has been read
+"""
+import unittest
+
+from octopus.core import app
+from service import passthrough
+
+class TestEarlyReject(unittest.TestCase):
+
+    def setUp(self):
+        self.limit = app.config.get("EARLY_REJECT_DRAIN_LIMIT")
+        app.config["EARLY_REJECT_DRAIN_LIMIT"] = 1000
+
+    def tearDown(self):
+        app.config["EARLY_REJECT_DRAIN_LIMIT"] = self.limit
+
+    def _refuse(self, data):
+        with app.test_request_context("/sword/collection/missing", method="POST", data=data):
+            return passthrough._early_response(404)
+
+    def test_01_small_body_is_drained(self):
+        resp = self._refuse("x" * 1000)
+        self.assertEqual(resp.status_code, 404)
+        self.assertIsNone(resp.headers.get("Connection"))
+
+    def test_02_large_body_closes_connection(self):
+        resp = self._refuse("x" * 1001)
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.headers.get("Connection"), "close")
@@ -0,0 +1,124 @@
+"""
+Unit tests for the coalescing of concurrent requests to JPER for the same notification
+"""
+import threading, time, unittest, uuid
+
+from service import cache, sword
+
+THREADS = 10
+
+class StubNotification(object):
+    """
+    Just enough of a notification for the notification cache and existence index
+    """
+    analysis_date = None
+
+    def get_urls(self, type=None):
+        return []
+
+class CountingClient(object):
+    """
+    Stand-in for the JPER client which counts the notifications requested, and holds each request until released
+    """
+    def __init__(self, exists=True):
+        self.exists = exists
+        self.calls = 0
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+
+    def get_notification(self, notification_id=None):
+        with self._lock:
+            self.calls += 1
+        self.release.wait(10)
+        return StubNotification() if self.exists else None
+
+def make_sword(client):
+    """
+    Make a JperSword which talks to the given client, without the configuration of a real request
+    """
+    s = sword.JperSword.__new__(sword.JperSword)
+    s.auth_credentials = sword.JperAuth("user", None, "api-key-" + uuid.uuid4().hex)
+    s.jper = client
+    s.notes = {}
+    s.spooled = {}
+    return s
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("timed out waiting for the threads")
+        time.sleep(0.01)
+
+class TestNotificationFetches(unittest.TestCase):
+
+    def _lookup_concurrently(self, client, path):
+        followers = sword._notification_fetches.stats()["followers"]
+        results = [None] * THREADS
+        # every thread uses the same credentials, as they would be for one user's requests
+        credentials = make_sword(client).auth_credentials
+
+        def lookup(i):
+            s = make_sword(client)
+            s.auth_credentials = credentials
+            results[i] = s._cache_notification(path)
+
+        threads = [threading.Thread(target=lookup, args=(i,)) for i in range(THREADS)]
+        for t in threads:
+            t.start()
+        # hold the request to JPER until every other thread is waiting for it
+        wait_for(lambda: sword._notification_fetches.stats()["followers"] - followers == THREADS - 1)
+        client.release.set()
+        for t in threads:
+            t.join(10)
+        return results
+
+    def test_01_concurrent_lookups_make_one_request(self):
+        client = CountingClient()
+        results = self._lookup_concurrently(client, uuid.uuid4().hex)
+        self.assertEqual(client.calls, 1)
+        self.assertEqual(results, [True] * THREADS)
+
+    def test_02_concurrent_lookups_of_missing_notification_make_one_request(self):
+        client = CountingClient(exists=False)
+        results = self._lookup_concurrently(client, uuid.uuid4().hex)
+        self.assertEqual(client.calls, 1)
+        self.assertEqual(results, [False] * THREADS)
+
+    def test_03_later_lookup_is_served_from_cache(self):
+        client = CountingClient()
+        client.release.set()
+        s = make_sword(client)
+        path = uuid.uuid4().hex
+        self.assertTrue(s._cache_notification(path))
+        s.notes = {}
+        self.assertTrue(s._cache_notification(path))
+        self.assertEqual(client.calls, 1)
+
+    def test_04_single_flight_shares_result_and_exception(self):
+        sf = cache.SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def work():
+            calls.append(1)
+            release.wait(10)
+            raise ValueError("failed")
+
+        def call():
+            try:
+                sf.do("key", work)
+            except ValueError as e:
+                results.append(e.message)
+
+        threads = [threading.Thread(target=call) for i in range(THREADS)]
+        for t in threads:
+            t.start()
+        wait_for(lambda: sf.stats()["followers"] == THREADS - 1)
+        release.set()
+        for t in threads:
+            t.join(10)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["failed"] * THREADS)
+        self.assertEqual(sf.stats()["in_flight"], 0)
@@ -0,0 +1,117 @@
+"""
+Unit tests for the package cache serving packages only to the accounts JPER lets retrieve them
+"""
+import os, shutil, tempfile, unittest
+
+from sss.core import SwordError
+
+from service import packages, sword
+
+PACKAGE_URL = "http://jper.test/api/v1/notification/1234/content"
+PACKAGE = "PK" + "x" * 1000
+
+class StubContent(object):
+    """
+    Stand-in for the streaming response to a request for a package
+    """
+    def __init__(self, data):
+        self.data = data
+        self.headers = {"Content-Length" : str(len(data)), "Content-Type" : "application/zip"}
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+class StubJPER(object):
+    """
+    Stand-in for the JPER client of one account, which may or may not be allowed the package, and counts the
+    requests made for it
+    """
+    def __init__(self, api_key, allowed):
+        self.api_key = api_key
+        self.allowed = allowed
+        self.downloads = 0
+        self.checks = 0
+
+    def get_content(self, url):
+        self.downloads += 1
+        return StubContent(PACKAGE) if self.allowed else None
+
+    def content_accessible(self, url):
+        self.checks += 1
+        return self.allowed
+
+class StubNotification(object):
+    analysis_date = "2026-01-01T00:00:00Z"
+
+    def get_urls(self, type=None):
+        return [PACKAGE_URL]
+
+class TestPackageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="sword-test-packages-")
+        self.pc = packages.PackageCache(os.path.join(self.directory, "packages"),
+                                        os.path.join(self.directory, "packages.sqlite"), 10485760)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_01_download_grants_access(self):
+        owner = StubJPER("owner-key", True)
+        entry = self.pc.fetch(PACKAGE_URL, owner)
+        self.assertEqual(entry["size"], len(PACKAGE))
+        self.assertEqual(owner.downloads, 1)
+
+        # served from the cache from then on, without asking JPER
+        self.assertEqual(self.pc.fetch(PACKAGE_URL, owner)["key"], entry["key"])
+        self.assertEqual(owner.downloads, 1)
+        self.assertEqual(owner.checks, 0)
+
+    def test_02_other_account_without_access_is_refused(self):
+        self.pc.fetch(PACKAGE_URL, StubJPER("owner-key", True))
+
+        other = StubJPER("other-key", False)
+        self.assertIsNone(self.pc.fetch(PACKAGE_URL, other))
+        self.assertEqual(other.checks, 1)
+        self.assertEqual(other.downloads, 0)
+
+        # the cached package is still there for the account which may have it
+        self.assertIsNotNone(self.pc.get(PACKAGE_URL))
+
+    def test_03_other_account_with_access_is_checked_once(self):
+        self.pc.fetch(PACKAGE_URL, StubJPER("owner-key", True))
+
+        other = StubJPER("other-key", True)
+        self.assertIsNotNone(self.pc.fetch(PACKAGE_URL, other))
+        self.assertIsNotNone(self.pc.fetch(PACKAGE_URL, other))
+        self.assertEqual(other.checks, 1)
+        self.assertEqual(other.downloads, 0)
+
+    def test_04_access_is_checked_again_once_stale(self):
+        self.pc.access_ttl = -1
+        owner = StubJPER("owner-key", True)
+        self.pc.fetch(PACKAGE_URL, owner)
+        owner.allowed = False
+        self.assertIsNone(self.pc.fetch(PACKAGE_URL, owner))
+        self.assertEqual(owner.checks, 1)
+
+    def test_05_sword_answers_404_to_account_without_access(self):
+        self.pc.fetch(PACKAGE_URL, StubJPER("owner-key", True))
+
+        old = packages._package_cache
+        packages._package_cache = self.pc
+        try:
+            s = sword.JperSword.__new__(sword.JperSword)
+            s.auth_credentials = sword.JperAuth("other", None, "other-key")
+            s.jper = StubJPER("other-key", False)
+            s.notes = {"1234" : StubNotification()}
+            s.spooled = {}
+            with self.assertRaises(SwordError) as cm:
+                s.get_package("1234")
+            self.assertEqual(cm.exception.status, 404)
+        finally:
+            packages._package_cache = old
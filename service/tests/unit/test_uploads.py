@@ -0,0 +1,47 @@
+"""
+Unit tests for receiving deposits with service.uploads, and sending them on to JPER with their length
+"""
+import io, unittest
+
+from service import uploads, upstream
+
+class ReadOnlyStream(object):
+    """
+    Stream which can only be read, like the body of a request under gunicorn
+    """
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.data.read(size)
+
+class TestUploads(unittest.TestCase):
+
+    def setUp(self):
+        self.jper = upstream.JPERClient(api_key="api-key", base_url="http://jper.test/api/v1")
+
+    def test_01_memory_body_has_length(self):
+        data = b"x" * 1000
+        body = uploads.receive(ReadOnlyStream(data), len(data), threshold=4096, buffer_size=256)
+        self.assertEqual(self.jper._content_length(body), len(data))
+        self.assertEqual(body.read(), data)
+
+    def test_02_file_body_has_length(self):
+        data = b"x" * 10000
+        body = uploads.receive(ReadOnlyStream(data), None, threshold=4096, buffer_size=256)
+        self.assertEqual(self.jper._content_length(body), len(data))
+        body.close()
+
+    def test_03_length_is_what_remains(self):
+        data = b"x" * 1000
+        body = uploads.receive(ReadOnlyStream(data), len(data), threshold=4096)
+        body.read(100)
+        self.assertEqual(self.jper._content_length(body), 900)
+        self.assertEqual(len(body.read()), 900)
+
+    def test_04_unseekable_stream_has_no_length(self):
+        self.assertIsNone(self.jper._content_length(ReadOnlyStream(b"x" * 1000)))
+
+    def test_05_too_large(self):
+        with self.assertRaises(uploads.UploadTooLargeException):
+            uploads.receive(ReadOnlyStream(b"x" * 1000), None, threshold=4096, max_size=500)
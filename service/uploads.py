@@ -0,0 +1,168 @@
+"""
+Receiving the bodies of deposits, and reading them back to send to JPER, with as little work per byte as possible
+
+When DEPOSIT_BUFFERING is enabled, deposits are received by passthrough.stream_deposit with receive, rather than
+by the swordv2 blueprint, which copies each one to its temporary directory in small pieces.  receive reads the
+body in large blocks straight into a preallocated buffer, with readinto where the stream supports it.  A body
+no larger than the memory threshold is kept in memory; a larger one, or one of unknown length which turns out to
+be larger, is written to an anonymous temporary file as it arrives.  Either way, the deposit can then be read as
+many times as needed, so the local package checks and deduplication work as they do for the blueprint.
+
+mapped_chunks reads a file which is on disk through a memory map, in large blocks, so that sending it to JPER
+does not go through a read call for each block.  Python 2 has no os.sendfile, and the body of a request to JPER
+is a multipart document rather than the bare file, so the bytes are still copied into the request, but only
+once, and in C.
+
+This module does not depend on the application, so that service/scripts/bench_uploads.py can measure it alone.
+"""
+
+import cStringIO, mmap, os, tempfile
+
+class UploadTooLargeException(Exception):
+    """
+    Exception raised when the body of a request turns out to be larger than the limit on deposits
+    """
+    pass
+
+class CappedStream(object):
+    """
+    Wrapper for a stream of unknown length, such as a chunked request body, which refuses to be read beyond a
+    maximum size
+    """
+    def __init__(self, stream, max_size):
+        """
+        :param stream: the stream
+        :param max_size: the maximum number of bytes which may be read from it
+        """
+        self.stream = stream
+        self.max_size = max_size
+        self.received = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.received += len(data)
+        if self.received > self.max_size:
+            raise UploadTooLargeException(u"Upload exceeds the maximum size of {x} bytes".format(x=self.max_size))
+        return data
+
+def receive(stream, length=None, threshold=8388608, buffer_size=1048576, directory=None, max_size=None):
+    """
+    Receive the body of a request, into memory if it is no larger than the threshold, and into a temporary file
+    otherwise
+
+    :param stream: the stream of the request body
+    :param length: the length of the body, if known from the Content-Length
+    :param threshold: largest body, in bytes, to keep in memory
+    :param buffer_size: size of the blocks to read the body in
+    :param directory: directory to create the temporary file in; the system default if not given
+    :param max_size: largest body to accept, or None for no limit
+    :return: seekable file-like object holding the body, positioned at its start
+    """
+    if length is not None and length > threshold:
+        return _receive_to_file(stream, memoryview(b""), buffer_size, directory, max_size)
+
+    capacity = threshold if length is None else length
+    buf = bytearray(capacity)
+    view = memoryview(buf)
+    received = 0
+    while received < capacity:
+        n = readinto(stream, view[received:received + buffer_size])
+        if n == 0:
+            break
+        received += n
+
+    if length is None and received == capacity:
+        # there may be more to come, which will not fit in memory
+        return _receive_to_file(stream, view[:received], buffer_size, directory, max_size)
+    if max_size is not None and received > max_size:
+        raise UploadTooLargeException(u"Upload exceeds the maximum size of {x} bytes".format(x=max_size))
+
+    del view
+    if received < capacity:
+        del buf[received:]
+    # cStringIO reads straight from the buffer, where io.BytesIO would copy it
+    return cStringIO.StringIO(buf)
+
+def _receive_to_file(stream, head, buffer_size, directory, max_size):
+    """
+    Receive the rest of the body of a request into a temporary file, which is removed when it is closed
+
+    :param head: what has been received already
+    :return: the file, positioned at its start
+    """
+    f = tempfile.TemporaryFile(dir=directory)
+    try:
+        f.write(head)
+        received = len(head)
+        buf = bytearray(buffer_size)
+        view = memoryview(buf)
+        while True:
+            n = readinto(stream, view)
+            if n == 0:
+                break
+            received += n
+            if max_size is not None and received > max_size:
+                raise UploadTooLargeException(u"Upload exceeds the maximum size of {x} bytes".format(x=max_size))
+            f.write(view[:n])
+        f.seek(0)
+        return f
+    except:
+        f.close()
+        raise
+
+def readinto(stream, view):
+    """
+    Read from a stream into a buffer, without an intermediate copy if the stream supports readinto
+
+    :param stream: the stream
+    :param view: memoryview of the buffer to fill
+    :return: the number of bytes read, which is 0 only at the end of the stream
+    """
+    if hasattr(stream, "readinto"):
+        return stream.readinto(view)
+    data = stream.read(len(view))
+    n = len(data)
+    view[:n] = data
+    return n
+
+def read_chunks(file_handle, chunk_size):
+    """
+    Read the remainder of a file-like object in chunks
+
+    :param file_handle: the file-like object
+    :param chunk_size: size of the chunks to read
+    :return: generator over the chunks
+    """
+    while True:
+        chunk = file_handle.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def mapped_chunks(file_handle, chunk_size):
+    """
+    Read the remainder of a file in chunks through a memory map, if it is a file on disk
+
+    :param file_handle: the file-like object
+    :param chunk_size: size of the chunks to read
+    :return: generator over the chunks, or None if the file can't be memory mapped
+    """
+    try:
+        fd = file_handle.fileno()
+        start = file_handle.tell()
+        size = os.fstat(fd).st_size
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    if size <= start:
+        return None
+    return _mapped_chunks(file_handle, fd, start, size, chunk_size)
+
+def _mapped_chunks(file_handle, fd, start, size, chunk_size):
+    m = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    try:
+        for offset in xrange(start, size, chunk_size):
+            yield m[offset:offset + chunk_size]
+    finally:
+        m.close()
+        # leave the file where reading it to the end would have
+        file_handle.seek(size)
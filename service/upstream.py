@@ -0,0 +1,501 @@
+"""
+Pooled HTTP access to the JPER API
+
+The octopus JPER client opens a new connection for every call it makes.  This module provides a subclass of that
+client which sends all of its requests through a single application-scoped requests.Session, so that connections
+to JPER_BASE_URL are pooled and kept alive between requests, and between users.  Only the API key varies from
+one client to the next, so clients are cheap to create, and get_client should be used to obtain one.
+
+Every request is made under a policy: a connect and read timeout for the operation, retries with jittered
+backoff for reads, which are safe to repeat, and a circuit breaker.  When JPER has failed repeatedly the breaker
+opens, and requests fail at once with a JPERUnavailableException rather than each tying up a worker until it
+times out.
+"""
+
+import json, os, random, threading, time, uuid
+from urllib import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from octopus.core import app
+from octopus.modules.jper import client, models
+from service import breaker, metrics, uploads
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+def session():
+    """
+    Get the shared HTTP session used for all requests to JPER, creating it on first use
+
+    The size of the connection pool is set by JPER_POOL_SIZE, and should be at least as large as the number of
+    concurrent requests a single worker process may make.
+
+    :return: the requests.Session
+    """
+    global _session, _session_pid
+    # a session created before a fork (e.g. by a preloaded gunicorn master) must not share its connections with
+    # the forked worker, so each process creates its own
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                pool_size = app.config.get("JPER_POOL_SIZE", 10)
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                _session = s
+                _session_pid = os.getpid()
+    return _session
+
+class SizedStream(object):
+    """
+    Wrapper for a stream whose length is known in advance, but which can't report it itself (such as the body of
+    an incoming request), so that it can be forwarded to JPER with a Content-Length
+    """
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+class MultipartBody(object):
+    """
+    The body of a multipart upload to JPER: the preamble, the content read from a file handle, and the closing
+    boundary.  Iterating over it gives the body in chunks, for chunked transfer encoding.  If the length of the
+    content is known, it also has a length and can be read like a file, which is how a body sent with a
+    Content-Length is read by httplib.  Once it has all been sent, the throughput achieved is logged.
+    """
+    def __init__(self, head, file_handle, tail, length, chunk_size, operation):
+        """
+        :param head: the multipart preamble, up to the start of the content
+        :param file_handle: file-like object holding the content package
+        :param tail: the multipart closing boundary
+        :param length: the number of bytes of content to be read from the file handle, or None if not known
+        :param chunk_size: size of the chunks to read the content in
+        :param operation: the name of the operation, under which the bytes sent are counted
+        """
+        self.head = head
+        self.file_handle = file_handle
+        self.tail = tail
+        self.length = length
+        self.chunk_size = chunk_size
+        self.operation = operation
+        self._chunks = None
+        self._chunk = ""
+        self._pos = 0
+
+    def __len__(self):
+        return len(self.head) + self.length + len(self.tail)
+
+    def __iter__(self):
+        sent = 0
+        start = time.time()
+        yield self.head
+        # content which is on disk is read through a memory map, rather than a read call for each chunk
+        chunks = uploads.mapped_chunks(self.file_handle, self.chunk_size)
+        if chunks is None:
+            chunks = uploads.read_chunks(self.file_handle, self.chunk_size)
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+        yield self.tail
+        metrics.UPLOAD_BYTES.labels(self.operation).inc(sent)
+        elapsed = max(time.time() - start, 0.000001)
+        app.logger.info(u"Sent %s bytes of content to JPER in %.3fs (%.0f bytes/sec)", sent, elapsed, sent / elapsed)
+
+    def read(self, size=-1):
+        """
+        Read the next part of the body, of at most the given size
+
+        :param size: the maximum number of bytes to return, or -1 for the next chunk
+        :return: the bytes, or an empty string at the end of the body
+        """
+        if self._chunks is None:
+            self._chunks = iter(self)
+        while self._pos >= len(self._chunk):
+            try:
+                self._chunk = next(self._chunks)
+            except StopIteration:
+                return ""
+            self._pos = 0
+        end = len(self._chunk) if size < 0 else self._pos + size
+        data = self._chunk[self._pos:end]
+        self._pos += len(data)
+        return data
+
+class JPERUnavailableException(client.JPERConnectionException):
+    """
+    Exception raised when a request is not sent because JPER is considered to be unavailable
+    """
+    def __init__(self, message, retry_after=None):
+        super(JPERUnavailableException, self).__init__(message)
+        self.retry_after = retry_after
+
+def jper_breaker():
+    """
+    Get the circuit breaker guarding requests to JPER, configured by JPER_BREAKER_THRESHOLD and
+    JPER_BREAKER_RESET_TIMEOUT
+
+    :return: the CircuitBreaker
+    """
+    return breaker.get_breaker("jper",
+                               threshold=app.config.get("JPER_BREAKER_THRESHOLD", 5),
+                               reset_timeout=app.config.get("JPER_BREAKER_RESET_TIMEOUT", 30))
+
+def get_client(api_key):
+    """
+    Get a JPER client for the given API key, which will communicate with JPER over the shared session
+
+    :param api_key: the user's API key for JPER
+    :return: a JPERClient
+    """
+    return JPERClient(api_key=api_key)
+
+class JPERClient(client.JPER):
+    """
+    Implementation of the parts of the octopus JPER client used by this application, which sends its requests
+    over the pooled, keep-alive HTTP session, with connect and read timeouts from the configuration.
+    """
+    def __init__(self, api_key=None, base_url=None):
+        super(JPERClient, self).__init__(api_key=api_key)
+        self.base_url = app.config.get("JPER_BASE_URL") if base_url is None else base_url
+        if self.base_url.endswith("/"):
+            self.base_url = self.base_url[:-1]
+
+    def get_notification(self, notification_id=None, location=None):
+        """
+        Retrieve a notification from JPER, either by its id or by its location
+
+        :param notification_id: the id of the notification
+        :param location: the full url of the notification, as an alternative to the id
+        :return: an OutgoingNotification or ProviderOutgoingNotification, or None if there is no such notification
+        """
+        url = location if location is not None else self._jper_url("notification", notification_id)
+        resp = self._request("GET", url, operation="get_notification", retries=app.config.get("JPER_RETRIES", 2))
+
+        if resp.status_code == 404:
+            return None
+        if resp.status_code == 401:
+            raise client.JPERAuthException(u"Could not authenticate with JPER with your API key")
+        if resp.status_code != 200:
+            raise client.JPERException(u"Received unexpected status code from {y}: {x}".format(x=resp.status_code, y=url))
+
+        j = resp.json()
+        if "provider" in j:
+            return models.ProviderOutgoingNotification(j)
+        return models.OutgoingNotification(j)
+
+    def list_notifications(self, since, page=1, page_size=100):
+        """
+        List the notifications JPER has routed since the given date, a page at a time, from its /routed feed.  JPER
+        has no listing of the notifications deposited by an account, so this is the listing of every routed
+        notification, whoever deposited it; notifications which have not yet been routed are not in it, and the
+        date is compared with the date each notification was routed
+
+        :param since: the date from which to list notifications, as YYYY-MM-DDThh:mm:ssZ
+        :param page: the page number
+        :param page_size: the number of notifications on each page
+        :return: dict of the total number of notifications ("total") and the notifications on the page
+            ("notifications"), as OutgoingNotification or ProviderOutgoingNotification objects
+        """
+        url = self._jper_url("routed")
+        params = {"since" : since, "page" : page, "pageSize" : page_size}
+        resp = self._request("GET", url, operation="list_notifications", retries=app.config.get("JPER_RETRIES", 2), params=params)
+
+        if resp.status_code == 401:
+            raise client.JPERAuthException(u"Could not authenticate with JPER with your API key")
+        if resp.status_code == 400:
+            raise client.JPERException(self._error_message(resp))
+        if resp.status_code != 200:
+            raise client.JPERException(u"Received unexpected status code from {y}: {x}".format(x=resp.status_code, y=url))
+
+        j = resp.json()
+        notes = []
+        for n in j.get("notifications", []):
+            notes.append(models.ProviderOutgoingNotification(n) if "provider" in n else models.OutgoingNotification(n))
+        return {"total" : j.get("total"), "notifications" : notes}
+
+    def notification_exists(self, notification_id):
+        """
+        Check whether a notification exists in JPER, with a HEAD request, so that it is not retrieved.  If JPER
+        does not allow HEAD requests, the notification is retrieved instead.
+
+        :param notification_id: the id of the notification
+        :return: True if the notification exists, False if not
+        """
+        url = self._jper_url("notification", notification_id)
+        resp = self._request("HEAD", url, operation="notification_exists", retries=app.config.get("JPER_RETRIES", 2))
+
+        if resp.status_code == 200:
+            return True
+        if resp.status_code == 404:
+            return False
+        if resp.status_code == 401:
+            raise client.JPERAuthException(u"Could not authenticate with JPER with your API key")
+        if resp.status_code == 405:
+            return self.get_notification(notification_id=notification_id) is not None
+        raise client.JPERException(u"Received unexpected status code from {y}: {x}".format(x=resp.status_code, y=url))
+
+    def get_content(self, url):
+        """
+        Start retrieving a content package from JPER.  The body of the response is not read until the caller
+        reads it, so the package can be streamed to disk; the caller must close the response.
+
+        :param url: the full url of the package, as given in the notification's links
+        :return: the streaming response, or None if there is no such package, or this client's account may not
+            retrieve it
+        """
+        resp = self._request("GET", url, operation="get_content", retries=app.config.get("JPER_RETRIES", 2), stream=True)
+
+        if resp.status_code in [403, 404]:
+            resp.close()
+            return None
+        if resp.status_code == 401:
+            resp.close()
+            raise client.JPERAuthException(u"Could not authenticate with JPER with your API key")
+        if resp.status_code != 200:
+            resp.close()
+            raise client.JPERException(u"Received unexpected status code from {y}: {x}".format(x=resp.status_code, y=url))
+        return resp
+
+    def content_accessible(self, url):
+        """
+        Check whether this client's account may retrieve a package from JPER, with a HEAD request, so that the
+        package is not downloaded.  If JPER does not allow HEAD requests, the download is started and abandoned.
+
+        :param url: the full url of the package, as given in the notification's links
+        :return: True if the package exists and the account may retrieve it, False if not
+        """
+        resp = self._request("HEAD", url, operation="content_accessible", retries=app.config.get("JPER_RETRIES", 2))
+
+        if resp.status_code == 200:
+            return True
+        if resp.status_code in [403, 404]:
+            return False
+        if resp.status_code == 401:
+            raise client.JPERAuthException(u"Could not authenticate with JPER with your API key")
+        if resp.status_code == 405:
+            content = self.get_content(url)
+            if content is None:
+                return False
+            content.close()
+            return True
+        raise client.JPERException(u"Received unexpected status code from {y}: {x}".format(x=resp.status_code, y=url))
+
+    def check_credentials(self):
+        """
+        Check whether JPER accepts this client's API key, by requesting a notification which does not exist.
+        JPER authenticates the request before looking for the notification, so a 401 means the key was refused.
+
+        :return: True if the API key is valid, False if not
+        """
+        url = self._jper_url("notification", app.config.get("JPER_CREDENTIAL_PROBE_ID", "sword-in-credential-check"))
+        resp = self._request("GET", url, operation="check_credentials", retries=app.config.get("JPER_RETRIES", 2))
+        if resp.status_code == 401:
+            return False
+        if resp.status_code not in [200, 404]:
+            raise client.JPERException(u"Received unexpected status code from {y}: {x}".format(x=resp.status_code, y=url))
+        return True
+
+    def validate(self, notification, file_handle=None):
+        """
+        Send the notification, and any associated content, to JPER for validation only
+
+        :param notification: the IncomingNotification to validate
+        :param file_handle: file-like object holding the associated content package, if any
+        :return: True if the notification is valid
+        """
+        resp = self._post_notification(self._jper_url("validate"), notification, file_handle, "validate")
+
+        if resp.status_code == 401:
+            raise client.JPERAuthException(u"Could not authenticate with JPER with your API key")
+        if resp.status_code == 400:
+            raise client.ValidationException(self._error_message(resp))
+        if resp.status_code != 204:
+            raise client.JPERException(u"Received unexpected status code from JPER validate: {x}".format(x=resp.status_code))
+        return True
+
+    def create_notification(self, notification, file_handle=None):
+        """
+        Send the notification, and any associated content, to JPER for routing
+
+        :param notification: the IncomingNotification to create
+        :param file_handle: file-like object holding the associated content package, if any
+        :return: tuple of the id of the new notification and its location
+        """
+        resp = self._post_notification(self._jper_url("notification"), notification, file_handle, "create_notification")
+
+        if resp.status_code == 401:
+            raise client.JPERAuthException(u"Could not authenticate with JPER with your API key")
+        if resp.status_code == 400:
+            raise client.ValidationException(self._error_message(resp))
+        if resp.status_code != 202:
+            raise client.JPERException(u"Received unexpected status code from JPER create: {x}".format(x=resp.status_code))
+
+        j = resp.json()
+        return j.get("id"), j.get("location")
+
+    def _jper_url(self, *parts):
+        """
+        Build the url of a JPER API endpoint
+
+        :param parts: the path segments of the endpoint, which will be url-escaped
+        :return: the full url
+        """
+        return self.base_url + "/" + "/".join([quote(p, safe="") for p in parts])
+
+    def _post_notification(self, url, notification, file_handle, operation):
+        """
+        POST a notification to JPER, as plain JSON or, if there is content, as a multipart request
+
+        The multipart body is streamed to JPER as it is read from the file handle, in chunks of
+        JPER_UPLOAD_CHUNK_SIZE, so the content is never held in memory; content in a file on disk is read
+        through a memory map (see service.uploads).  It is sent with a Content-Length whenever the length of the
+        content can be determined, and with chunked transfer encoding only if it can't (such as a streamed deposit
+        sent without a Content-Length), or if JPER_UPLOAD_CHUNKED is set.
+
+        POSTs are never retried, since JPER may have acted on one which appeared to fail.
+
+        :param url: the endpoint to POST to
+        :param notification: the notification model object
+        :param file_handle: file-like object holding the content package, or None
+        :param operation: the name of the operation, which selects its timeouts
+        :return: the response
+        """
+        metadata = json.dumps(notification.data)
+        if file_handle is None:
+            return self._request("POST", url, operation=operation, data=metadata, headers={"Content-Type" : "application/json"})
+
+        boundary = uuid.uuid4().hex
+        head = ("--" + boundary + "\r\n" +
+                "Content-Disposition: form-data; name=\"metadata\"; filename=\"metadata.json\"\r\n" +
+                "Content-Type: application/json\r\n\r\n" +
+                metadata + "\r\n" +
+                "--" + boundary + "\r\n" +
+                "Content-Disposition: form-data; name=\"content\"; filename=\"content.zip\"\r\n" +
+                "Content-Type: application/zip\r\n\r\n")
+        tail = "\r\n--" + boundary + "--\r\n"
+
+        headers = {"Content-Type" : "multipart/form-data; boundary=" + boundary}
+        length = self._content_length(file_handle)
+        body = MultipartBody(head, file_handle, tail, length, app.config.get("JPER_UPLOAD_CHUNK_SIZE", 1048576), operation)
+        if length is None or app.config.get("JPER_UPLOAD_CHUNKED", False):
+            # an iterator with no length is sent with chunked transfer encoding
+            data = iter(body)
+        else:
+            data = body
+            headers["Content-Length"] = str(len(body))
+
+        return self._request("POST", url, operation=operation, data=data, headers=headers)
+
+    def _content_length(self, file_handle):
+        """
+        Work out how many bytes remain to be read from the file handle, if possible: from its length attribute, the
+        size of the file it is open on, or, for a seekable object with no file (such as a deposit received into
+        memory by service.uploads), by seeking to its end and back
+
+        :param file_handle: the file-like object
+        :return: the number of bytes, or None if it can't be determined
+        """
+        length = getattr(file_handle, "length", None)
+        if length is not None:
+            return length
+        try:
+            return os.fstat(file_handle.fileno()).st_size - file_handle.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+        try:
+            start = file_handle.tell()
+            file_handle.seek(0, 2)
+            end = file_handle.tell()
+            file_handle.seek(start)
+            return end - start
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+
+    def _request(self, method, url, operation=None, retries=0, **kwargs):
+        """
+        Issue a request to JPER over the shared session, authenticated with this client's API key
+
+        The request is refused with a JPERUnavailableException if the circuit breaker is open.  Connection errors,
+        timeouts and 5xx responses count as failures towards opening the breaker, and are retried up to the given
+        number of times, after a backoff of JPER_RETRY_BACKOFF seconds, doubling with each attempt up to
+        JPER_RETRY_BACKOFF_MAX, with random jitter.  If all attempts fail, a client.JPERConnectionException is
+        raised, whether the last failure was a connection error or a 5xx response.
+
+        :param method: the HTTP method
+        :param url: the full url to request
+        :param operation: the name of the operation, which selects its timeouts from JPER_TIMEOUTS
+        :param retries: number of times to retry a failed request; only for requests which are safe to repeat
+        :param kwargs: further arguments for requests.Session.request
+        :return: the response, whose status is below 500
+        """
+        params = kwargs.pop("params", {})
+        if self.api_key:
+            params["api_key"] = self.api_key
+        kwargs.setdefault("timeout", self._timeout(operation))
+
+        br = jper_breaker()
+        resp = None
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                backoff = min(app.config.get("JPER_RETRY_BACKOFF", 0.1) * (2 ** (attempt - 1)), app.config.get("JPER_RETRY_BACKOFF_MAX", 2))
+                time.sleep(backoff * random.uniform(0.5, 1.0))
+                app.logger.info(u"Retrying %s request to JPER, attempt %s of %s", operation, attempt + 1, retries + 1)
+
+            if not br.allow():
+                metrics.upstream_request(operation, 0, "unavailable")
+                raise JPERUnavailableException(u"JPER is unavailable, not sending {x} request".format(x=operation), br.retry_after())
+
+            start = time.time()
+            try:
+                resp = session().request(method, url, params=params, **kwargs)
+            except requests.exceptions.RequestException as e:
+                br.failure()
+                metrics.upstream_request(operation, time.time() - start, "timeout" if isinstance(e, requests.exceptions.Timeout) else "connection")
+                if attempt == retries:
+                    raise client.JPERConnectionException(u"Unable to communicate with JPER at {x}: {y}".format(x=url, y=e))
+                continue
+            except Exception:
+                # not a failure of JPER (e.g. the deposit could not be read from the client), so doesn't count
+                br.abandon()
+                raise
+
+            if resp.status_code < 500:
+                br.success()
+                metrics.upstream_request(operation, time.time() - start)
+                return resp
+            br.failure()
+            metrics.upstream_request(operation, time.time() - start, "http_" + str(resp.status_code))
+            resp.close()
+
+        # a 5xx (typically a 502, 503 or 504 from the proxy in front of JPER) means JPER is unavailable, just as a
+        # connection error does
+        raise client.JPERConnectionException(u"JPER at {x} answered with status {y}".format(x=url, y=resp.status_code))
+
+    def _timeout(self, operation):
+        """
+        Get the connect and read timeouts for an operation, from JPER_TIMEOUTS, or JPER_CONNECT_TIMEOUT and
+        JPER_READ_TIMEOUT if it has none of its own
+
+        :param operation: the name of the operation
+        :return: tuple of connect and read timeouts, in seconds
+        """
+        default = (app.config.get("JPER_CONNECT_TIMEOUT", 5), app.config.get("JPER_READ_TIMEOUT", 60))
+        return tuple(app.config.get("JPER_TIMEOUTS", {}).get(operation, default))
+
+    def _error_message(self, resp):
+        """
+        Extract the error message from a JPER error response
+
+        :param resp: the response
+        :return: the error message
+        """
+        try:
+            return resp.json().get("error")
+        except ValueError:
+            return resp.text
@@ -8,8 +8,13 @@ To start the application directly using the python web server, you can just do
     python web.py
 
 Refer to server installation documentation for more details how to deploy in production.
+
+Each phase of start-up is timed, and the times logged when it is complete (see service.startup).
 """
-from octopus.core import app, initialise, add_configuration
+from service import startup
+
+with startup.phase("import octopus"):
+    from octopus.core import app, initialise, add_configuration
 
 if __name__ == "__main__":
     import argparse
@@ -31,18 +36,54 @@ if __name__ == "__main__":
         pydevd.settrace(app.config.get('DEBUG_SERVER_HOST', 'localhost'), port=app.config.get('DEBUG_SERVER_PORT', 51234), stdoutToServer=True, stderrToServer=True)
         print "STARTED IN REMOTE DEBUG MODE"
 
-    initialise()
+    with startup.phase("initialise"):
+        initialise()
 
 # most of the imports should be done here, after initialise()
 from flask import render_template
 
-from octopus.modules.swordv2.swordv2_server import blueprint as swordv2
-app.register_blueprint(swordv2)
+with startup.phase("register swordv2 blueprint"):
+    from octopus.modules.swordv2.swordv2_server import blueprint as swordv2
+    app.register_blueprint(swordv2)
+
+with startup.phase("import service modules"):
+    from octopus.modules.jper import client
+    from service import compression, logs, metrics, passthrough, responses, spool, upstream
+if app.config.get("NOTIFY_ASYNC", False):
+    # deliver anything left in the spool from before this process started
+    app.before_first_request(spool.start_forwarders)
+app.before_request(logs.assign_request_id)
+app.before_request(metrics.start_timer)
+app.before_request(passthrough.reject_early)
+app.before_request(passthrough.stream_deposit)
+app.before_request(passthrough.proxy_media_resource)
+app.before_request(passthrough.stream_collection)
+# after_request handlers run in the reverse of the order they are registered: the recorded headers are applied,
+# then the response is compressed (which needs its ETag), then answered with a 304 if the client already has the
+# variant being sent (which needs that variant's ETag, and keeps its Vary), and the metrics record the status sent
+app.after_request(metrics.record_request)
+app.after_request(responses.conditional_response)
+app.after_request(compression.compress_response)
+app.after_request(responses.apply_headers)
+app.errorhandler(upstream.JPERUnavailableException)(passthrough.upstream_unavailable)
+app.errorhandler(client.JPERConnectionException)(passthrough.upstream_unavailable)
+
+if app.config.get("METRICS_ENDPOINT", False):
+    @app.route("/metrics")
+    def prometheus_metrics():
+        if not metrics.scrape_authorised():
+            return "", 401, {"WWW-Authenticate" : "Bearer"}
+        return metrics.render()
 
 @app.errorhandler(404)
 def page_not_found(e):
     return render_template('errors/404.html'), 404
 
+if app.config.get("PRELOAD", True):
+    with startup.phase("preload"):
+        startup.preload()
+startup.report()
+
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', debug=app.config['DEBUG'], port=app.config['PORT'], threaded=False)
+    app.run(host='0.0.0.0', debug=app.config['DEBUG'], port=app.config['PORT'], threaded=app.config.get('THREADED', False))
 
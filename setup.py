@@ -7,7 +7,9 @@ setup(
     install_requires = [
         "octopus==1.0.0",
         "esprit",
-        "Flask"
+        "Flask",
+        "requests",
+        "prometheus_client<0.13"
     ],
     url = 'http://cottagelabs.com/',
     author = 'Cottage Labs',